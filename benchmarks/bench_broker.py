@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+'''
+Benchmark: throughput of the broker forwarding loop
+
+Measures messages/sec through the broker on loopback, with an echo worker
+behind it and a single client that keeps a window of requests in flight.
+On Linux, also reports the CPU time the broker process spends per message.
+
+- legacy: the broker loop before the multipart protocol, which split the
+  message on spaces, re-joined it and sent it frame by frame
+- multipart: daemons/broker.py, which routes on the target frame and
+  forwards the packed body untouched
+- fast: daemons/broker.py --fast, which only relays the frames, with the
+  return address in the worker token instead of a table of pending requests
+
+Then checks that a worker that never answers some requests doesn't hold on
+to its slots: the worker answers 'discover' only STUCK_DELAY seconds late,
+the client sends MAX_IN_FLIGHT of them (enough to take all the slots of the
+worker) with a short ttl, and then a 'state' request. The discovers must
+fail once their deadline passes, the state request must go through, and the
+late replies must be dropped. Exits with an error otherwise.
+
+Needs the broker ports (9800/9801) to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import json
+import time
+import itertools
+import multiprocessing
+
+import zmq
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+
+from devices import protocol
+import broker
+
+BROKER_URL = "tcp://localhost:9800"
+WORKER_URL = "tcp://localhost:9801"
+
+# Number of requests, and how many are kept in flight at once
+N_REQUESTS = 20000
+WINDOW = 100
+
+# Requests as the daemons receive them: a plain state query, and
+# a write with a few arguments. The query is for a different device every
+# time, so that the broker can't answer identical reads with a single reply
+COMMANDS = [['state', 'Kitchen{}'],
+            ['write', 'BC:6A:29:AB:D3:7A', '0x29', '01']]
+
+# Requests that the broker sends a worker at a time (its default), the ttl of
+# the requests that the worker holds on to, and how late it answers them
+MAX_IN_FLIGHT = 8
+STUCK_TTL = 0.3
+STUCK_DELAY = 4
+
+def legacy_broker():
+    '''
+    The broker loop as it was with the space-separated protocol: requests
+    are [b'', req_id, "target command device args..."], and workers register
+    and send heartbeats as [b'', command]
+    '''
+    sys.stdout = open(os.devnull, 'w')
+    context = zmq.Context()
+    clients = context.socket(zmq.ROUTER)
+    clients.bind("tcp://*:9800")
+    workers = context.socket(zmq.ROUTER)
+    workers.bind("tcp://*:9801")
+
+    poller = zmq.Poller()
+    poller.register(clients, zmq.POLLIN)
+    poller.register(workers, zmq.POLLIN)
+
+    liveness = protocol.HEARTBEAT_INTERVAL * protocol.HEARTBEAT_LIVENESS
+    registered_workers = {}
+    pending = {}
+    tokens = itertools.count()
+
+    while True:
+        socks = dict(poller.poll(protocol.HEARTBEAT_INTERVAL * 1e3))
+
+        if (clients in socks and socks[clients] == zmq.POLLIN):
+            client_addr, empty, req_id, msg = clients.recv_multipart()
+            print "Client with address: {}".format(client_addr)
+            print "Message is {}".format(msg)
+
+            cmds = msg.split(' ')
+            target = cmds[0]
+            if target not in registered_workers:
+                clients.send_multipart([client_addr, b'', req_id, b'ERROR Unknown target'])
+                continue
+
+            token = str(next(tokens))
+            pending[token] = (client_addr, req_id)
+
+            workers.send(target, zmq.SNDMORE)
+            workers.send(token, zmq.SNDMORE)
+            workers.send(b'', zmq.SNDMORE)
+            workers.send(' '.join(cmds[1:]))
+
+        if (workers in socks and socks[workers] == zmq.POLLIN):
+            frames = workers.recv_multipart()
+            identity = frames[0]
+            registered_workers[identity] = time.time() + liveness
+            if frames[1] == b'':
+                continue
+
+            _, token, _, msg = frames
+            client_addr, req_id = pending.pop(token)
+            print "Received response for client '{}' : {}".format(client_addr, msg)
+
+            clients.send_multipart([client_addr, b'', req_id, msg])
+
+        now = time.time()
+        for identity, expiry in registered_workers.items():
+            if expiry < now:
+                del registered_workers[identity]
+
+def multipart_broker():
+    ''' daemons/broker.py, started the same way as the legacy broker '''
+    sys.stdout = open(os.devnull, 'w')
+    broker.main([])
+
+def fast_broker():
+    ''' daemons/broker.py in --fast mode '''
+    sys.stdout = open(os.devnull, 'w')
+    broker.main(['--fast'])
+
+def legacy_worker():
+    ''' Echo worker for the legacy broker, which re-tokenizes the message '''
+    socket = zmq.Context().socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, b"Echo")
+    socket.connect(WORKER_URL)
+    socket.send_multipart([b'', protocol.W_READY])
+
+    p = zmq.Poller()
+    p.register(socket, zmq.POLLIN)
+    while True:
+        if not p.poll(protocol.HEARTBEAT_INTERVAL * 1e3):
+            socket.send_multipart([b'', protocol.W_HEARTBEAT])
+            continue
+        client_addr, _, msg = socket.recv_multipart()
+        msg = msg.split(' ')
+        socket.send_multipart([client_addr, b'', ' '.join(msg)])
+
+def multipart_worker():
+    ''' Echo worker for the current broker '''
+    socket = zmq.Context().socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, b"Echo")
+    socket.connect(WORKER_URL)
+    socket.send_multipart(protocol.control(protocol.W_READY, b"Echo"))
+
+    p = zmq.Poller()
+    p.register(socket, zmq.POLLIN)
+    while True:
+        if not p.poll(protocol.HEARTBEAT_INTERVAL * 1e3):
+            socket.send_multipart(protocol.control(protocol.W_HEARTBEAT, b"Echo"))
+            continue
+        token, body = socket.recv_multipart()
+        socket.send_multipart([token] + protocol.ok_reply(*protocol.unpack(body)))
+
+def stuck_worker():
+    ''' Echo worker that answers the 'discover' requests STUCK_DELAY seconds late '''
+    socket = zmq.Context().socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, b"Echo")
+    socket.connect(WORKER_URL)
+    socket.send_multipart(protocol.control(protocol.W_READY, b"Echo"))
+
+    # Replies held back, as (time to send, frames)
+    held = []
+    next_beat = time.time() + protocol.HEARTBEAT_INTERVAL
+    p = zmq.Poller()
+    p.register(socket, zmq.POLLIN)
+    while True:
+        now = time.time()
+        if now >= next_beat:
+            socket.send_multipart(protocol.control(protocol.W_HEARTBEAT, b"Echo"))
+            next_beat = now + protocol.HEARTBEAT_INTERVAL
+        for reply in [reply for reply in held if reply[0] <= now]:
+            held.remove(reply)
+            socket.send_multipart(reply[1])
+
+        if not p.poll(100):
+            continue
+        token, body = socket.recv_multipart()
+        fields = protocol.unpack(body)
+        reply = [token] + protocol.ok_reply(*fields)
+        if fields[0] == 'discover':
+            held.append((time.time() + STUCK_DELAY, reply))
+        else:
+            socket.send_multipart(reply)
+
+def check_stuck():
+    '''
+    Take all the slots of the worker with requests that it only answers
+    late, then check that a request still goes through. Returns a list of
+    what went wrong
+    '''
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.connect(BROKER_URL)
+    p = zmq.Poller()
+    p.register(socket, zmq.POLLIN)
+    problems = []
+
+    def send(req_id, target, ttl, fields):
+        socket.send_multipart([protocol.VERSION, req_id, target, str(int(ttl * 1e3)),
+                               protocol.pack(fields)])
+
+    def receive(timeout, wanted=None):
+        ''' The next reply (to `wanted` if given), None if it takes more than `timeout` '''
+        deadline = time.time() + timeout
+        while p.poll(max(deadline - time.time(), 0) * 1e3):
+            _, req_id, status, payload = socket.recv_multipart()
+            if wanted is None or req_id == wanted:
+                return req_id, status, protocol.unpack(payload)
+        return None
+
+    start = time.time()
+    for i in range(MAX_IN_FLIGHT):
+        send(str(i), 'Echo', STUCK_TTL, ['discover', ''])
+    for i in range(MAX_IN_FLIGHT):
+        reply = receive(STUCK_DELAY)
+        if reply is None:
+            problems.append("only {} of the stuck requests were answered".format(i))
+            break
+        if reply[1] != protocol.ERROR:
+            problems.append("a stuck request was answered with {}".format(reply[1]))
+    failed = time.time() - start
+
+    send('state', 'Echo', 1, ['state', 'Kitchen'])
+    reply = receive(1, 'state')
+    if reply is None or reply[1] != protocol.OK:
+        problems.append("the request after the stuck ones was answered with {}".format(
+            reply and reply[1]))
+
+    # Let the late replies come in
+    time.sleep(max(start + STUCK_DELAY + 1 - time.time(), 0))
+    send('stats', protocol.BROKER, 1, [protocol.B_STATS, ''])
+    stats = json.loads(receive(1, 'stats')[2][0])
+    timed_out = stats['targets']['Echo'].get('timed_out', 0)
+    if timed_out != MAX_IN_FLIGHT:
+        problems.append("{} requests timed out in flight, not {}".format(timed_out, MAX_IN_FLIGHT))
+    if stats['late_replies'] != MAX_IN_FLIGHT:
+        problems.append("{} late replies dropped, not {}".format(stats['late_replies'], MAX_IN_FLIGHT))
+
+    print "stuck requests failed after {:.1f} s, {} timed out in flight, {} late replies dropped".format(
+        failed, timed_out, stats['late_replies'])
+    socket.close()
+    return problems
+
+def drive(make_request):
+    ''' Send N_REQUESTS requests keeping WINDOW in flight, return messages/sec '''
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.connect(BROKER_URL)
+
+    # Warm up, and make sure that the worker is registered
+    socket.send_multipart(make_request(0))
+    socket.recv_multipart()
+
+    start = time.time()
+    sent = received = 0
+    while received < N_REQUESTS:
+        while sent < N_REQUESTS and sent - received < WINDOW:
+            socket.send_multipart(make_request(sent))
+            sent += 1
+        socket.recv_multipart()
+        received += 1
+    elapsed = time.time() - start
+
+    socket.close()
+    return N_REQUESTS / elapsed
+
+def cpu_seconds(pid):
+    ''' CPU time used by process `pid` so far, None if not available '''
+    try:
+        fields = open('/proc/{}/stat'.format(pid)).read().split()
+    except IOError:
+        return None
+    return (int(fields[13]) + int(fields[14])) / float(os.sysconf('SC_CLK_TCK'))
+
+def run(name, n_fields, broker, worker, make_request):
+    broker = multiprocessing.Process(target=broker)
+    broker.start()
+    worker = multiprocessing.Process(target=worker)
+    worker.daemon = True
+    worker.start()
+    time.sleep(1)
+
+    try:
+        start = cpu_seconds(broker.pid)
+        rate = drive(make_request)
+        end = cpu_seconds(broker.pid)
+
+        # CPU used by the broker alone, as the processes share the machine
+        per_msg = "n/a" if start is None else "{:.1f}".format((end - start) / N_REQUESTS * 1e6)
+        print "{:>10} {:>8} {:>10.0f} {:>12}".format(name, n_fields, rate, per_msg)
+    finally:
+        worker.terminate()
+        broker.terminate()
+        time.sleep(0.5)
+
+def main():
+    print "{:>10} {:>8} {:>10} {:>12}".format("protocol", "fields", "msg/s", "broker us/msg")
+    for command in COMMANDS:
+        fields = lambda i: [field.format(i) for field in command]
+        run("legacy", len(command), legacy_broker, legacy_worker,
+            lambda i: [b'', str(i), ' '.join(['Echo'] + fields(i))])
+
+        request = lambda i: [protocol.VERSION, str(i), 'Echo', b'0', protocol.pack(fields(i))]
+        run("multipart", len(command), multipart_broker, multipart_worker, request)
+        run("fast", len(command), fast_broker, multipart_worker, request)
+
+    broker = multiprocessing.Process(target=multipart_broker)
+    worker = multiprocessing.Process(target=stuck_worker)
+    worker.daemon = True
+    for process in (broker, worker):
+        process.start()
+    time.sleep(1)
+    try:
+        problems = check_stuck()
+    finally:
+        worker.terminate()
+        broker.terminate()
+    if problems:
+        sys.exit("FAIL: " + "; ".join(problems))
+
+if __name__ == "__main__": main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+Benchmark: per-call sockets vs. the pooled broker client
+
+Starts the broker, plus an echo worker that answers every request
+immediately, and then measures round trips through the broker with
+1, 10 and 100 concurrent callers:
+
+- per-call: every request creates, connects and closes a socket
+  (what the device drivers used to do)
+- pooled: every request goes through the shared `devices.client` connection
+
+Needs the broker ports (9800/9801) to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import time
+import threading
+import subprocess
+
+import zmq
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+
+from devices.client import BrokerClient
+from devices import protocol
+
+BROKER_URL = "tcp://localhost:9800"
+WORKER_URL = "tcp://localhost:9801"
+
+def echo_worker(context):
+    ''' Worker that registers as `Echo` and replies with the request frames '''
+    socket = context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, b"Echo")
+    socket.connect(WORKER_URL)
+    socket.send_multipart(protocol.control(protocol.W_READY, b"Echo"))
+
+    p = zmq.Poller()
+    p.register(socket, zmq.POLLIN)
+    while True:
+        if not p.poll(protocol.HEARTBEAT_INTERVAL * 1e3):
+            socket.send_multipart(protocol.control(protocol.W_HEARTBEAT, b"Echo"))
+            continue
+        token, body = socket.recv_multipart()
+        socket.send_multipart([token] + protocol.ok_reply(*protocol.unpack(body)))
+
+def per_call_request(target, command):
+    ''' One round trip with a fresh socket '''
+    context = zmq.Context.instance()
+    sock = context.socket(zmq.DEALER)
+    sock.connect(BROKER_URL)
+    sock.send_multipart([protocol.VERSION, b'0', target, b'0', protocol.pack([command, b''])])
+    result = sock.recv_multipart()
+    sock.close()
+    return result
+
+def run(request, n_callers, n_requests):
+    '''
+    Run `n_callers` threads that each send `n_requests` requests
+    Returns (requests/sec, mean latency in ms, p95 latency in ms)
+    '''
+    latencies = []
+    lock = threading.Lock()
+
+    def caller():
+        local = []
+        for i in range(n_requests):
+            start = time.time()
+            request('Echo', 'ping')
+            local.append(time.time() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=caller) for i in range(n_callers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    p95 = latencies[int(len(latencies) * 0.95)]
+    return len(latencies) / elapsed, mean * 1e3, p95 * 1e3
+
+def main():
+    broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'daemons', 'broker.py')],
+                              stdout=open(os.devnull, 'w'))
+    try:
+        context = zmq.Context.instance()
+        worker = threading.Thread(target=echo_worker, args=(context,))
+        worker.daemon = True
+        worker.start()
+
+        client = BrokerClient(BROKER_URL)
+
+        # Make sure that everything is connected before timing
+        time.sleep(1)
+        client.request('Echo', 'ping')
+
+        template = "{:>10} {:>8} {:>12} {:>10} {:>10}"
+        print template.format("mode", "callers", "req/s", "mean ms", "p95 ms")
+        for n_callers in [1, 10, 100]:
+            n_requests = max(2000 // n_callers, 20)
+            for mode, fn in [("per-call", per_call_request), ("pooled", client.request)]:
+                rate, mean, p95 = run(fn, n_callers, n_requests)
+                print template.format(mode, n_callers, "{:.0f}".format(rate),
+                                      "{:.2f}".format(mean), "{:.2f}".format(p95))
+    finally:
+        broker.terminate()
+
+if __name__ == "__main__": main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''
+Benchmark: round trips to gatttool per read in the GATT daemon
+
+Drives benchmarks/fake_gatttool.py (as `gatttool`) with the read functions
+of daemons/bt_gatt.py, and counts the commands sent to gatttool per read
+and the time each read takes.
+
+- as it was: the read path that checked the connection with a blank line
+  before the read and after it, and before every write, with the pauses
+  of pexpect before sending every command (50 ms) and after every read
+- probing: the same, without the pauses
+- tracked: daemons/bt_gatt.py, which knows the state of the connection
+  from the prompts of gatttool, and only checks it when it can't tell
+
+`read` is a plain char-read-hnd, `read_value` the enable, read, disable
+sequence of the SensorTag sensors (without the sleep). The fake takes
+LATENCY seconds per read, like the round trip over the air; writes and
+the connection checks don't go to the device.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+import bt_gatt
+import fake_gatttool
+from bt_gatt import wait
+
+ADDRESS = 'BC:6A:29:AB:D3:7A'
+N_READS = 500
+LATENCIES = [0, 0.0075]
+
+def probing_write(gatt, write_addr, write_value):
+    ''' st_write before the connection was tracked '''
+    gatt.sendline(' ')
+    stat = gatt.expect(bt_gatt.PROMPTS)
+    if stat == 1:
+        gatt.sendline('connect')
+        gatt.expect('\[CON\].*>', timeout=3)
+
+    gatt.sendline('char-write-cmd {} {}'.format(write_addr, write_value))
+    stat = gatt.expect(bt_gatt.PROMPTS)
+    if stat == 1:
+        return False
+
+def probing_read(gatt, read_addr):
+    ''' st_read before the connection was tracked '''
+    wait(bt_gatt.st_check_connected(gatt))
+
+    gatt.sendline('char-read-hnd {}'.format(read_addr))
+    gatt.expect('descriptor: (?P<value>.*) \r\n')
+    rval = gatt.match.group('value')
+    gatt.expect('\[CON\].*>')
+    wait(bt_gatt.st_check_connected(gatt))
+
+    return rval
+
+def probing_read_value(gatt, ctrl_addr, read_addr, enable_cmd, disable_cmd):
+    probing_write(gatt, ctrl_addr, enable_cmd)
+    rval = probing_read(gatt, read_addr)
+    probing_write(gatt, ctrl_addr, disable_cmd)
+    return rval
+
+def tracked_read(gatt, read_addr):
+    return wait(bt_gatt.st_read(gatt, read_addr))
+
+def tracked_read_value(gatt, ctrl_addr, read_addr, enable_cmd, disable_cmd):
+    return wait(bt_gatt.st_read_value(gatt, ctrl_addr, read_addr, enable_cmd, disable_cmd,
+                                      sleep_amount=0))
+
+def count_commands(gatt):
+    ''' Count the lines sent to `gatt`, returns the counter '''
+    counter = [0]
+    sendline = gatt.sendline
+    def counting(line=''):
+        counter[0] += 1
+        return sendline(line)
+    gatt.sendline = counting
+    return counter
+
+# pexpect's pauses before sending and after reading, by default
+PEXPECT_DELAYS = (0.05, 0.0001)
+
+def run(latency, name, operation, read, n_reads=N_READS, delays=(None, None)):
+    os.environ['FAKE_GATTTOOL_LATENCY'] = str(latency)
+    gatt = bt_gatt.st_spawn(ADDRESS)
+    wait(bt_gatt.st_connect(gatt))
+    gatt.delaybeforesend, gatt.delayafterread = delays
+    try:
+        counter = count_commands(gatt)
+        args = ['0x25'] if operation == 'read' else ['0x29', '0x25', '01', '00']
+        start = time.time()
+        for _ in range(n_reads):
+            read(gatt, *args)
+        elapsed = time.time() - start
+        print "{:>10} {:>10} {:>10} {:>12.1f} {:>10.2f}".format(
+            latency * 1e3, operation, name, counter[0] / float(n_reads),
+            elapsed / n_reads * 1e3)
+    finally:
+        wait(bt_gatt.st_disconnect(gatt))
+        wait(bt_gatt.st_exit(gatt))
+
+def main():
+    fake_gatttool.install()
+    print "{:>10} {:>10} {:>10} {:>12} {:>10}".format(
+        "latency ms", "operation", "path", "commands/read", "ms/read")
+    for latency in LATENCIES:
+        for operation, probing, tracked in [("read", probing_read, tracked_read),
+                                            ("read_value", probing_read_value, tracked_read_value)]:
+            run(latency, "as it was", operation, probing, N_READS // 20, PEXPECT_DELAYS)
+            run(latency, "probing", operation, probing)
+            run(latency, "tracked", operation, tracked)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+'''
+Benchmark: GATT daemon reads/sec and memory with 1 to 30 devices
+
+Runs the broker and daemons/bt_gatt.py, with benchmarks/fake_gatttool.py
+as gatttool, connects N devices, and has a client thread per device read
+a characteristic over and over for DURATION seconds. Reports
+
+- reads/s: reads of all the devices together, and per device
+- p50, p95: latency of the reads, through the broker
+- errors: reads that failed (after the daemon gave them a second chance)
+- KB/dev: memory (RSS) that the daemon takes per connected device, not
+  counting the gatttool processes
+- threads: threads of the daemon
+- CPU us/read: CPU time that the daemon spends per read
+
+The fake devices take LATENCY seconds per read. The steady ones keep
+their connection, the flaky ones drop it before DROP_RATE of the commands.
+
+Needs the broker ports (9800-9803) to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import time
+import threading
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+import broker
+import bt_gatt
+import fake_gatttool
+from devices.client import request, BrokerError
+
+SIZES = [1, 5, 10, 20, 30]
+DURATION = 5
+LATENCY = 0.0075
+DROP_RATE = 0.01
+
+def address(i):
+    return "00:00:00:00:00:{:02X}".format(i)
+
+def run_broker():
+    sys.stdout = open(os.devnull, 'w')
+    # Let every device have a read in flight
+    broker.main(['--max-in-flight', str(max(SIZES))])
+
+def run_daemon():
+    sys.stdout = open(os.devnull, 'w')
+    bt_gatt.main(['--max-connections', str(max(SIZES))])
+
+def status(pid, field):
+    ''' Number in the `field` line of /proc/<pid>/status '''
+    for line in open('/proc/{}/status'.format(pid)):
+        if line.startswith(field + ':'):
+            return int(line.split()[1])
+
+def cpu_seconds(pid):
+    ''' CPU time used by process `pid` so far '''
+    fields = open('/proc/{}/stat'.format(pid)).read().split()
+    return (int(fields[13]) + int(fields[14])) / float(os.sysconf('SC_CLK_TCK'))
+
+def reader(device, deadline, latencies, errors):
+    ''' Read from `device` until `deadline` '''
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            request('GATT', 'read', device, ['0x25'])
+            latencies.append(time.time() - start)
+        except BrokerError:
+            errors.append(device)
+
+def run(name, drop_rate, n_devices):
+    fake_gatttool.install({'*': {'latency': LATENCY, 'drop_rate': drop_rate}})
+    processes = [multiprocessing.Process(target=run_broker),
+                 multiprocessing.Process(target=run_daemon)]
+    for p in processes:
+        p.start()
+    time.sleep(1)
+
+    try:
+        daemon = processes[1].pid
+        baseline = status(daemon, 'VmRSS')
+
+        devices = [address(i) for i in range(n_devices)]
+        connects = [threading.Thread(target=request, args=('GATT', 'connect', device))
+                    for device in devices]
+        for t in connects:
+            t.start()
+        for t in connects:
+            t.join()
+
+        latencies = []
+        errors = []
+        cpu = cpu_seconds(daemon)
+        deadline = time.time() + DURATION
+        readers = [threading.Thread(target=reader, args=(device, deadline, latencies, errors))
+                   for device in devices]
+        for t in readers:
+            t.start()
+        for t in readers:
+            t.join()
+
+        cpu = cpu_seconds(daemon) - cpu
+        memory = (status(daemon, 'VmRSS') - baseline) / float(n_devices)
+        threads = status(daemon, 'Threads')
+
+        latencies.sort()
+        rate = len(latencies) / float(DURATION)
+        print "{:>8} {:>8} {:>10.0f} {:>12.1f} {:>8.1f} {:>8.1f} {:>8} {:>8.0f} {:>8} {:>12.0f}".format(
+            name, n_devices, rate, rate / n_devices,
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3, len(errors), memory, threads,
+            cpu / len(latencies) * 1e6)
+    finally:
+        for p in processes:
+            p.terminate()
+        time.sleep(0.5)
+
+def main():
+    print "{:>8} {:>8} {:>10} {:>12} {:>8} {:>8} {:>8} {:>8} {:>8} {:>12}".format(
+        "devices", "count", "reads/s", "reads/s/dev", "p50 ms", "p95 ms", "errors",
+        "KB/dev", "threads", "CPU us/read")
+    for name, drop_rate in [("steady", 0), ("flaky", DROP_RATE)]:
+        for n_devices in SIZES:
+            run(name, drop_rate, n_devices)
+
+if __name__ == "__main__": main()
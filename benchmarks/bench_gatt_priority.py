@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+Benchmark: interactive writes behind a burst of polling reads, GATT daemon
+
+Runs the broker and daemons/bt_gatt.py, with benchmarks/fake_gatttool.py
+as gatttool, and connects a single device. POLLERS client threads poll
+HANDLES characteristics of the device as fast as they can (as 'read:poll'),
+while another thread writes a setting every WRITE_INTERVAL seconds, one
+more drags a "slider" (bursts of SLIDER_BURST writes to another handle),
+and a "dashboard" reads one of the polled characteristics now and then.
+
+- fifo: the writes and the dashboard reads are sent with the poll
+  priority, so they queue up behind the polls like they did before the
+  priorities
+- priorities: they are interactive, and go ahead of the polls
+
+Reports the latency of the single writes, the polling reads/sec, and how
+many reads the daemon answered along with an identical one (coalesced)
+and how many slider writes it dropped for a later one (superseded), from
+its stats. (The broker already answers identical reads in flight together,
+the daemon still joins the dashboard reads to the polls.)
+
+Needs the broker ports (9800-9803) to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import json
+import time
+import threading
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+import broker
+import bt_gatt
+import fake_gatttool
+from devices.client import request, BrokerError
+
+ADDRESS = 'BC:6A:29:AB:D3:7A'
+DURATION = 5
+LATENCY = 0.0075
+POLLERS = 16
+HANDLES = ['0x25', '0x2d', '0x35', '0x3d']
+WRITE_INTERVAL = 0.1
+SLIDER_BURST = 10
+
+def run_broker():
+    sys.stdout = open(os.devnull, 'w')
+    # Hand all the requests to the daemon, so that it is the one to order them
+    broker.main(['--max-in-flight', str(POLLERS + 2)])
+
+def run_daemon():
+    sys.stdout = open(os.devnull, 'w')
+    bt_gatt.main()
+
+def poller(i, deadline, reads):
+    while time.time() < deadline:
+        try:
+            request('GATT', 'read:poll', ADDRESS, [HANDLES[i % len(HANDLES)]])
+            reads.append(1)
+        except BrokerError:
+            pass
+
+def writer(command, deadline, latencies):
+    value = 0
+    while time.time() < deadline:
+        value = 1 - value
+        start = time.time()
+        request('GATT', command, ADDRESS, ['0x29', '0{}'.format(value)])
+        latencies.append(time.time() - start)
+        time.sleep(WRITE_INTERVAL)
+
+def dashboard(command, deadline):
+    while time.time() < deadline:
+        try:
+            request('GATT', command, ADDRESS, [HANDLES[0]])
+        except BrokerError:
+            pass
+        time.sleep(WRITE_INTERVAL)
+
+def slider(command, deadline):
+    ''' Bursts of writes to the same handle, like dragging a slider '''
+    while time.time() < deadline:
+        burst = [threading.Thread(target=request,
+                                  args=('GATT', command, ADDRESS, ['0x31', '{:02x}'.format(i)]))
+                 for i in range(SLIDER_BURST)]
+        for t in burst:
+            t.start()
+        for t in burst:
+            t.join()
+        time.sleep(WRITE_INTERVAL)
+
+def run(name, write_command, read_command):
+    fake_gatttool.install({'*': {'latency': LATENCY}})
+    processes = [multiprocessing.Process(target=run_broker),
+                 multiprocessing.Process(target=run_daemon)]
+    for p in processes:
+        p.start()
+    time.sleep(1)
+
+    try:
+        request('GATT', 'connect', ADDRESS)
+
+        reads = []
+        latencies = []
+        deadline = time.time() + DURATION
+        threads = [threading.Thread(target=poller, args=(i, deadline, reads))
+                   for i in range(POLLERS)]
+        threads.append(threading.Thread(target=writer, args=(write_command, deadline, latencies)))
+        threads.append(threading.Thread(target=slider, args=(write_command, deadline)))
+        threads.append(threading.Thread(target=dashboard, args=(read_command, deadline)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats, = request('GATT', 'stats', ADDRESS)
+        stats = json.loads(stats)[ADDRESS]
+
+        latencies.sort()
+        print "{:>12} {:>10.1f} {:>10.1f} {:>10.0f} {:>10} {:>10}".format(
+            name, latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3,
+            len(reads) / float(DURATION), stats['coalesced'], stats['superseded'])
+    finally:
+        for p in processes:
+            p.terminate()
+        time.sleep(0.5)
+
+def main():
+    print "{:>12} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "queue", "write p50", "write p95", "reads/s", "coalesced", "superseded")
+    run("fifo", "write:poll", "read:poll")
+    run("priorities", "write", "read")
+
+if __name__ == "__main__": main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Benchmark: time from a reconnect to the first reading, GATT daemon
+
+Runs the broker and daemons/bt_gatt.py, with benchmarks/fake_gatttool.py
+as gatttool, and CYCLES times connects to a SensorTag, reads its
+temperature, and disconnects. Reports the time from the connect request
+to the reading.
+
+- handle: the reading by handle ('0x25'), nothing to discover
+- discover: by name ('temperature'), with a new firmware revision on every
+  connect, so that the characteristics are discovered every time (like the
+  node daemon does)
+- cached: by name, the handles come from the cache after the first connect
+
+The fake takes LATENCY seconds per round trip, and a round trip per
+characteristic to discover them (a SensorTag has 35).
+
+Needs the broker ports (9800-9803) to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import json
+import time
+import tempfile
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+import broker
+import bt_gatt
+import fake_gatttool
+from devices.client import request
+
+ADDRESS = 'BC:6A:29:AB:D3:7A'
+CYCLES = 10
+LATENCY = 0.03
+
+def run_broker():
+    sys.stdout = open(os.devnull, 'w')
+    broker.main([])
+
+def run_daemon(handle_cache):
+    sys.stdout = open(os.devnull, 'w')
+    bt_gatt.main(['--handle-cache', handle_cache])
+
+def configure(firmware):
+    ''' Have the fake SensorTags that start from now on run `firmware` '''
+    with open(os.environ['FAKE_GATTTOOL_CONFIG'], 'w') as f:
+        json.dump({'*': {'latency': LATENCY, 'firmware': firmware}}, f)
+
+def run(name, characteristic, new_firmware):
+    fake_gatttool.install({})
+    configure('1.4 (Mar 13 2013)')
+    handle_cache = os.path.join(tempfile.mkdtemp(prefix='gatt-handles-'), 'handles.json')
+    processes = [multiprocessing.Process(target=run_broker),
+                 multiprocessing.Process(target=run_daemon, args=(handle_cache,))]
+    for p in processes:
+        p.start()
+    time.sleep(1)
+
+    try:
+        times = []
+        for i in range(CYCLES):
+            if new_firmware:
+                configure('1.{}'.format(i))
+            start = time.time()
+            request('GATT', 'connect', ADDRESS)
+            request('GATT', 'read', ADDRESS, [characteristic])
+            times.append(time.time() - start)
+            request('GATT', 'disconnect', ADDRESS)
+
+        print "{:>10} {:>10.0f} {:>10.0f} {:>10.0f}".format(
+            name, times[0] * 1e3, sorted(times)[len(times) // 2] * 1e3, max(times[1:]) * 1e3)
+    finally:
+        for p in processes:
+            p.terminate()
+        time.sleep(0.5)
+
+def main():
+    print "{:>10} {:>10} {:>10} {:>10}".format("path", "first ms", "median ms", "max ms")
+    run("handle", '0x25', False)
+    run("discover", 'temperature', True)
+    run("cached", 'temperature', False)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Benchmark: latency of the sensor readings (read_value), GATT daemon
+
+Runs the broker and daemons/bt_gatt.py, with benchmarks/fake_gatttool.py
+as gatttool, connects a SensorTag, and reads its temperature with
+read_value READS times, every INTERVAL seconds. The sensor takes the
+default warm-up of 0.3 seconds.
+
+- per sample: the daemon switches the sensor off right after every
+  reading (--sensor-idle 0), so that every reading switches it on and
+  waits for the warm-up, as read_value did before the sensors stayed on
+- kept on: the sensor stays on between the readings
+
+Needs the broker ports (9800-9803) to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import time
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+import broker
+import bt_gatt
+import fake_gatttool
+from devices.client import request
+
+ADDRESS = 'BC:6A:29:AB:D3:7A'
+READS = 20
+INTERVAL = 0.1
+LATENCY = 0.0075
+
+def run_broker():
+    sys.stdout = open(os.devnull, 'w')
+    broker.main([])
+
+def run_daemon(sensor_idle):
+    sys.stdout = open(os.devnull, 'w')
+    bt_gatt.main(['--sensor-idle', str(sensor_idle)])
+
+def run(name, sensor_idle):
+    fake_gatttool.install({'*': {'latency': LATENCY}})
+    processes = [multiprocessing.Process(target=run_broker),
+                 multiprocessing.Process(target=run_daemon, args=(sensor_idle,))]
+    for p in processes:
+        p.start()
+    time.sleep(1)
+
+    try:
+        request('GATT', 'connect', ADDRESS)
+        times = []
+        for _ in range(READS):
+            start = time.time()
+            request('GATT', 'read_value', ADDRESS, ['0x29', '0x25', '01', '00'])
+            times.append(time.time() - start)
+            time.sleep(INTERVAL)
+
+        print "{:>12} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name, times[0] * 1e3, sorted(times)[len(times) // 2] * 1e3,
+            sum(times) / len(times) * 1e3)
+    finally:
+        for p in processes:
+            p.terminate()
+        time.sleep(0.5)
+
+def main():
+    print "{:>12} {:>10} {:>10} {:>10}".format("sensor", "first ms", "median ms", "mean ms")
+    run("per sample", 0)
+    run("kept on", bt_gatt.SENSOR_IDLE)
+
+if __name__ == "__main__": main()
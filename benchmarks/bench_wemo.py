@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+'''
+Benchmark: WeMo daemon responsiveness with a stuck switch
+
+Runs the broker and the request loop of daemons/wemo.py, with fake switches
+instead of a ouimeaux environment: 'Stuck' never answers, the others take
+20 ms per command like a switch on the LAN. One client turns 'Stuck' on,
+and then asks for the state of the other switches one after the other.
+
+- sequential: a pool of one greenlet, which is how the daemon used to
+  handle requests
+- pooled: the daemon's greenlet pool
+
+Reports the latency of the requests to the working switches, and how the
+request to the stuck switch ended. Exits with an error unless the pooled
+daemon answers all the requests to the working switches within MAX_LATENCY,
+and the stuck request with an error once the daemon gives up on it.
+
+Needs the broker ports (9800/9801) to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import time
+import multiprocessing
+
+import zmq
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+
+from devices import protocol
+import broker
+
+# (ouimeaux resets __main__.__file__, so only import it now)
+from ouimeaux.environment import UnknownDevice
+
+BROKER_URL = "tcp://localhost:9800"
+WORKER_URL = "tcp://localhost:9801"
+
+SWITCHES = ['Kitchen', 'Lamp', 'Fan', 'Heater']
+N_REQUESTS = 50
+# Time a working switch takes to answer
+DELAY = 0.02
+# Command timeout of the daemon
+TIMEOUT = 2
+# Latency that the requests to the working switches must stay under, with
+# the pool, far less than the timeout that the stuck switch runs into
+MAX_LATENCY = TIMEOUT / 4.
+
+class FakeSwitch(object):
+    ''' Switch that takes `delay` seconds to answer every command '''
+    def __init__(self, delay):
+        self.delay = delay
+        self.state = 0
+
+    def on(self):
+        time.sleep(self.delay)
+        self.state = 1
+
+    def off(self):
+        time.sleep(self.delay)
+        self.state = 0
+
+    def get_state(self, force_update=False):
+        time.sleep(self.delay)
+        return self.state
+
+class FakeEnvironment(object):
+    ''' The part of the ouimeaux Environment that the daemon uses '''
+    def __init__(self):
+        self.switches = dict((name, FakeSwitch(DELAY)) for name in SWITCHES)
+        self.switches['Stuck'] = FakeSwitch(3600)
+
+    def list_switches(self):
+        return self.switches.keys()
+
+    def get_switch(self, name):
+        try:
+            return self.switches[name]
+        except KeyError:
+            raise UnknownDevice(name)
+
+def run_broker():
+    sys.stdout = open(os.devnull, 'w')
+    broker.main([])
+
+def run_daemon(pool_size):
+    ''' The WeMo daemon request loop, with the fake environment '''
+    # Imported here, as the daemon patches the standard library for gevent
+    import wemo
+    sys.stdout = open(os.devnull, 'w')
+
+    socket = wemo.zmq.Context.instance().socket(wemo.zmq.DEALER)
+    socket.setsockopt(wemo.zmq.IDENTITY, b"WeMo-bench")
+    socket.connect(WORKER_URL)
+    send = wemo.locked_send(socket)
+    send(protocol.control(protocol.W_READY, wemo.SERVICE))
+    wemo.Heartbeat(send).start()
+
+    env = FakeEnvironment()
+    states = wemo.StateTable(lambda name, state: None)
+    wemo.serve(socket, send, lambda body: wemo.handle(env, states, body, TIMEOUT / 2.),
+               pool_size=pool_size, timeout=TIMEOUT)
+
+def request(socket, req_id, command, switch, *args):
+    socket.send_multipart([protocol.VERSION, req_id, b"WeMo", b'0',
+                           protocol.pack([command, switch] + list(args))])
+
+def drive():
+    '''
+    Turn the stuck switch on, then ask the others for their state
+    Returns the sorted latencies, and the time and status of the stuck request
+    '''
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.connect(BROKER_URL)
+
+    start = time.time()
+    request(socket, b'stuck', 'on', 'Stuck')
+
+    latencies = []
+    stuck = None
+    for i in range(N_REQUESTS):
+        sent = time.time()
+        request(socket, str(i), 'state', SWITCHES[i % len(SWITCHES)], 'fresh')
+        while True:
+            _, req_id, status, _ = socket.recv_multipart()
+            if req_id == b'stuck':
+                stuck = (time.time() - start, status)
+            else:
+                break
+        latencies.append(time.time() - sent)
+
+    if stuck is None:
+        _, _, status, _ = socket.recv_multipart()
+        stuck = (time.time() - start, status)
+
+    socket.close()
+    return sorted(latencies), stuck
+
+def run(name, pool_size):
+    processes = [multiprocessing.Process(target=run_broker),
+                 multiprocessing.Process(target=run_daemon, args=(pool_size,))]
+    for p in processes:
+        p.start()
+    time.sleep(1)
+
+    try:
+        latencies, (stuck_time, stuck_status) = drive()
+        print "{:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>8} {:>8.1f}".format(
+            name, latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3, latencies[-1] * 1e3,
+            stuck_status, stuck_time)
+        return latencies, stuck_status
+    finally:
+        for p in processes:
+            p.terminate()
+        time.sleep(0.5)
+
+def main():
+    print "{:>10} {:>10} {:>10} {:>10} {:>8} {:>8}".format(
+        "daemon", "p50 ms", "p95 ms", "max ms", "stuck", "after s")
+    run("sequential", 1)
+    latencies, stuck_status = run("pooled", 16)
+
+    if latencies[-1] > MAX_LATENCY:
+        sys.exit("FAIL: a working switch took {:.0f} ms to answer, the limit is {:.0f} ms".format(
+            latencies[-1] * 1e3, MAX_LATENCY * 1e3))
+    if stuck_status != protocol.ERROR:
+        sys.exit("FAIL: the stuck switch answered {} rather than timing out".format(stuck_status))
+    print "OK: the stuck switch held up no other request"
+
+if __name__ == "__main__": main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+'''
+Benchmark: the WeMo daemon with 10, 100 and 500 switches
+
+Starts benchmarks/fake_wemo.py with N switches that take LATENCY seconds
+per SOAP action, and runs the discovery and the request handling of
+daemons/wemo.py against them (without the broker, see bench_broker.py for
+that hop). Reports
+
+- discovery: seconds until all the switches are set up
+- on/off, state, state fresh: requests/sec through the daemon's greenlet
+  pool, one request per switch
+- set_many, state_all: seconds for a single request over all the switches
+
+Needs the ports of fake_wemo.py and 54321 to be free.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'daemons'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+# (Patches the standard library for gevent)
+import wemo
+import fake_wemo
+from devices import protocol
+
+import gevent
+from gevent.pool import Pool
+
+SIZES = [10, 100, 500]
+LATENCY = 0.02
+DISCOVERY_TIMEOUT = 120
+
+def discover(env, n_switches):
+    ''' Seconds until `n_switches` switches are set up in `env` '''
+    start = time.time()
+    while len(env.list_switches()) < n_switches:
+        if time.time() - start > DISCOVERY_TIMEOUT:
+            break
+        env.upnp.broadcast()
+        # Look again if some answers got lost
+        for _ in range(20):
+            gevent.sleep(0.1)
+            if len(env.list_switches()) >= n_switches:
+                break
+    return time.time() - start
+
+def throughput(handler, bodies):
+    ''' Requests/sec of `bodies` through a pool like the daemon's '''
+    pool = Pool(wemo.POOL_SIZE)
+    start = time.time()
+    for body in bodies:
+        pool.spawn(handler, body)
+    pool.join()
+    return len(bodies) / (time.time() - start)
+
+def timed(handler, body):
+    start = time.time()
+    status, _ = handler(body)
+    assert status == protocol.OK
+    return time.time() - start
+
+def run(n_switches):
+    fake = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_wemo.py'),
+                             '--switches', str(n_switches), '--latency', str(LATENCY)],
+                            stdout=open(os.devnull, 'w'))
+    env = None
+    try:
+        time.sleep(1 + n_switches / 200.)
+        env = wemo.make_environment(bind='127.0.0.1:54321')
+        fake_wemo.use_fake_switches(env)
+        env.start()
+
+        discovery = discover(env, n_switches)
+        names = env.list_switches()
+
+        states = wemo.StateTable(lambda name, state: None)
+        handler = lambda body: wemo.handle(env, states, body)
+        pack = lambda *fields: protocol.pack(list(fields))
+
+        on_off = throughput(handler, [pack('on' if i % 2 else 'off', name)
+                                      for i, name in enumerate(names)])
+        state = throughput(handler, [pack('state', name) for name in names])
+        fresh = throughput(handler, [pack('state', name, 'fresh') for name in names])
+
+        args = []
+        for name in names:
+            args.extend([name, 'off'])
+        set_many = timed(handler, pack('set_many', '', *args))
+        state_all = timed(handler, pack('state_all', '', 'fresh'))
+
+        print "{:>8} {:>5} {:>9.2f} {:>8.0f} {:>8.0f} {:>8.0f} {:>9.2f} {:>9.2f}".format(
+            n_switches, len(names), discovery, on_off, state, fresh, set_many, state_all)
+    finally:
+        if env is not None:
+            env.upnp.server.stop()
+            env.registry.server.stop()
+        fake.terminate()
+        fake.wait()
+
+def main():
+    print "{:>8} {:>5} {:>9} {:>8} {:>8} {:>8} {:>9} {:>9}".format(
+        "switches", "found", "discov s", "on/off/s", "state/s", "fresh/s",
+        "set_many s", "state_all s")
+    for n_switches in SIZES:
+        run(n_switches)
+
+if __name__ == "__main__": main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+'''
+Fake gatttool, for benchmarks and trying out the GATT daemon without a device
+
+Speaks the interactive mode of gatttool, as daemons/bt_gatt.py drives it:
+
+    fake_gatttool.py -b BC:6A:29:AB:D3:7A --interactive
+
+- connect, disconnect, exit, and a blank line to redraw the prompt
+- char-read-hnd: every handle reads as two bytes, the handle and a counter,
+  unless it has a value of its own
+- char-write-cmd, char-write-req: writing 0100 to the handle after a
+  value (its client configuration descriptor) makes the value send
+  notifications, 0000 stops them
+- characteristics: the characteristics of a SensorTag (CHARACTERISTICS),
+  and char-read-uuid for the values of the ones with a value of their own
+  (the firmware revision)
+
+How every device behaves is set by these settings:
+
+- latency: seconds that connecting, reading and acknowledged writes take,
+  like the round trip over the air (default: 0)
+- drop_rate: fraction of the commands before which the connection drops,
+  as if the device went out of range (default: 0)
+- connect_failures: number of connects that are refused before one goes
+  through (default: 0)
+- notify_interval: seconds between notifications (default: 0.1)
+- values: values of some handles, e.g. {"0x25": "11 22"}
+- firmware: the firmware revision (default: "1.4 (Mar 13 2013)")
+- discovery_latency: seconds that the discovery of every characteristic
+  takes, as each one costs a round trip (default: the latency)
+
+They come from the environment (FAKE_GATTTOOL_LATENCY, _DROP_RATE,
+_CONNECT_FAILURES, _NOTIFY_INTERVAL, _FIRMWARE, _DISCOVERY_LATENCY), and from the JSON file that
+FAKE_GATTTOOL_CONFIG points to, with the settings for all devices under
+"*" and those of a single device under its address:
+
+    {"*": {"latency": 0.0075},
+     "BC:6A:29:AB:D3:7A": {"drop_rate": 0.01, "values": {"0x25": "11 22"}}}
+
+SIGUSR1 drops the connection as well.
+
+`install` puts it on the PATH as `gatttool`, with the given settings.
+
+(c) 2014 Berk Birand
+'''
+import os
+import sys
+import json
+import time
+import random
+import signal
+import tempfile
+import threading
+
+DEFAULTS = {
+    'latency': 0.0,
+    'drop_rate': 0.0,
+    'connect_failures': 0,
+    'notify_interval': 0.1,
+    'values': {},
+    'firmware': '1.4 (Mar 13 2013)',
+    'discovery_latency': None,
+}
+
+# Characteristics of a SensorTag, as (value handle, UUID)
+TI_UUID = 'f000{:04x}-0451-4000-b000-000000000000'
+SIG_UUID = '0000{:04x}-0000-1000-8000-00805f9b34fb'
+CHARACTERISTICS = [
+    (0x03, SIG_UUID.format(0x2a00)), (0x05, SIG_UUID.format(0x2a01)),
+    (0x07, SIG_UUID.format(0x2a02)), (0x09, SIG_UUID.format(0x2a03)),
+    (0x0b, SIG_UUID.format(0x2a04)), (0x0e, SIG_UUID.format(0x2a05)),
+    (0x12, SIG_UUID.format(0x2a23)), (0x14, SIG_UUID.format(0x2a24)),
+    (0x16, SIG_UUID.format(0x2a25)), (0x18, SIG_UUID.format(0x2a26)),
+    (0x1a, SIG_UUID.format(0x2a27)), (0x1c, SIG_UUID.format(0x2a28)),
+    (0x1e, SIG_UUID.format(0x2a29)), (0x20, SIG_UUID.format(0x2a2a)),
+    (0x22, SIG_UUID.format(0x2a50)),
+    (0x25, TI_UUID.format(0xaa01)), (0x29, TI_UUID.format(0xaa02)),
+    (0x2d, TI_UUID.format(0xaa11)), (0x31, TI_UUID.format(0xaa12)),
+    (0x34, TI_UUID.format(0xaa13)),
+    (0x38, TI_UUID.format(0xaa21)), (0x3c, TI_UUID.format(0xaa22)),
+    (0x40, TI_UUID.format(0xaa31)), (0x44, TI_UUID.format(0xaa32)),
+    (0x47, TI_UUID.format(0xaa33)),
+    (0x4b, TI_UUID.format(0xaa41)), (0x4f, TI_UUID.format(0xaa42)),
+    (0x52, TI_UUID.format(0xaa43)),
+    (0x57, TI_UUID.format(0xaa51)), (0x5b, TI_UUID.format(0xaa52)),
+    (0x5f, SIG_UUID.format(0xffe1)),
+    (0x63, TI_UUID.format(0xaa61)), (0x66, TI_UUID.format(0xaa62)),
+    (0x6a, TI_UUID.format(0xffc1)), (0x6e, TI_UUID.format(0xffc2)),
+]
+FIRMWARE_HANDLE = 0x18
+
+def settings(address):
+    ''' The settings of the device at `address` '''
+    result = dict(DEFAULTS)
+    for name, default in DEFAULTS.items():
+        variable = 'FAKE_GATTTOOL_' + name.upper()
+        if variable in os.environ and name != 'values':
+            result[name] = (float if default is None else type(default))(os.environ[variable])
+
+    path = os.environ.get('FAKE_GATTTOOL_CONFIG')
+    if path:
+        with open(path) as f:
+            config = json.load(f)
+        result.update(config.get('*', {}))
+        result.update(config.get(address, {}))
+    return result
+
+class FakeGatttool(object):
+    ''' The state of the device and of the connection '''
+
+    def __init__(self, address, settings=DEFAULTS):
+        self.address = address
+        self.latency = settings['latency']
+        self.drop_rate = settings['drop_rate']
+        self.connect_failures = settings['connect_failures']
+        self.notify_interval = settings['notify_interval']
+        self.values = dict((int(handle, 16), value)
+                           for handle, value in settings['values'].items())
+        self.values.setdefault(FIRMWARE_HANDLE, ' '.join(
+            '{:02x}'.format(ord(c)) for c in settings['firmware'] + '\0'))
+        self.discovery_latency = settings['discovery_latency']
+        if self.discovery_latency is None:
+            self.discovery_latency = self.latency
+        self.connected = False
+        self.counter = 0
+        # Handles of the values that send notifications
+        self.notifying = set()
+        # (Reentrant, as the signal handler may run while the main thread prints)
+        self.lock = threading.RLock()
+
+    def out(self, text):
+        with self.lock:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def prompt(self):
+        self.out('[{}][{}][LE]> '.format('CON' if self.connected else '   ', self.address))
+
+    def drop(self, *args):
+        ''' Lose the connection, gatttool redraws its prompt '''
+        self.connected = False
+        self.notifying.clear()
+        self.out('\n')
+        self.prompt()
+
+    def value(self, handle):
+        if handle in self.values:
+            return self.values[handle]
+        self.counter = (self.counter + 1) % 256
+        return '{:02x} {:02x}'.format(handle % 256, self.counter)
+
+    def notify(self):
+        while True:
+            time.sleep(self.notify_interval)
+            for handle in sorted(self.notifying):
+                self.out('\rNotification handle = 0x{:04x} value: {} \n'.format(
+                    handle, self.value(handle)))
+                self.prompt()
+
+    def command(self, line):
+        cmd = line.split()
+        if not cmd:
+            return
+
+        if self.connected and cmd[0] != 'disconnect' and random.random() < self.drop_rate:
+            self.drop()
+
+        if cmd[0] == 'connect':
+            self.out('Attempting to connect to {}\n'.format(self.address))
+            time.sleep(self.latency)
+            if self.connect_failures > 0:
+                self.connect_failures -= 1
+                self.out('connect error: Connection refused (111)\n')
+                return
+            self.connected = True
+            self.out('Connection successful\n')
+
+        elif cmd[0] == 'disconnect':
+            self.connected = False
+            self.notifying.clear()
+
+        elif not self.connected:
+            self.out('Command Failed: Disconnected\n')
+
+        elif cmd[0] == 'char-read-hnd' and len(cmd) == 2:
+            time.sleep(self.latency)
+            self.out('Characteristic value/descriptor: {} \n'.format(self.value(int(cmd[1], 16))))
+
+        elif cmd[0] in ('char-write-cmd', 'char-write-req') and len(cmd) == 3:
+            handle = int(cmd[1], 16) - 1
+            if cmd[2] == '0100':
+                self.notifying.add(handle)
+            elif cmd[2] == '0000':
+                self.notifying.discard(handle)
+            if cmd[0] == 'char-write-req':
+                time.sleep(self.latency)
+                self.out('Characteristic value was written successfully\n')
+
+        elif cmd[0] == 'characteristics':
+            time.sleep(self.discovery_latency * len(CHARACTERISTICS))
+            for handle, uuid in CHARACTERISTICS:
+                self.out('handle: 0x{:04x}, char properties: 0x02, char value handle: '
+                         '0x{:04x}, uuid: {}\n'.format(handle - 1, handle, uuid))
+
+        elif cmd[0] == 'char-read-uuid' and len(cmd) == 2:
+            time.sleep(self.latency)
+            uuid = cmd[1].lower()
+            if len(uuid) == 4:
+                uuid = SIG_UUID.format(int(uuid, 16))
+            handles = [handle for handle, u in CHARACTERISTICS
+                       if u == uuid and handle in self.values]
+            if not handles:
+                self.out('Read characteristics by UUID failed: '
+                         'No attribute found within the given range\n')
+            for handle in handles:
+                self.out('handle: 0x{:04x} \t value: {} \n'.format(handle, self.values[handle]))
+
+        else:
+            self.out('{}: command not found\n'.format(cmd[0]))
+
+    def run(self):
+        signal.signal(signal.SIGUSR1, self.drop)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        notifier = threading.Thread(target=self.notify)
+        notifier.daemon = True
+        notifier.start()
+
+        self.prompt()
+        while True:
+            line = sys.stdin.readline()
+            if not line or line.split()[:1] in (['exit'], ['quit']):
+                break
+            self.command(line)
+            self.prompt()
+
+def install(config=None):
+    '''
+    Put the fake on the PATH as `gatttool`, return the directory it is in
+
+    `config` holds the settings, as in the FAKE_GATTTOOL_CONFIG file.
+    '''
+    directory = tempfile.mkdtemp(prefix='fake-gatttool-')
+    if config is not None:
+        path = os.path.join(directory, 'config.json')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        os.environ['FAKE_GATTTOOL_CONFIG'] = path
+
+    path = os.path.join(directory, 'gatttool')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(
+            sys.executable, os.path.realpath(__file__).replace('.pyc', '.py')))
+    os.chmod(path, 0755)
+    os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+    return directory
+
+def main():
+    address = sys.argv[sys.argv.index('-b') + 1] if '-b' in sys.argv else ''
+    FakeGatttool(address, settings(address)).run()
+
+if __name__ == "__main__": main()
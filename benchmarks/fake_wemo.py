@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+'''
+Fake WeMo switches, for benchmarks and trying out the WeMo daemon
+
+Emulates N switches on loopback, each on an address of its own
+(127.1.x.y, as ouimeaux tells the switches apart by their address):
+
+- SSDP: answers M-SEARCH requests sent to 127.0.0.1:SSDP_PORT for all the
+  switches, within the MX seconds of the request (point ouimeaux there
+  with `use_fake_switches`, or the WeMo daemon with --ssdp)
+- setup.xml and the basicevent service description
+- the GetBinaryState and SetBinaryState SOAP actions
+- SUBSCRIBE to the basic events, with a NOTIFY of the state to the
+  subscribers when it changes
+
+Every SOAP action takes `latency` seconds, and fails with a 500 error with
+probability `failure_rate`.
+
+    python benchmarks/fake_wemo.py --switches 100 --latency 0.02
+
+(c) 2014 Berk Birand
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import re
+import uuid
+import random
+import argparse
+
+import gevent
+from gevent import socket
+from gevent.pywsgi import WSGIServer
+from gevent.server import DatagramServer
+
+SSDP_PORT = 19000
+SWITCH_PORT = 49153
+
+SETUP_XML = '''<?xml version="1.0"?>
+<root xmlns="urn:Belkin:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:Belkin:device:controllee:1</deviceType>
+    <friendlyName>{name}</friendlyName>
+    <manufacturer>Belkin International Inc.</manufacturer>
+    <modelDescription>Belkin Plugin Socket 1.0</modelDescription>
+    <modelName>Socket</modelName>
+    <modelNumber>1.0</modelNumber>
+    <serialNumber>{serial}</serialNumber>
+    <UDN>{udn}</UDN>
+    <serviceList>
+      <service>
+        <serviceType>urn:Belkin:service:basicevent:1</serviceType>
+        <serviceId>urn:Belkin:serviceId:basicevent1</serviceId>
+        <controlURL>/upnp/control/basicevent1</controlURL>
+        <eventSubURL>/upnp/event/basicevent1</eventSubURL>
+        <SCPDURL>/eventservice.xml</SCPDURL>
+      </service>
+    </serviceList>
+  </device>
+</root>
+'''
+
+EVENTSERVICE_XML = '''<?xml version="1.0"?>
+<scpd xmlns="urn:Belkin:service-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <actionList>
+    <action>
+      <name>SetBinaryState</name>
+      <argumentList>
+        <argument>
+          <retval/>
+          <name>BinaryState</name>
+          <relatedStateVariable>BinaryState</relatedStateVariable>
+          <direction>in</direction>
+        </argument>
+      </argumentList>
+    </action>
+    <action>
+      <name>GetBinaryState</name>
+      <argumentList>
+        <argument>
+          <retval/>
+          <name>BinaryState</name>
+          <relatedStateVariable>BinaryState</relatedStateVariable>
+          <direction>out</direction>
+        </argument>
+      </argumentList>
+    </action>
+  </actionList>
+</scpd>
+'''
+
+SOAP_RESPONSE = '''<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body>
+<u:{action}Response xmlns:u="urn:Belkin:service:basicevent:1">
+<BinaryState>{state}</BinaryState>
+</u:{action}Response>
+</s:Body>
+</s:Envelope>'''
+
+PROPERTYSET = '''<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">
+<e:property>
+<BinaryState>{state}</BinaryState>
+</e:property>
+</e:propertyset>'''
+
+SSDP_RESPONSE = '\r\n'.join([
+    'HTTP/1.1 200 OK',
+    'CACHE-CONTROL: max-age=86400',
+    'EXT:',
+    'LOCATION: {location}',
+    'SERVER: Unspecified, UPnP/1.0, Unspecified',
+    'ST: upnp:rootdevice',
+    'USN: {udn}::upnp:rootdevice',
+    'X-User-Agent: redsonic',
+    '', ''])
+
+class FakeSwitch(object):
+    ''' A switch that serves its setup and basic events on `host` '''
+
+    def __init__(self, index, host, latency=0, failure_rate=0):
+        self.host = host
+        self.name = "Fake Switch {}".format(index)
+        self.udn = "uuid:Socket-1_0-FAKE{:06d}".format(index)
+        self.location = "http://{}:{}/setup.xml".format(host, SWITCH_PORT)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.state = 0
+        # Callback URLs of the subscribers, by SID
+        self.subscribers = {}
+
+    def start(self):
+        # (Naming the server saves a reverse DNS lookup of every address)
+        self.server = WSGIServer((self.host, SWITCH_PORT), self.handle, log=None,
+                                 environ={'SERVER_NAME': self.host})
+        self.server.start()
+
+    def handle(self, environ, start_response):
+        method, path = environ['REQUEST_METHOD'], environ['PATH_INFO']
+        headers = [('Content-Type', 'text/xml')]
+
+        if method == 'GET' and path == '/setup.xml':
+            body = SETUP_XML.format(name=self.name, serial=self.udn[-10:], udn=self.udn)
+        elif method == 'GET' and path == '/eventservice.xml':
+            body = EVENTSERVICE_XML
+        elif method == 'POST' and path == '/upnp/control/basicevent1':
+            gevent.sleep(self.latency)
+            if random.random() < self.failure_rate:
+                start_response('500 Internal Server Error', headers)
+                return ['']
+            body = self.soap(environ)
+        elif method == 'SUBSCRIBE':
+            sid = environ.get('HTTP_SID') or 'uuid:{}'.format(uuid.uuid4())
+            callback = environ.get('HTTP_CALLBACK', '').strip('<>')
+            if callback:
+                self.subscribers[sid] = callback
+            # The state is sent to new subscribers
+            gevent.spawn(self.notify, sid, callback)
+            headers = [('SID', sid), ('TIMEOUT', 'Second-1800')]
+            body = ''
+        elif method == 'UNSUBSCRIBE':
+            self.subscribers.pop(environ.get('HTTP_SID'), None)
+            body = ''
+        else:
+            start_response('404 Not Found', headers)
+            return ['']
+
+        start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+    def soap(self, environ):
+        action = environ.get('HTTP_SOAPACTION', '').strip('"').split('#')[-1]
+        if action == 'SetBinaryState':
+            request = environ['wsgi.input'].read()
+            state = int(re.search(r'<BinaryState>(\d+)</BinaryState>', request).group(1))
+            if state != self.state:
+                self.state = state
+                for sid, callback in self.subscribers.items():
+                    gevent.spawn(self.notify, sid, callback)
+        return SOAP_RESPONSE.format(action=action, state=self.state)
+
+    def notify(self, sid, callback):
+        ''' Send the state to a subscriber, from the address of the switch '''
+        match = re.match(r'http://([^:/]+):(\d+)', callback)
+        if not match:
+            return
+        body = PROPERTYSET.format(state=self.state)
+        request = '\r\n'.join(['NOTIFY / HTTP/1.1',
+                               'HOST: {}:{}'.format(*match.groups()),
+                               'CONTENT-TYPE: text/xml; charset="utf-8"',
+                               'NT: upnp:event',
+                               'NTS: upnp:propchange',
+                               'SID: {}'.format(sid),
+                               'CONTENT-LENGTH: {}'.format(len(body)),
+                               '', body])
+        try:
+            sock = socket.create_connection((match.group(1), int(match.group(2))),
+                                            timeout=5, source_address=(self.host, 0))
+            sock.sendall(request)
+            sock.recv(1024)
+            sock.close()
+        except socket.error:
+            pass
+
+class FakeSSDP(DatagramServer):
+    ''' Answers the M-SEARCH requests for all the `switches` '''
+
+    def __init__(self, switches, port=SSDP_PORT):
+        DatagramServer.__init__(self, ('127.0.0.1', port))
+        self.switches = switches
+
+    def handle(self, data, address):
+        if not data.startswith('M-SEARCH'):
+            return
+        # Like real devices, answer at a random time within the MX seconds
+        # that the request allows, rather than all at once
+        match = re.search(r'MX: *(\d+)', data, re.IGNORECASE)
+        mx = int(match.group(1)) if match else 1
+        for switch in self.switches:
+            answer = SSDP_RESPONSE.format(location=switch.location, udn=switch.udn)
+            gevent.spawn_later(random.uniform(0, mx), self.socket.sendto, answer, address)
+
+def switch_host(index):
+    ''' Loopback address of switch number `index` '''
+    return "127.1.{}.{}".format(index // 250, index % 250 + 1)
+
+def start(n_switches, latency=0, failure_rate=0, port=SSDP_PORT):
+    ''' Start `n_switches` switches and their SSDP responder, return the switches '''
+    switches = [FakeSwitch(i, switch_host(i), latency, failure_rate)
+                for i in range(n_switches)]
+    for switch in switches:
+        switch.start()
+    FakeSSDP(switches, port).start()
+    return switches
+
+def use_fake_switches(env, port=SSDP_PORT):
+    ''' Make the ouimeaux Environment `env` discover the fake switches '''
+    env.upnp.mcast_ip = '127.0.0.1'
+    env.upnp.mcast_port = port
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake WeMo switches on loopback")
+    parser.add_argument('--switches', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds each SOAP action takes (default: 0)")
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help="fraction of the SOAP actions that fail (default: 0)")
+    parser.add_argument('--port', type=int, default=SSDP_PORT,
+                        help="SSDP port (default: {})".format(SSDP_PORT))
+    args = parser.parse_args()
+
+    start(args.switches, args.latency, args.failure_rate, args.port)
+    print "{} switches on 127.1.x.y:{}, SSDP on 127.0.0.1:{}".format(
+        args.switches, SWITCH_PORT, args.port)
+    gevent.wait()
+
+if __name__ == "__main__": main()
@@ -1,15 +1,370 @@
 import zmq
-# 
+import os
+import sys
+import json
+import time
+import bisect
+import argparse
+import threading
+import itertools
+import collections
+#
 # Kasa Broker
 #
 #
 # (c) 2014 Berk Birand
 
-def main():
+# Make the shared kasa modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from devices import protocol
+from devices.jsonfile import save_json
+
+# Messages taken from a socket in one go by the --fast relay
+FAST_DRAIN = 100
+
+class Worker(object):
+    ''' A worker that registered with the broker, for the target `service` '''
+
+    def __init__(self, identity, service, now):
+        self.identity = identity
+        self.service = service
+        # Number of requests sent to the worker and not answered yet
+        self.in_flight = 0
+        # Requests waiting for the worker to have a free slot, oldest first
+        self.queue = collections.deque()
+        self.touch(now)
+
+    def touch(self, now):
+        ''' We heard from the worker, so it is alive for a while longer '''
+        self.expiry = now + protocol.HEARTBEAT_INTERVAL * protocol.HEARTBEAT_LIVENESS
+
+    def load(self):
+        return self.in_flight + len(self.queue)
+
+    def as_dict(self):
+        return {'service': self.service,
+                'in_flight': self.in_flight,
+                'queued': len(self.queue)}
+
+class Service(object):
+    '''
+    The workers that serve one target
+
+    Requests go to the least loaded worker, except that a device sticks to
+    the worker that got its first request: that worker may be connected to
+    the device, or hold state about it.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.workers = []
+        # Worker of each device that was addressed so far
+        self.pins = {}
+
+    def add(self, worker):
+        self.workers.append(worker)
+
+    def remove(self, worker):
+        ''' Remove `worker`, its devices go to the other workers from now on '''
+        self.workers.remove(worker)
+        for device, w in self.pins.items():
+            if w is worker:
+                del self.pins[device]
+
+    def select(self, device):
+        ''' Worker for a request to `device` (empty if the request has none) '''
+        worker = self.pins.get(device)
+        if worker is None:
+            worker = min(self.workers, key=Worker.load)
+            if device:
+                self.pins[device] = worker
+        return worker
+
+class Histogram(object):
+    '''
+    Latency histogram with fixed buckets, cheap enough to update for every
+    message. Percentiles are reported as the upper bound of their bucket
+    '''
+
+    # Upper bounds of the buckets in seconds, 25% apart from 0.1ms to ~1min
+    BOUNDS = [1e-4 * 1.25 ** i for i in range(60)]
+
+    def __init__(self):
+        # The last bucket holds everything above the largest bound
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+
+    def percentile(self, p):
+        ''' Upper bound of the bucket with the `p`th percentile, None if empty '''
+        total = sum(self.counts)
+        if total == 0:
+            return None
+
+        rank = total * p / 100.
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
+
+    def as_dict(self):
+        ''' Percentiles and the non-empty buckets as [upper bound, count], in ms '''
+        ms = lambda seconds: None if seconds is None else round(seconds * 1e3, 3)
+        summary = dict(("p{}".format(p), ms(self.percentile(p))) for p in (50, 95, 99))
+        bounds = self.BOUNDS + [None]
+        summary['buckets'] = [[ms(bounds[i]), count]
+                              for i, count in enumerate(self.counts) if count]
+        return summary
+
+class TargetStats(object):
+    ''' Counters for the requests to one target '''
+
+    def __init__(self):
+        self.requests = 0
+        self.replies = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.queued = 0
+        # Requests answered with the reply to an identical request
+        self.coalesced = 0
+        # Requests turned away because the queue was full, requests
+        # dropped from the queue because their deadline passed, and requests
+        # given up on because the worker didn't answer them by their deadline
+        self.busy = 0
+        self.expired = 0
+        self.timed_out = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {'requests': self.requests,
+                'replies': self.replies,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'busy': self.busy,
+                'expired': self.expired,
+                'timed_out': self.timed_out,
+                'coalesced': self.coalesced,
+                'latency_ms': self.latency.as_dict()}
+
+class Metrics(object):
+    ''' What the broker knows about the traffic going through it '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.targets = {}
+        # Requests to targets that aren't registered
+        self.unknown_target = 0
+        # Messages relayed on the telemetry bus
+        self.published = 0
+        # Batch requests
+        self.batches = 0
+        # Replies that came after the request was answered or failed
+        self.late_replies = 0
+
+    def target(self, name):
+        stats = self.targets.get(name)
+        if stats is None:
+            stats = self.targets[name] = TargetStats()
+        return stats
+
+    def snapshot(self, workers):
+        return {'time': time.time(),
+                'uptime': time.time() - self.started,
+                'workers': dict((identity, worker.as_dict())
+                                for identity, worker in workers.items()),
+                'unknown_target': self.unknown_target,
+                'late_replies': self.late_replies,
+                'published': self.published,
+                'batches': self.batches,
+                'targets': dict((name, stats.as_dict())
+                                for name, stats in self.targets.items())}
+
+# A client request on its way to a worker. `received` is the time the broker
+# got it, and `deadline` the time after which the client doesn't want it
+# anymore. Reads that can share their reply with identical requests have a
+# `key`, which is None for the other requests
+Request = collections.namedtuple('Request',
+                                 'client_addr req_id body stats received deadline key')
+
+class Batch(object):
+    '''
+    A batch request of a client, answered once all of its items are
+
+    Its items are routed like requests of their own, with the batch in place
+    of the client address and their index in place of the request id.
+    '''
+
+    def __init__(self, client_addr, req_id, n_items, deadline):
+        self.client_addr = client_addr
+        self.req_id = req_id
+        self.deadline = deadline
+        # Status and payload frames of the reply to each item
+        self.results = [None] * n_items
+        self.missing = n_items
+        self.answered = False
+
+    def set(self, index, reply):
+        ''' Record the reply to an item, return True if the batch is complete now '''
+        if self.answered or self.results[index] is not None:
+            return False
+        self.results[index] = reply
+        self.missing -= 1
+        return self.missing == 0
+
+    def reply(self):
+        ''' Status and payload of the reply, with a packed [status, value...] per item '''
+        self.answered = True
+        items = []
+        for result in self.results:
+            if result is None:
+                result = protocol.error_reply("Deadline passed")
+            status, payload = result
+            items.append(protocol.pack([status] + protocol.unpack(payload)))
+        return protocol.ok_reply(*items)
+
+def reply_to_client(clients, client_addr, req_id, reply):
+    ''' Send the status and payload frames in `reply` back to a client '''
+    clients.send_multipart([client_addr, protocol.VERSION, req_id] + reply)
+
+def fast_token(client_addr, req_id):
+    ''' Token that carries the return address of a request, see `relay` '''
+    return chr(len(client_addr)) + client_addr + req_id
+
+def relay(clients, workers):
+    '''
+    Broker loop of --fast mode: a plain relay between clients and workers
+
+    The return address of a request travels in the token handed to the
+    worker, so the relay keeps no state per request, and only looks at the
+    routing frames: bodies and payloads are passed on without being decoded.
+    (They are a few dozen bytes, which zmq copies faster than it can track
+    zero-copy frames.)
+
+    Every target is served by its oldest live worker, the other workers of
+    the target stand by until it expires. There are no metrics, queues,
+    deadlines, coalescing or batches, and requests sent to a worker that
+    dies are not answered: the client times out.
+    '''
+    # Identity of the workers of each target, oldest first, and the time
+    # until which each worker is considered alive
+    services = {}
+    expiry = {}
+    liveness = protocol.HEARTBEAT_INTERVAL * protocol.HEARTBEAT_LIVENESS
+
+    # Messages relayed so far, reported by the stats command
+    relayed = [0, 0]
+
+    poller = zmq.Poller()
+    poller.register(clients, zmq.POLLIN)
+    poller.register(workers, zmq.POLLIN)
+
+    next_purge = time.time() + protocol.HEARTBEAT_INTERVAL
+
+    print "Ready to relay"
+    while True:
+        socks = dict(poller.poll(protocol.HEARTBEAT_INTERVAL * 1e3))
+        now = time.time()
+
+        if now >= next_purge:
+            next_purge = now + protocol.HEARTBEAT_INTERVAL
+            for identity, (service_name, until) in expiry.items():
+                if until < now:
+                    print "Worker '{}' expired".format(identity)
+                    del expiry[identity]
+                    services[service_name].remove(identity)
+                    if not services[service_name]:
+                        del services[service_name]
+
+        # Take all the messages that are waiting, rather than polling again
+        # for each of them
+        for _ in range(FAST_DRAIN if clients in socks else 0):
+            try:
+                frames = clients.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if len(frames) != 6 or frames[1] != protocol.VERSION:
+                reply_to_client(clients, frames[0], b'',
+                                protocol.error_reply("Unsupported protocol version"))
+                continue
+            client_addr, _, req_id, target, _, body = frames
+
+            if target == protocol.BROKER:
+                command = protocol.peek(body)[0]
+                if command == protocol.B_STATS:
+                    stats = {'mode': 'fast',
+                             'requests': relayed[0],
+                             'replies': relayed[1],
+                             'services': services}
+                    reply = protocol.ok_reply(json.dumps(stats))
+                else:
+                    reply = protocol.error_reply(
+                        "Broker command '{}' is not available in --fast mode".format(command))
+                reply_to_client(clients, client_addr, req_id, reply)
+                continue
+
+            identities = services.get(target)
+            if not identities:
+                reply_to_client(clients, client_addr, req_id,
+                                protocol.error_reply("Unknown target '{}'".format(target)))
+                continue
+
+            workers.send_multipart([identities[0], fast_token(client_addr, req_id), body])
+            relayed[0] += 1
+
+        for _ in range(FAST_DRAIN if workers in socks else 0):
+            try:
+                frames = workers.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            identity, token = frames[:2]
+
+            if token == b'':
+                version, command, service_name = frames[2:5]
+                if version != protocol.VERSION:
+                    print "Ignoring worker '{}' with protocol {}".format(identity, version)
+                    continue
+                if identity not in expiry:
+                    print "Registered worker '{}' for '{}'".format(identity, service_name)
+                    services.setdefault(service_name, []).append(identity)
+                expiry[identity] = (service_name, now + liveness)
+                continue
+
+            if identity in expiry:
+                expiry[identity] = (expiry[identity][0], now + liveness)
+
+            # Unpack the return address from the token
+            n = ord(token[0])
+            clients.send_multipart([token[1:1 + n], protocol.VERSION, token[1 + n:],
+                                    frames[2], frames[3]])
+            relayed[1] += 1
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Kasa broker")
+    parser.add_argument('--max-in-flight', type=int, default=8,
+                        help="requests a worker is sent before it answers some (default: 8)")
+    parser.add_argument('--max-queue', type=int, default=100,
+                        help="requests queued per worker before new ones are "
+                             "answered with BUSY (default: 100)")
+    parser.add_argument('--stats-file',
+                        help="periodically write the broker stats to this file, as JSON")
+    parser.add_argument('--stats-interval', type=float, default=10,
+                        help="seconds between two writes of the stats file (default: 10)")
+    parser.add_argument('--fast', action='store_true',
+                        help="only relay messages between clients and workers, "
+                             "without metrics, queues, coalescing or batches")
+    return parser.parse_args(argv)
+
+def main(argv=None):
     """ main method """
+    args = parse_args(argv)
 
     url_clients = "tcp://*:9800"
     url_workers = "tcp://*:9801"
+    url_publishers = "tcp://*:{}".format(protocol.TELEMETRY_PUBLISH_PORT)
+    url_subscribers = "tcp://*:{}".format(protocol.TELEMETRY_SUBSCRIBE_PORT)
 
     # Prepare our context and sockets
     context = zmq.Context()
@@ -18,46 +373,404 @@ def main():
 
     workers = context.socket(zmq.ROUTER)
     workers.bind(url_workers)
-    
+
+    # Telemetry bus: the daemons publish to the XSUB socket, and the
+    # clients subscribe on the XPUB socket
+    publishers = context.socket(zmq.XSUB)
+    publishers.bind(url_publishers)
+    subscribers = context.socket(zmq.XPUB)
+    subscribers.bind(url_subscribers)
+
+    if args.fast:
+        # Nothing to count on the bus either, so a native zmq proxy can
+        # take it over, in a thread of its own
+        telemetry = threading.Thread(target=zmq.proxy, args=(publishers, subscribers),
+                                     name="Telemetry")
+        telemetry.daemon = True
+        telemetry.start()
+        relay(clients, workers)
+        return
+
     poller = zmq.Poller()
     poller.register(clients, zmq.POLLIN)
     poller.register(workers, zmq.POLLIN)
+    poller.register(publishers, zmq.POLLIN)
+    poller.register(subscribers, zmq.POLLIN)
+
+    # Workers that are currently alive, keyed by their identity, and the
+    # services with at least one of them, keyed by the target name
+    registered_workers = {}
+    services = {}
+
+    # Requests waiting for a worker reply. The worker is handed a token
+    # instead of the client address, and the token maps back to the client
+    # address, its request id, the worker, the stats of the target, the
+    # time the request was received, its deadline, and for reads that can be
+    # shared, their key and the identical reads waiting for the same reply
+    # (else None)
+    pending = {}
+    tokens = itertools.count()
+
+    # Reads in flight that identical reads can still join, by their key. The
+    # values are the lists of (client_addr, req_id, received, deadline) of
+    # the reads that joined, shared with `pending`
+    coalesced = {}
+
+    metrics = Metrics()
+
+    # Batches that still wait for some of their items
+    open_batches = set()
+
+    def respond(client_addr, req_id, reply):
+        ''' Send `reply` to a client, or record it if it is for an item of a batch '''
+        if not isinstance(client_addr, Batch):
+            reply_to_client(clients, client_addr, req_id, reply)
+            return
+
+        batch = client_addr
+        if batch.set(req_id, reply):
+            open_batches.discard(batch)
+            reply_to_client(clients, batch.client_addr, batch.req_id, batch.reply())
+
+    def forward(worker, request):
+        ''' Send a Request to `worker` '''
+        request.stats.in_flight += 1
+
+        # The same read is already on its way, wait for its reply instead
+        followers = coalesced.get(request.key)
+        if followers is not None:
+            request.stats.coalesced += 1
+            followers.append((request.client_addr, request.req_id, request.received,
+                              request.deadline))
+            return
+
+        if request.key is not None:
+            followers = coalesced[request.key] = []
+        else:
+            # The reads sent so far may not see the effect of this request,
+            # so later reads of the target must not join them
+            target = worker.service
+            for key in [key for key in coalesced if key[0] == target]:
+                del coalesced[key]
+
+        token = str(next(tokens))
+        pending[token] = (request.client_addr, request.req_id, worker, request.stats,
+                          request.received, request.deadline, request.key, followers)
+        worker.in_flight += 1
+
+        # Send the token for the reply along with the body
+        workers.send_multipart([worker.identity, token, request.body])
+
+    def answer(client_addr, req_id, stats, received, reply, now):
+        ''' Pass on the reply of a worker, `reply` being the status and payload '''
+        stats.in_flight -= 1
+        stats.replies += 1
+        stats.latency.add(now - received)
+        if reply[0] != protocol.OK:
+            stats.errors += 1
+        respond(client_addr, req_id, reply)
+
+    def expired(request, now):
+        ''' Answer a Request whose deadline passed while queued, if it did '''
+        if request.deadline is None or request.deadline >= now:
+            return False
+        request.stats.expired += 1
+        respond(request.client_addr, request.req_id,
+              protocol.error_reply("Deadline passed while queued"))
+        return True
+
+    def dispatch(worker, now):
+        ''' Forward queued requests to `worker` while it has free slots '''
+        while worker.queue and worker.in_flight < args.max_in_flight:
+            request = worker.queue.popleft()
+            request.stats.queued -= 1
+            if not expired(request, now):
+                forward(worker, request)
+
+    def expire_queued(worker, now):
+        ''' Drop the queued requests of `worker` whose deadline passed '''
+        live = collections.deque()
+        for request in worker.queue:
+            if expired(request, now):
+                request.stats.queued -= 1
+            else:
+                live.append(request)
+        worker.queue = live
+
+    def fail_pending(worker, reason):
+        ''' Answer every request in flight at `worker` with an error '''
+        # Workers rarely fail, so rather than keeping track of the requests of
+        # every worker, look them up when it happens
+        for token, (client_addr, req_id, w, stats, _, _, _, followers) in pending.items():
+            if w is worker:
+                del pending[token]
+                waiting = [(client_addr, req_id)]
+                waiting.extend((c, r) for c, r, _, _ in followers or [])
+                for client_addr, req_id in waiting:
+                    stats.in_flight -= 1
+                    stats.errors += 1
+                    respond(client_addr, req_id, protocol.error_reply(reason))
+        worker.in_flight = 0
+
+        # Nothing that the worker had can be joined anymore
+        for key in [key for key in coalesced if key[0] == worker.service]:
+            del coalesced[key]
+
+    def expire_in_flight(now):
+        '''
+        Give up on the requests in flight that their worker didn't answer by
+        their deadline (the latest one of the reads that share the reply), so
+        that a live worker that never answers some requests doesn't hold on
+        to their slots for good. The reply, if it comes, is dropped as late.
+        '''
+        for token, (client_addr, req_id, worker, stats, _, deadline,
+                    key, followers) in pending.items():
+            deadlines = [deadline] + [d for _, _, _, d in followers or []]
+            if None in deadlines or max(deadlines) >= now:
+                continue
+            del pending[token]
+            worker.in_flight -= 1
+            if followers is not None and coalesced.get(key) is followers:
+                del coalesced[key]
+
+            waiting = [(client_addr, req_id)]
+            waiting.extend((c, r) for c, r, _, _ in followers or [])
+            for client_addr, req_id in waiting:
+                stats.in_flight -= 1
+                stats.errors += 1
+                stats.timed_out += 1
+                respond(client_addr, req_id, protocol.error_reply(
+                    "Deadline passed without a reply from '{}'".format(worker.service)))
+            dispatch(worker, now)
 
-    # Set of worker IDs that are currently available
-    registered_workers = set([])
+    def fail_queued(worker, reason):
+        ''' Answer every request queued for `worker` with an error '''
+        while worker.queue:
+            request = worker.queue.popleft()
+            request.stats.queued -= 1
+            request.stats.errors += 1
+            respond(request.client_addr, request.req_id, protocol.error_reply(reason))
+
+    def submit(client_addr, req_id, target, body, deadline, now):
+        ''' Send a request on to a worker of `target`, or queue it '''
+        # Fail right away instead of letting the client hang
+        service = services.get(target)
+        if service is None:
+            metrics.unknown_target += 1
+            respond(client_addr, req_id, protocol.error_reply("Unknown target '{}'".format(target)))
+            return
+        worker = service.select(protocol.peek(body)[1])
+
+        stats = metrics.target(target)
+        stats.requests += 1
+
+        # Reads without side effects can share the reply of an identical
+        # read, writes (on, off, enable...) never do. The key starts with
+        # the target, so that a write can stop the reads of its target
+        # from being joined
+        key = (target, body) if protocol.is_idempotent(body) else None
+
+        request = Request(client_addr, req_id, body, stats, now, deadline, key)
+
+        # (Reads that would join a read in flight only skip the queue when
+        # there are no writes queued before them)
+        if (worker.in_flight < args.max_in_flight or
+                (key in coalesced and not worker.queue)):
+            forward(worker, request)
+        elif len(worker.queue) < args.max_queue:
+            worker.queue.append(request)
+            stats.queued += 1
+        else:
+            # Tell the client to back off, rather than letting the
+            # latency of everyone grow
+            stats.busy += 1
+            respond(client_addr, req_id, protocol.busy_reply("Target '{}' is busy".format(target)))
+
+    def broker_command(client_addr, req_id, body, deadline, now):
+        ''' Answer a request addressed to the broker itself '''
+        try:
+            fields = protocol.unpack(body)
+            command = fields[0]
+        except (ValueError, IndexError, AttributeError):
+            respond(client_addr, req_id, protocol.error_reply("Malformed request"))
+            return
+
+        if command == protocol.B_STATS:
+            respond(client_addr, req_id,
+                  protocol.ok_reply(json.dumps(metrics.snapshot(registered_workers))))
+
+        elif command == protocol.B_BATCH:
+            # Every item is sent on as a request of its own, and the batch
+            # collects their replies
+            items = fields[2:]
+            metrics.batches += 1
+            batch = Batch(client_addr, req_id, len(items), deadline)
+            if deadline is not None:
+                open_batches.add(batch)
+            for index, item in enumerate(items):
+                try:
+                    item = protocol.unpack(item)
+                except (ValueError, AttributeError):
+                    item = []
+                if len(item) < 2:
+                    respond(batch, index, protocol.error_reply("Malformed batch item"))
+                    continue
+                submit(batch, index, item[0], protocol.pack(item[1:]), deadline, now)
+
+            # Nothing to wait for
+            if not items:
+                reply_to_client(clients, client_addr, req_id, batch.reply())
+
+        else:
+            respond(client_addr, req_id,
+                  protocol.error_reply("Unknown broker command '{}'".format(command)))
+
+    # Time of the next check for expired workers, and of the next stats snapshot
+    next_purge = time.time() + protocol.HEARTBEAT_INTERVAL
+    next_snapshot = time.time() + args.stats_interval
 
     print "Ready to broker"
     while True:
-        socks = dict(poller.poll())
+        # Wake up in time for the deadline of the batches
+        timeout = protocol.HEARTBEAT_INTERVAL
+        if open_batches:
+            first = min(batch.deadline for batch in open_batches)
+            timeout = min(max(first - time.time(), 0), timeout)
+
+        socks = dict(poller.poll(timeout * 1e3))
+        now = time.time()
+
+        # Answer the batches that ran out of time with what they have
+        for batch in [batch for batch in open_batches if batch.deadline <= now]:
+            open_batches.discard(batch)
+            reply_to_client(clients, batch.client_addr, batch.req_id, batch.reply())
+
+        # Purge workers that stopped sending heartbeats
+        if now >= next_purge:
+            next_purge = now + protocol.HEARTBEAT_INTERVAL
+            for identity, worker in registered_workers.items():
+                if worker.expiry < now:
+                    print "Worker '{}' expired".format(identity)
+                    del registered_workers[identity]
+                    service = services[worker.service]
+                    service.remove(worker)
+
+                    reason = "Worker '{}' is not responding".format(identity)
+                    fail_pending(worker, reason)
+                    if service.workers:
+                        # The other workers can take over the queued requests
+                        for request in worker.queue:
+                            other = service.select(protocol.peek(request.body)[1])
+                            other.queue.append(request)
+                        worker.queue.clear()
+                        for other in service.workers:
+                            dispatch(other, now)
+                    else:
+                        fail_queued(worker, reason)
+                        del services[worker.service]
+                elif worker.queue:
+                    expire_queued(worker, now)
+            expire_in_flight(now)
+
+        if args.stats_file and now >= next_snapshot:
+            next_snapshot = now + args.stats_interval
+            save_json(args.stats_file, metrics.snapshot(registered_workers))
 
         if (clients in socks and socks[clients] == zmq.POLLIN):
-            # Parse the three components of the message
-            client_addr, empty, msg = clients.recv_multipart()
+            frames = clients.recv_multipart()
+            client_addr = frames[0]
+
+            # Requests from other versions of the protocol can't be parsed
+            if len(frames) != 6 or frames[1] != protocol.VERSION:
+                reply_to_client(clients, client_addr, b'',
+                                protocol.error_reply("Unsupported protocol version"))
+                continue
 
-            assert empty == b""
-            print "Client with address: {}".format(client_addr)
-            print "Message is {}".format(msg)
+            # Route on the target, leave the body alone
+            _, _, req_id, target, ttl, body = frames
 
-            cmds = msg.split(' ')
-            target = cmds[0]   # First part is the target device
+            # Requests that wait in the queue past their deadline are dropped,
+            # since the client has given up on them by then
+            try:
+                ttl = int(ttl)
+            except ValueError:
+                respond(client_addr, req_id,
+                      protocol.error_reply("Invalid deadline '{}'".format(ttl)))
+                continue
+            deadline = now + ttl / 1e3 if ttl > 0 else None
 
-            # If the worker is registered, send the message there
-            # Also send the client address for the reply
-            workers.send(target, zmq.SNDMORE)
-            workers.send(client_addr, zmq.SNDMORE)
-            workers.send(b'', zmq.SNDMORE)
-            workers.send(' '.join(cmds[1:]))
+            if target == protocol.BROKER:
+                broker_command(client_addr, req_id, body, deadline, now)
+                continue
+
+            submit(client_addr, req_id, target, body, deadline, now)
 
         if (workers in socks and socks[workers] == zmq.POLLIN):
-            # Parse the three components of the message
-            _, client_addr, _, msg = workers.recv_multipart()
-            print "Received response for client '{}' : {}".format(client_addr, msg)
+            frames = workers.recv_multipart()
+            identity = frames[0]
+
+            # Control messages have an empty second frame
+            if frames[1] == b'':
+                version, command, service_name = frames[2:5]
+                if version != protocol.VERSION:
+                    print "Ignoring worker '{}' with protocol {}".format(identity, version)
+                    continue
+                worker = registered_workers.get(identity)
+
+                if command == protocol.W_READY and worker is not None:
+                    # The worker restarted, the requests it had are lost, but
+                    # the queued ones can still go through
+                    fail_pending(worker, "Worker '{}' restarted".format(identity))
+                    dispatch(worker, now)
+
+                if worker is None:
+                    # Heartbeats of unknown workers (e.g. after a broker
+                    # restart) also register them
+                    print "Registered worker '{}' for '{}'".format(identity, service_name)
+                    worker = registered_workers[identity] = Worker(identity, service_name, now)
+                    if service_name not in services:
+                        services[service_name] = Service(service_name)
+                    services[service_name].add(worker)
+                worker.touch(now)
+                continue
+
+            # Parse the reply: token, status and payload
+            _, token, status, payload = frames
+            if identity in registered_workers:
+                registered_workers[identity].touch(now)
+
+            # Drop replies nobody is waiting for anymore (e.g. a worker
+            # that answers a request more than once)
+            if token not in pending:
+                metrics.late_replies += 1
+                continue
+            (client_addr, req_id, worker, stats, received, _,
+             key, followers) = pending.pop(token)
+            worker.in_flight -= 1
+
+            answer(client_addr, req_id, stats, received, [status, payload], now)
+            if followers is not None:
+                # Later reads have to ask the worker again
+                if coalesced.get(key) is followers:
+                    del coalesced[key]
+                for client_addr, req_id, received, _ in followers:
+                    answer(client_addr, req_id, stats, received, [status, payload], now)
+
+            # The worker has a free slot now
+            if worker.queue:
+                dispatch(worker, now)
+
+        if publishers in socks:
+            subscribers.send_multipart(publishers.recv_multipart())
+            metrics.published += 1
 
-            clients.send(client_addr, zmq.SNDMORE)
-            clients.send(b'', zmq.SNDMORE)
-            clients.send(msg)
+        if subscribers in socks:
+            # (Un)subscriptions, let the daemons know
+            publishers.send_multipart(subscribers.recv_multipart())
 
     # Clean up on graceful exit
+    subscribers.close()
+    publishers.close()
     workers.close()
     clients.close()
     context.term()
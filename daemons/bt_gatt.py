@@ -2,275 +2,1194 @@
 import zmq
 import pexpect
 
-import sys, threading, time
+import os, re, sys, json, time, types, select, argparse, collections
 
-def _st_connect_helper(gatt):
+# Make the shared kasa modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from devices import protocol
+from devices.jsonfile import load_json, save_json
+
+# Target that the clients address this daemon with
+SERVICE = b"GATT"
+
+# Devices that the daemon is connected to at the same time, at most (the
+# Bluetooth adapters can't keep many more connections up)
+MAX_CONNECTIONS = 10
+
+# Seconds that gatttool gets to answer a command
+COMMAND_TIMEOUT = 10
+
+# Seconds without requests after which the connection of a device is checked
+IDLE_CHECK = 10
+
+# Seconds without reads after which a sensor that read_value switched on is
+# switched off again
+SENSOR_IDLE = 60
+
+# Priorities of the requests, most urgent first. A request gives its
+# priority after its command, e.g. 'read:poll', plain commands are interactive
+PRIORITIES = ['interactive', 'poll', 'background']
+INTERACTIVE, POLL, BACKGROUND = range(len(PRIORITIES))
+
+# Commands that only read, which identical requests queued after them can join
+READS = frozenset(['read', 'read_value'])
+
+# Commands that the daemon queues for its devices by itself, which the
+# clients can't send: they don't reply, or leave the device behind
+INTERNAL_COMMANDS = frozenset(['check', 'power_off', 'exit'])
+
+# Arguments that the commands need after the device (they may take more)
+ARGUMENTS = {
+    'read': ['a handle'],
+    'write': ['a handle', 'a value'],
+    'read_value': ['a configuration handle', 'a value handle', 'an enable command',
+                   'a disable command'],
+    'subscribe': ['a handle'],
+    'unsubscribe': ['a handle'],
+}
+
+def missing_arguments(command, args):
+    ''' What `command` needs that `args` lacks, e.g. 'write needs a handle and a value', or None '''
+    needed = ARGUMENTS.get(command, [])
+    if len(args) >= len(needed):
+        return None
+    if len(needed) == 1:
+        return "{} needs {}".format(command, needed[0])
+    return "{} needs {} and {}".format(command, ', '.join(needed[:-1]), needed[-1])
+
+def parse_command(command):
+    '''
+    The name and the priority of `command`
+    Raises ValueError if the priority is unknown
+    '''
+    name, _, priority = command.partition(':')
+    if not priority:
+        return name, INTERACTIVE
+    if priority not in PRIORITIES:
+        raise ValueError("Unknown priority '{}'".format(priority))
+    return name, PRIORITIES.index(priority)
+
+# Where the handles of the characteristics of the devices are kept, so
+# that they are only discovered once per device and firmware
+HANDLE_CACHE_FILE = os.path.expanduser('~/.kasa/gatt-handles.json')
+
+# Seconds without more characteristics after which their discovery is over
+# (gatttool prints them all at once, but may redraw its prompt in between)
+DISCOVERY_GAP = 0.1
+
+# UUID of the firmware revision, which tells when the handles may have moved
+FIRMWARE_UUID = '00002a26-0000-1000-8000-00805f9b34fb'
+
+# Characteristics that the commands can give by name rather than by handle
+# or UUID: the SensorTag sensors, with their configuration (e.g.
+# 'temperature_config') and update period where they have one
+SENSORTAG_UUID = 'f000{:04x}-0451-4000-b000-000000000000'
+CHARACTERISTICS = {
+    'device_name': '00002a00-0000-1000-8000-00805f9b34fb',
+    'firmware': FIRMWARE_UUID,
+}
+for name, first in [('temperature', 0xaa01), ('accelerometer', 0xaa11),
+                    ('humidity', 0xaa21), ('magnetometer', 0xaa31),
+                    ('pressure', 0xaa41), ('gyroscope', 0xaa51)]:
+    CHARACTERISTICS[name] = SENSORTAG_UUID.format(first)
+    CHARACTERISTICS[name + '_config'] = SENSORTAG_UUID.format(first + 1)
+    CHARACTERISTICS[name + '_period'] = SENSORTAG_UUID.format(first + 2)
+CHARACTERISTICS['pressure_calibration'] = CHARACTERISTICS.pop('pressure_period')
+
+def full_uuid(uuid):
+    ''' The 128-bit form of `uuid`, which may be a 16-bit one (e.g. '2a26') '''
+    uuid = uuid.lower()
+    if len(uuid) == 4:
+        return '0000{}-0000-1000-8000-00805f9b34fb'.format(uuid)
+    return uuid
+
+# Prompts of gatttool, while connected to the device and while not
+PROMPTS = ['\[CON\].*>', '\[   \].*>']
+
+# gatttool redraws its prompt by itself when the connection goes up or down
+PROMPT = re.compile(r'\[(CON|   )\]\[[^\]]*\]\[LE\]>')
+
+class NotConnected(IOError):
+    ''' gatttool answered that the device is not connected '''
+
+# Values that gatttool prints by itself for the characteristics with
+# notifications (or indications) enabled
+NOTIFICATION = re.compile(r'(?:Notification|Indication) handle = (0x[0-9a-fA-F]+) '
+                          r'value: ([0-9a-fA-F ]*)\r?\n')
+
+class Expect(object):
+    ''' Step of an operation: wait for output of `gatt` that matches one of `patterns` '''
+
+    # The patterns as pexpect compiles them, by list of patterns (the
+    # operations use the same few lists over and over)
+    compiled = {}
+
+    def __init__(self, gatt, patterns, timeout=COMMAND_TIMEOUT):
+        self.gatt = gatt
+        self.patterns = patterns if isinstance(patterns, list) else [patterns]
+        self.timeout = timeout
+
+    def match(self):
+        '''
+        Index of the pattern that the output so far matches, None if none does
+        Raises pexpect.EOF if gatttool exited
+        '''
+        # (Matching TIMEOUT rather than having it raised, which is slow as
+        # pexpect describes the whole handle in the exception)
+        key = tuple(self.patterns)
+        if key not in Expect.compiled:
+            Expect.compiled[key] = self.gatt.compile_pattern_list(self.patterns + [pexpect.TIMEOUT])
+        index = self.gatt.expect_list(Expect.compiled[key], timeout=0)
+        return index if index < len(self.patterns) else None
+
+class Return(Exception):
+    ''' Raised by an operation to end with a result '''
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Task(object):
+    '''
+    Carries out an operation with gatttool, without blocking
+
+    Operations are generators (the st_ functions below), which yield what
+    they wait for:
+
+    - Expect: output of gatttool, the index of the pattern that matched is
+      sent back to them
+    - a number: a pause of that many seconds
+    - another operation, the result of which is sent back to them
+
+    and raise Return with their result. What goes wrong while they wait
+    (pexpect.TIMEOUT, pexpect.EOF) is raised inside of them.
+
+    The owner of the task calls `readable` when gatttool printed something,
+    and `expire` once `deadline` has passed, until the task is `done`. It
+    then has a `result`, or an `error`.
+    '''
+    def __init__(self, operation):
+        self.stack = [operation]
+        self.waiting = None
+        self.deadline = None
+        self.done = False
+        self.result = None
+        self.error = None
+        self.resume()
+
+    def resume(self, value=None, error=None):
+        ''' Run the operation until it waits for something again, or ends '''
+        while self.stack:
+            try:
+                if error is not None:
+                    step = self.stack[-1].throw(error)
+                else:
+                    step = self.stack[-1].send(value)
+            except Return as e:
+                self.stack.pop()
+                value, error = e.value, None
+                continue
+            except StopIteration:
+                self.stack.pop()
+                value, error = None, None
+                continue
+            except Exception as e:
+                self.stack.pop()
+                value, error = None, e
+                continue
+            value, error = None, None
+
+            if isinstance(step, types.GeneratorType):
+                self.stack.append(step)
+                continue
+
+            if isinstance(step, Expect):
+                # The output may be there already
+                try:
+                    value = step.match()
+                except pexpect.EOF as e:
+                    error = e
+                    continue
+                if value is not None:
+                    continue
+                self.deadline = time.time() + step.timeout
+            else:
+                self.deadline = time.time() + step
+            self.waiting = step
+            return
+
+        self.waiting = self.deadline = None
+        self.done = True
+        self.result, self.error = value, error
+
+    def readable(self):
+        '''
+        gatttool printed something: carry on if the operation waits for it
+        Returns False if it doesn't, the output is then up to the caller
+        '''
+        step = self.waiting
+        if not isinstance(step, Expect):
+            return False
+        try:
+            index = step.match()
+        except pexpect.EOF as e:
+            self.resume(error=e)
+            return True
+        if index is not None:
+            self.resume(index)
+        return True
+
+    def expire(self):
+        ''' The deadline passed: the pause is over, or the wait timed out '''
+        if isinstance(self.waiting, Expect):
+            self.resume(error=pexpect.TIMEOUT("Timed out"))
+        else:
+            self.resume()
+
+def wait(operation):
+    '''
+    Carry out `operation`, blocking until it is done, and return its result
+
+    For scripts and benchmarks: the daemon runs the operations of all the
+    devices at once, with Task.
+    '''
+    task = Task(operation)
+    while not task.done:
+        step = task.waiting
+        timeout = max(task.deadline - time.time(), 0)
+        if isinstance(step, Expect):
+            if select.select([step.gatt.child_fd], [], [], timeout)[0]:
+                task.readable()
+                continue
+        else:
+            time.sleep(timeout)
+        task.expire()
+
+    if task.error is not None:
+        raise task.error
+    return task.result
+
+def st_spawn(bluetooth_addr):
+    '''
+    Spawns a new pexpect call for the device, and returns the handle
+    (st_connect then connects)
     '''
-    Helper that tries to connect to the device 3 times
+    gatt = pexpect.spawn('gatttool -b ' + bluetooth_addr + ' --interactive')
+    # Every command waits for the prompt of the previous one, so there is no
+    # need for pexpect to wait before sending (50 ms by default)
+    gatt.delaybeforesend = None
+    # Nor to pause after reading, the output is only read once it's there
+    gatt.delayafterread = None
+    return gatt
+
+def st_connect(gatt):
+    '''
+    Tries to connect to the device 3 times
     If a connection cannot be established at that time,
-    it raises an exception
+    it raises IOError
     '''
+    yield Expect(gatt, '\[LE\]>')
     retry_num = 3
     while (retry_num > 0):
         try:
             #print "Preparing to connect. You might need to press the side button..."
             gatt.sendline('connect')
             # test for success of connect
-            gatt.expect('\[CON\].*>', timeout=3)
+            yield Expect(gatt, '\[CON\].*>', timeout=3)
             return
         except pexpect.TIMEOUT:
             retry_num -= 1
 
     # Could not connect after 3 retries, raise exception
     print "Cannot connect to device. Is it discoverable?"
-    gatt.close(force=True)
     raise IOError('Cannot connect')
 
-def st_connect(bluetooth_addr):
-    '''
-    Spawns a new pexpect call, connects, and returns the handle
-    Raises IOError if cannot connect
-    '''
-    # Receive the bluetooth address as the first argument
-    gatt = pexpect.spawn('gatttool -b ' + bluetooth_addr + ' --interactive')
-    gatt.expect('\[LE\]>')
-    _st_connect_helper(gatt)
-    return gatt
-
 def st_read_value(gatt, ctrl_addr, read_addr, enable_cmd, disable_cmd, sleep_amount=0.3):
     '''
     Convenience funciton for enabling a reading, and then performing it
     '''
-    st_write(gatt, ctrl_addr, enable_cmd)
-    #time.sleep(0.3)   # Sleep so that we can have time to take the reading
-    time.sleep(sleep_amount)   # Sleep so that we can have time to take the reading
-    rval = st_read(gatt, read_addr)
-    st_write(gatt, ctrl_addr, disable_cmd)
-    return rval
+    yield st_write(gatt, ctrl_addr, enable_cmd)
+    yield sleep_amount   # Sleep so that we can have time to take the reading
+    rval = yield st_read(gatt, read_addr)
+    yield st_write(gatt, ctrl_addr, disable_cmd)
+    raise Return(rval)
 
 def st_write(gatt, write_addr, write_value):
     '''
     Write value from an already established GATT interface
+    Raises NotConnected if gatttool isn't connected to the device (anymore)
     '''
-    # Make sure that we're connected
-    gatt.sendline(' ')
-    stat = gatt.expect(['\[CON\].*>', '\[   \].*>'])
-    if stat == 1:
-        # We're not connected, try to reconnect
-        _st_connect_helper(gatt)
-        #raise IOError("Not connected")
-
     gatt.sendline('char-write-cmd {} {}'.format(write_addr, write_value))
-    stat = gatt.expect(['\[CON\].*>', '\[   \].*>'])
-    if stat == 1:
-        # We're not connected
-        #raise IOError("Not connected")
-        return False
+    if (yield Expect(gatt, PROMPTS)) == 1:
+        raise NotConnected("Not connected")
 
 def st_check_connected(gatt):
     ''' Make sure that we're connected
     Checks that the connection is alive, and otherwise, tries to connect
-    Raises IOError if connection can't be established.
+    Raises NotConnected if connection can't be established.
     Returns True if connection is alive
+
+    This costs a round trip to gatttool, so the daemon only calls it when it
+    doesn't know the state of the connection from the output of gatttool.
     '''
     gatt.sendline(' ')
-    stat = gatt.expect(['\[CON\].*>', '\[   \].*>'])
+    stat = yield Expect(gatt, PROMPTS)
 
     # Connection is alive, return True
     if stat == 0:
-        return True
+        raise Return(True)
 
     # Not connected, try to connect
     try:
         print "Reconnecting"
         gatt.sendline('connect')
-        gatt.expect('\[CON\].*>', timeout=3)
-        return True
+        yield Expect(gatt, '\[CON\].*>', timeout=3)
     except pexpect.TIMEOUT:
-        raise IOError("Unable to set up connection.")
+        raise NotConnected("Unable to set up connection.")
+    raise Return(True)
 
 def st_read(gatt, read_addr):
     '''
     Read value from an already established GATT interface
+    Raises NotConnected if gatttool isn't connected to the device (anymore),
+    and IOError if the device refused the read
     '''
-    st_check_connected(gatt)
-
-    # Read the value
     gatt.sendline('char-read-hnd {}'.format(read_addr))
-    gatt.expect('descriptor: (?P<value>.*) \r\n') 
+    stat = yield Expect(gatt, ['descriptor: (?P<value>.*) \r\n', 'read failed: (?P<error>.*)\r\n'] + PROMPTS)
+    if stat == 3:
+        raise NotConnected("Not connected")
+    if stat == 2:
+        raise IOError("Read failed")
+    if stat == 1:
+        error = gatt.match.group('error')
+        yield Expect(gatt, PROMPTS)
+        raise IOError("Read failed: {}".format(error))
+
     rval = gatt.match.group('value')
-    gatt.expect('\[CON\].*>')
-    st_check_connected(gatt)
+    if (yield Expect(gatt, PROMPTS)) == 1:
+        raise NotConnected("Not connected")
+    raise Return(rval)
+
+def st_read_uuid(gatt, uuid):
+    '''
+    Read the value of the characteristic `uuid`, without knowing its handle
+    Raises IOError if the device has no such characteristic
+    '''
+    gatt.sendline('char-read-uuid {}'.format(uuid))
+    stat = yield Expect(gatt, ['\t value: (?P<value>[0-9a-fA-F ]*)\r?\n', 'UUID failed: (?P<error>.*)\r\n'] + PROMPTS)
+    if stat == 3:
+        raise NotConnected("Not connected")
+    if stat == 2:
+        raise IOError("Read failed")
+    if stat == 1:
+        error = gatt.match.group('error')
+        yield Expect(gatt, PROMPTS)
+        raise IOError("Read failed: {}".format(error))
 
-    return rval
+    rval = gatt.match.group('value').strip()
+    if (yield Expect(gatt, PROMPTS)) == 1:
+        raise NotConnected("Not connected")
+    raise Return(rval)
+
+def st_characteristics(gatt):
+    '''
+    Discover the characteristics of the device
+    Returns the handles of their values, by UUID
+    '''
+    gatt.sendline('characteristics')
+    handles = {}
+    while True:
+        try:
+            stat = yield Expect(gatt, ['value handle: (?P<handle>0x[0-9a-fA-F]+), uuid: (?P<uuid>[0-9a-fA-F-]+)',
+                                       'characteristics failed: (?P<error>.*)\r\n'] + PROMPTS,
+                                timeout=DISCOVERY_GAP if handles else COMMAND_TIMEOUT)
+        except pexpect.TIMEOUT:
+            if handles:
+                raise Return(handles)
+            raise
+        if stat == 0:
+            handles[gatt.match.group('uuid').lower()] = gatt.match.group('handle')
+        elif stat == 1:
+            raise IOError("Discovery failed: {}".format(gatt.match.group('error')))
+        elif stat == 3:
+            raise NotConnected("Not connected")
+
+def st_subscribe(gatt, notify_addr, enable=True):
+    '''
+    Enable (or disable) the notifications of a characteristic, by writing to
+    its client configuration descriptor `notify_addr`
+    '''
+    yield st_write(gatt, notify_addr, '0100' if enable else '0000')
+
+def st_output(gatt):
+    '''
+    Take what gatttool printed by itself so far, without waiting
+
+    Returns a list of the notifications as (handle, value), with the handle
+    as an int, and whether the device is connected according to the last
+    prompt that gatttool redrew (None if it didn't). The rest of the output
+    is dropped, except for the start of a line that is still being printed.
+    Raises pexpect.EOF if gatttool exited.
+    '''
+    text = gatt.buffer
+    try:
+        while True:
+            text += gatt.read_nonblocking(4096, timeout=0)
+    except pexpect.TIMEOUT:
+        pass
+
+    notifications = [(int(handle, 16), value.strip())
+                     for handle, value in NOTIFICATION.findall(text)]
+    prompts = PROMPT.findall(text)
+    connected = prompts[-1] == 'CON' if prompts else None
+
+    # Keep an unfinished notification for the next time, but no prompt, as
+    # the next command would take it for its own
+    tail = text.rsplit('\n', 1)[-1]
+    gatt.buffer = tail if '>' not in tail else ''
+    return notifications, connected
 
 def st_disconnect(gatt):
     gatt.sendline('disconnect')
-    gatt.expect('\[   \].*>')
+    yield Expect(gatt, '\[   \].*>')
+
+def st_exit(gatt):
+    '''
+    Have gatttool exit, and close the handle
+    '''
+    try:
+        if gatt.isalive():
+            gatt.sendline('exit')
+            yield Expect(gatt, [pexpect.EOF], timeout=1)
+    except (pexpect.TIMEOUT, OSError):
+        pass
+    # gatttool is gone (or gets killed), no need to give it time
+    gatt.ptyproc.delayafterclose = 0
     gatt.close(force=True)
 
-def worker_thread(worker_url, bluetooth_addr, context=None):
+class HandleCache(object):
+    '''
+    The handles of the characteristics of every device, saved in `path`
+
+    They are kept by device address, along with the firmware revision of the
+    device: a device with another firmware is discovered again.
     '''
-    Thread that establishes a connection and waits for input on the PAIR socket
+    def __init__(self, path=HANDLE_CACHE_FILE):
+        self.path = path
+        self.devices = load_json(path, {})
 
-    Arguments:
-    - worker_url: URL for the PAIR socket that will be used for communicating with the
-    main process
-    - bluetooth_addr: Bluetooth address of the device to be connected
+    def save(self):
+        save_json(self.path, self.devices)
 
-    The items on the socket should be a string, corresponding to space-separated list
-    'read ctrl_add read_addr enable_cmd disable_cmd'
+    def get(self, bluetooth_addr, firmware):
+        ''' The handles of the device by UUID, None if they aren't known '''
+        device = self.devices.get(bluetooth_addr)
+        if device is None or device['firmware'] != firmware:
+            return None
+        return dict((str(uuid), str(handle)) for uuid, handle in device['handles'].items())
+
+    def put(self, bluetooth_addr, firmware, handles):
+        self.devices[bluetooth_addr] = {'firmware': firmware, 'handles': handles}
+        self.save()
+
+class Sensor(object):
+    '''
+    A sensor that read_value switched on, by writing `enable_cmd` to its
+    configuration `ctrl_addr`: it can be read from `ready_at` on, and is
+    switched off with `disable_cmd` once idle
+    '''
+    def __init__(self, ctrl_addr, read_handle, enable_cmd, disable_cmd, ready_at):
+        self.ctrl_addr = ctrl_addr
+        self.read_handle = read_handle
+        self.enable_cmd = enable_cmd
+        self.disable_cmd = disable_cmd
+        self.ready_at = ready_at
+        self.last_read = ready_at
 
+class Request(object):
+    '''
+    A request queued for a device, and the clients that wait for its reply
+    (None for the requests of the daemon itself)
     '''
-    context = context or zmq.Context.instance()
+    def __init__(self, client_addr, cmd, priority):
+        self.clients = [client_addr]
+        self.cmd = cmd
+        self.priority = priority
+        self.queued = time.time()
 
-    # Connected to the paired main thread
-    socket = context.socket(zmq.PAIR)
-    socket.connect(worker_url)
+class DeviceStats(object):
+    ''' Counters for the requests to one device '''
 
-    # Poller to implement timeout on the socket
-    p = zmq.Poller()
-    p.register(socket, zmq.POLLIN)
+    def __init__(self):
+        self.requests = 0
+        # Reads answered with the reply to an identical queued read, and
+        # writes dropped for a later write to the same handle
+        self.coalesced = 0
+        self.superseded = 0
+        # Requests started, and the seconds they waited in the queue, by priority
+        self.started = [0] * len(PRIORITIES)
+        self.total_wait = [0.] * len(PRIORITIES)
+        self.max_wait = [0.] * len(PRIORITIES)
 
-    # Connect to the BT device
-    try:
-        gatt = st_connect(bluetooth_addr)
-        socket.send(b'ok')
-    except IOError:
-        socket.send(b'fail')
-        return
+    def start(self, request, now):
+        wait = now - request.queued
+        self.started[request.priority] += 1
+        self.total_wait[request.priority] += wait
+        self.max_wait[request.priority] = max(self.max_wait[request.priority], wait)
 
-    while True:
-        # Poll the socket for new commands. If we don't receive any new commands
-        # within 5 seconds, make sure that the connection is active
-        msgs = dict(p.poll(10e3)) 
+    def as_dict(self):
+        ms = lambda seconds: round(seconds * 1e3, 3)
+        return {'requests': self.requests,
+                'coalesced': self.coalesced,
+                'superseded': self.superseded,
+                'wait_ms': dict((name, {'started': self.started[i],
+                                        'mean': ms(self.total_wait[i] / max(self.started[i], 1)),
+                                        'max': ms(self.max_wait[i])})
+                                for i, name in enumerate(PRIORITIES))}
+
+class Device(object):
+    '''
+    A device that the daemon talks to, through a gatttool process of its own
+
+    The requests for the device are multipart messages with the command
+    and its arguments, e.g. ['read_value', ctrl_addr, read_addr, enable_cmd,
+    disable_cmd]. They wait in a queue per priority, and are carried out one
+    at a time, the most urgent first (in the order they came in otherwise):
+    the first one is the connect. The replies are the status and payload
+    frames to be relayed to the client.
 
-        if socket not in msgs:
-            # Timeout event
-            if gatt is not None:
-                st_check_connected(gatt)
-            continue
+    A read that is already queued answers the identical reads that come in
+    after it, unless another request was queued in between: a poll that
+    comes around while the previous one still waits costs no extra round
+    trip. A write that is the last request queued is dropped for a later
+    write to the same handle, which answers both: of a burst of writes to a
+    setting, only the last one goes to the device. A write that other
+    requests were queued after is always carried out.
 
-        cmd = socket.recv().split()
+    The values that are read are also published on the telemetry bus, under
+    GATT/<bluetooth_addr>/<read_addr>.
+
+    ['read_value', ctrl_addr, read_addr, enable_cmd, disable_cmd, warm_up]
+    switches the sensor on (writes `enable_cmd` to its configuration
+    `ctrl_addr`) if it is not on yet, and reads it once it has warmed up
+    (after `warm_up` seconds, 0.3 by default). The sensor then stays on, so
+    that the next reads take a single round trip: it is switched off with
+    `disable_cmd` once it hasn't been read for SENSOR_IDLE seconds (and
+    isn't subscribed to).
+
+    The commands take the characteristics by handle (e.g. '0x25'), by UUID,
+    or by name (e.g. 'temperature', see CHARACTERISTICS). The first UUID or
+    name has the device list its characteristics, which takes a round trip
+    per characteristic: the handles are saved by device address and
+    firmware revision, so that later connections only read the firmware.
+
+    ['subscribe', read_addr, notify_addr] enables the notifications of the
+    characteristic at `read_addr` (`notify_addr` being its client
+    configuration descriptor, by default the next handle). The device then
+    sends every new value by itself: the values are published as they
+    arrive, and reads of `read_addr` answer with the latest one, without
+    asking the device. ['unsubscribe', read_addr] stops the notifications.
+    '''
+    def __init__(self, engine, bluetooth_addr):
+        self.engine = engine
+        self.bluetooth_addr = bluetooth_addr
+        self.gatt = st_spawn(bluetooth_addr)
+        # (The handle of a closed gatttool forgets its fd)
+        self.fd = self.gatt.child_fd
+
+        # Requests waiting for the device, by priority, and the clients of
+        # the one that is being carried out
+        self.queues = [collections.deque() for _ in PRIORITIES]
+        self.task = None
+        self.clients = []
+        self.last_request = time.time()
+
+        # Queued reads that identical reads can join, by command, and the
+        # last request queued if it is a write, by its handle
+        self.reads = {}
+        self.writes = {}
+        self.stats = DeviceStats()
+
+        # Whether the first connect went through, and whether gatttool is
+        # on its way out
+        self.ready = False
+        self.closing = False
+
+        # Whether the device is connected, as gatttool last showed it (None
+        # when we can't tell). gatttool is only asked when we can't tell or
+        # when the device has been idle for a while, not around every command
+        self.connected = None
+
+        # Characteristics with notifications enabled: the handle of their
+        # value (as an int) maps to their address as the client gave it, and
+        # to the latest value they sent, if any. (A notification that arrives
+        # in the middle of another command is skipped by its expect calls, the
+        # next one brings the value up to date.)
+        self.subscriptions = {}
+        self.latest = {}
+
+        # Handles of the characteristics by UUID, once a command gives one
+        # by UUID or by name (see `discover`)
+        self.handles = None
+
+        # Sensors that read_value switched on, by the handle of their
+        # configuration
+        self.sensors = {}
+
+    def publish(self, read_addr, rval):
+        self.engine.publish(self.bluetooth_addr, read_addr, rval)
+
+    def request(self, client_addr, cmd, priority=INTERACTIVE):
+        ''' Queue the request `cmd` of `client_addr` '''
+        self.last_request = time.time()
+        self.stats.requests += 1
+
+        key = tuple(cmd)
+        if cmd[0] in READS and key in self.reads:
+            # The same read is queued already, its reply answers both
+            self.stats.coalesced += 1
+            request = self.reads[key]
+            request.clients.append(client_addr)
+            self.promote(request, priority)
+            self.next()
+            return
+
+        request = Request(client_addr, cmd, priority)
+        if cmd[0] in READS:
+            self.reads[key] = request
+        else:
+            # Later reads must see the effect of this request, so they can't
+            # join the reads queued before it
+            self.reads.clear()
+
+        if cmd[0] == 'write':
+            previous = self.writes.get(cmd[1])
+            if previous is not None:
+                # The handle gets the later value right away, only write that
+                self.stats.superseded += 1
+                self.queues[previous.priority].remove(previous)
+                request.clients[:0] = previous.clients
+                request.queued = previous.queued
+                priority = request.priority = min(priority, previous.priority)
+            # Only the last request queued can be superseded, the requests
+            # queued after a write must see its value
+            self.writes = {cmd[1]: request}
+        else:
+            self.writes.clear()
+
+        self.queues[priority].append(request)
+        self.next()
+
+    def promote(self, request, priority):
+        ''' Move the queued `request` up to `priority`, if that is more urgent '''
+        if priority < request.priority:
+            self.queues[request.priority].remove(request)
+            request.priority = priority
+            self.queues[priority].append(request)
+
+    def pop(self):
+        ''' Take the next request out of the queues, None if there is none '''
+        for queue in self.queues:
+            if queue:
+                request = queue.popleft()
+                # Requests that are under way can't be joined anymore
+                key = tuple(request.cmd)
+                if self.reads.get(key) is request:
+                    del self.reads[key]
+                if request.cmd[0] == 'write' and self.writes.get(request.cmd[1]) is request:
+                    del self.writes[request.cmd[1]]
+                return request
+        return None
+
+    def queued(self):
+        ''' The requests that wait for the device, most urgent first '''
+        return [request for queue in self.queues for request in queue]
+
+    def next(self):
+        ''' Start on the next request, unless busy '''
+        while self.task is None:
+            request = self.pop()
+            if request is None:
+                return
+            self.stats.start(request, time.time())
+            self.clients = request.clients
+            self.task = Task(self.operation(request.cmd))
+            self.check()
+
+    def as_dict(self):
+        ''' Statistics of the device, for the stats command '''
+        now = time.time()
+        stats = self.stats.as_dict()
+        stats['busy'] = self.task is not None
+        stats['queued'] = dict((name, len(queue)) for name, queue in zip(PRIORITIES, self.queues))
+        stats['oldest_ms'] = round(max([now - r.queued for r in self.queued()] or [0]) * 1e3, 3)
+        return stats
+
+    def check(self):
+        ''' Answer the request once its task is done, and go on with the next '''
+        if not self.task.done:
+            return
+        task, self.task = self.task, None
+        error = task.error
+
+        if error is None:
+            reply = task.result
+        elif isinstance(error, NotConnected):
+            self.connected = False
+            reply = protocol.error_reply(str(error))
+        elif isinstance(error, pexpect.TIMEOUT):
+            # No telling what gatttool is up to, ask it before the next command
+            self.connected = None
+            reply = protocol.error_reply("Timed out")
+        elif isinstance(error, pexpect.EOF):
+            reply = protocol.error_reply("gatttool exited")
+        else:
+            reply = protocol.error_reply(str(error))
+        if reply is not None:
+            for client_addr in self.clients:
+                self.engine.reply(client_addr, reply)
+
+        if self.closing:
+            if self.gatt.closed:
+                self.engine.remove(self)
+        elif isinstance(error, pexpect.EOF) or (error is not None and not self.ready):
+            # The device is of no use anymore, nor are the requests for it
+            self.close(reply)
+
+    def close(self, reply=None):
+        '''
+        Have gatttool exit, after the current request. The requests that
+        are still waiting get `reply`, by default that the device is not
+        connected.
+        '''
+        reply = reply or protocol.error_reply("Not connected to '{}'".format(self.bluetooth_addr))
+        for request in self.queued():
+            for client_addr in request.clients:
+                self.engine.reply(client_addr, reply)
+        for queue in self.queues:
+            queue.clear()
+        self.reads.clear()
+        self.writes.clear()
+        self.closing = True
+        self.engine.closing(self)
+        self.queues[INTERACTIVE].append(Request(None, ['exit'], INTERACTIVE))
+
+    def readable(self):
+        ''' gatttool printed something '''
+        if self.task is not None and self.task.readable():
+            self.check()
+            self.next()
+            return
+
+        try:
+            notifications, state = st_output(self.gatt)
+        except pexpect.EOF:
+            # gatttool went away on its own
+            if not self.closing:
+                self.close(protocol.error_reply("gatttool exited"))
+                self.next()
+            elif self.task is None:
+                self.engine.remove(self)
+            return
+
+        for handle, rval in notifications:
+            if handle in self.subscriptions:
+                self.latest[handle] = rval
+                self.publish(self.subscriptions[handle], rval)
+        if state is not None:
+            self.connected = state
+
+    def idle_sensors(self):
+        ''' The sensors that are on, and that are not subscribed to '''
+        return [sensor for sensor in self.sensors.values()
+                if sensor.read_handle not in self.subscriptions]
+
+    def sensors_off_at(self):
+        ''' When the first of the idle sensors is to be switched off, None if none is '''
+        return min([sensor.last_read + self.engine.sensor_idle
+                    for sensor in self.idle_sensors()] or [None])
+
+    def deadline(self):
+        ''' When `tick` has something to do '''
+        if self.task is not None:
+            return self.task.deadline
+        if self.closing or not self.ready:
+            return None
+        return min(d for d in [self.last_request + IDLE_CHECK, self.sensors_off_at()]
+                   if d is not None)
+
+    def tick(self, now):
+        '''
+        Time out the task, switch off the sensors that are no longer read, or
+        check the connection of an idle device
+        '''
+        deadline = self.deadline()
+        if deadline is None or deadline > now:
+            return
+        if self.task is not None:
+            self.task.expire()
+            self.check()
+        elif self.sensors_off_at() is not None and self.sensors_off_at() <= now:
+            self.request(None, ['power_off'], BACKGROUND)
+        else:
+            self.request(None, ['check'], BACKGROUND)
+        self.next()
+
+    def operation(self, cmd):
+        ''' Operation that carries out the request `cmd` '''
+        if cmd[0] == 'connect':
+            if not self.ready:
+                yield st_connect(self.gatt)
+                self.ready = self.connected = True
+            raise Return(protocol.ok_reply())
+
+        if cmd[0] == 'exit':
+            yield st_exit(self.gatt)
+            return
+
+        if cmd[0] == 'disconnect':
+            # Disconnect and let gatttool go
+            yield st_disconnect(self.gatt)
+            self.close()
+            raise Return(protocol.ok_reply())
+
+        if not self.connected:
+            # The device switches its sensors off when the connection drops
+            self.sensors.clear()
+
+        if cmd[0] == 'check':
+            # The device has been idle for a while
+            self.connected = yield st_check_connected(self.gatt)
+            return
+
+        if cmd[0] == 'power_off':
+            if self.connected:
+                yield self.power_off()
+            return
+
+        if not self.connected:
+            self.connected = yield st_check_connected(self.gatt)
+        try:
+            reply = yield self.command(cmd)
+        except NotConnected:
+            # The connection went down before gatttool showed it:
+            # connect again, and give the command a second chance
+            self.sensors.clear()
+            self.connected = yield st_check_connected(self.gatt)
+            reply = yield self.command(cmd)
+        raise Return(reply)
+
+    def power_off(self):
+        ''' Operation that switches off the sensors that nobody read for a while '''
+        now = time.time()
+        for sensor in self.idle_sensors():
+            if sensor.last_read + self.engine.sensor_idle <= now:
+                del self.sensors[int(sensor.ctrl_addr, 16)]
+                yield st_write(self.gatt, sensor.ctrl_addr, sensor.disable_cmd)
+
+    def read_sensor(self, ctrl_addr, read_addr, enable_cmd, disable_cmd, warm_up):
+        '''
+        Operation that reads a sensor, after switching it on if it is off
+
+        The sensor then stays on (see `power_off`), the reads only wait for
+        what is left of its warm-up of `warm_up` seconds.
+        '''
+        sensor = self.sensors.get(int(ctrl_addr, 16))
+        if sensor is None or sensor.enable_cmd != enable_cmd:
+            yield st_write(self.gatt, ctrl_addr, enable_cmd)
+            sensor = Sensor(ctrl_addr, int(read_addr, 16), enable_cmd, disable_cmd,
+                            time.time() + warm_up)
+            self.sensors[int(ctrl_addr, 16)] = sensor
+
+        wait = sensor.ready_at - time.time()
+        if wait > 0:
+            yield wait
+        rval = yield st_read(self.gatt, read_addr)
+        sensor.last_read = time.time()
+        raise Return(rval)
+
+    def handle(self, characteristic):
+        '''
+        Operation that finds the handle of `characteristic`, given as its
+        handle (e.g. '0x25'), its UUID, or its name in CHARACTERISTICS
+        Raises IOError if the device has no such characteristic
+        '''
+        if characteristic.lower().startswith('0x'):
+            raise Return(characteristic)
+
+        uuid = full_uuid(CHARACTERISTICS.get(characteristic, characteristic))
+        if self.handles is None:
+            yield self.discover()
+        if uuid not in self.handles:
+            raise IOError("Unknown characteristic '{}'".format(characteristic))
+        raise Return(self.handles[uuid])
+
+    def discover(self):
+        '''
+        Operation that finds the handles of all the characteristics, in the
+        cache if the device and its firmware were seen before
+        '''
+        try:
+            rval = yield st_read_uuid(self.gatt, FIRMWARE_UUID)
+            firmware = ''.join(chr(int(byte, 16)) for byte in rval.split()).rstrip('\0')
+        except NotConnected:
+            raise
+        except IOError:
+            # No firmware revision to go by, the handles are kept all the same
+            firmware = ''
+        cache = self.engine.handle_cache
+
+        handles = cache.get(self.bluetooth_addr, firmware)
+        if handles is None:
+            print "Discovering the characteristics of '{}'".format(self.bluetooth_addr)
+            handles = yield st_characteristics(self.gatt)
+            cache.put(self.bluetooth_addr, firmware, handles)
+        self.handles = handles
+
+    def command(self, cmd):
+        '''
+        Operation that carries out the command `cmd` on the device
+        Raises NotConnected if gatttool says that the device is not connected
+        '''
+        gatt = self.gatt
 
         if cmd[0] == 'read':
-            read_addr = cmd[1]
-            rval = st_read(gatt, read_addr)
-            socket.send(rval)
+            read_addr = yield self.handle(cmd[1])
+            rval = self.latest.get(int(read_addr, 16))
+            if rval is None:
+                rval = yield st_read(gatt, read_addr)
+                self.publish(cmd[1], rval)
+            raise Return(protocol.ok_reply(rval))
+
+        elif cmd[0] == 'subscribe':
+            handle = int((yield self.handle(cmd[1])), 16)
+            notify_addr = (yield self.handle(cmd[2])) if len(cmd) > 2 else hex(handle + 1)
+            yield st_subscribe(gatt, notify_addr)
+            self.subscriptions[handle] = cmd[1]
+            raise Return(protocol.ok_reply())
+
+        elif cmd[0] == 'unsubscribe':
+            handle = int((yield self.handle(cmd[1])), 16)
+            notify_addr = (yield self.handle(cmd[2])) if len(cmd) > 2 else hex(handle + 1)
+            yield st_subscribe(gatt, notify_addr, enable=False)
+            self.subscriptions.pop(handle, None)
+            self.latest.pop(handle, None)
+            raise Return(protocol.ok_reply())
 
         elif cmd[0] == 'write':
-            write_addr = cmd[1]
+            write_addr = yield self.handle(cmd[1])
             write_value = cmd[2]
-            st_write(gatt, write_addr, write_value)
-            socket.send(b'ok')
+            # A sensor configured by hand is up to the client from now on
+            self.sensors.pop(int(write_addr, 16), None)
+            yield st_write(gatt, write_addr, write_value)
+            raise Return(protocol.ok_reply())
 
         elif cmd[0] == 'read_value':
-            # Make sure that we're connected
-            ctrl_addr, read_addr, enable_cmd, disable_cmd = cmd[1:5]
+            ctrl_addr = yield self.handle(cmd[1])
+            read_addr = yield self.handle(cmd[2])
+            enable_cmd, disable_cmd = cmd[3:5]
 
             # Default amount to sleep between the readings
             sleep_amount = 0.3
             if len(cmd) == 6:
                 sleep_amount = float(cmd[5])
-            rval = st_read_value(gatt, ctrl_addr, read_addr, enable_cmd, disable_cmd, sleep_amount = sleep_amount)
-            socket.send(rval)
-            #TODO Send the reading via a PUB/SUB socket
+            rval = self.latest.get(int(read_addr, 16))
+            if rval is None:
+                rval = yield self.read_sensor(ctrl_addr, read_addr, enable_cmd, disable_cmd, sleep_amount)
+                self.publish(cmd[2], rval)
+            raise Return(protocol.ok_reply(rval))
 
-        elif cmd[0] == 'disconnect':
-            # Disconnect and exit the thread
-            st_disconnect(gatt)
-            socket.send(b"ok")
-            break
+        raise Return(protocol.error_reply("Command not understood"))
 
-        else:
-            raise ValueError('Command not understood')
+class Heartbeat(object):
+    '''
+    Keeps the broker informed that we are alive
 
-def main():
+    The broker socket is only used from the main loop, so rather than
+    running in the background, `beat` is called whenever the loop comes
+    around, which it does at least every heartbeat interval.
     '''
-    Server routine
+    def __init__(self, broker):
+        self.broker = broker
+        self.next_beat = time.time() + protocol.HEARTBEAT_INTERVAL
+
+    def beat(self):
+        ''' Send a heartbeat if it is due '''
+        if time.time() >= self.next_beat:
+            self.broker.send_multipart(protocol.control(protocol.W_HEARTBEAT, SERVICE))
+            self.next_beat = time.time() + protocol.HEARTBEAT_INTERVAL
+
+class Engine(object):
     '''
-    port = "9801"
-    context = zmq.Context.instance()
+    Talks to all the devices from a single thread
 
-    # Receive input from the outside world
-    socket = context.socket(zmq.DEALER)
-    # Specify unique identity
-    socket.setsockopt(zmq.IDENTITY, b"GATT")
-    socket.connect("tcp://*:%s" % port)
+    Every device has its own gatttool process (gatttool only connects to
+    one device), but no thread: the engine polls the broker socket and the
+    output of all the gatttool processes at once, and moves the requests of
+    every device along as the output comes in. A device that is slow to
+    connect or to answer only holds up its own requests.
+    '''
+    def __init__(self, socket, telemetry, max_connections=MAX_CONNECTIONS,
+                 handle_cache=None, sensor_idle=SENSOR_IDLE):
+        self.socket = socket
+        self.telemetry = telemetry
+        self.max_connections = max_connections
+        self.sensor_idle = sensor_idle
+        self.handle_cache = handle_cache or HandleCache()
+        self.heartbeat = Heartbeat(socket)
 
-    print "Ready to receive"
+        # Devices by address, connected or connecting
+        self.devices = {}
+        # Devices on their way out, until their gatttool exits
+        self.leaving = []
 
-    # Where we will store references to the worker threads
-    worker_sockets = {}
+        self.poller = zmq.Poller()
+        self.poller.register(socket, zmq.POLLIN)
 
-    while True:
-        # Get the outside message in several parts
-        # Store the client_addr
-        client_addr, _, msg = socket.recv_multipart()
-        print "Received request {} from '{}'".format(msg, client_addr)
-        msg = msg.split(' ')
+    def reply(self, client_addr, frames):
+        ''' Send a reply, unless the request came from the daemon itself '''
+        if client_addr is not None:
+            self.socket.send_multipart([client_addr] + frames)
+
+    def publish(self, bluetooth_addr, read_addr, rval):
+        protocol.publish(self.telemetry, protocol.topic('GATT', bluetooth_addr, read_addr), rval)
 
-        command = msg[0]
+    def closing(self, device):
+        ''' `device` is on its way out, new requests go to a new one '''
+        if self.devices.get(device.bluetooth_addr) is device:
+            del self.devices[device.bluetooth_addr]
+            self.leaving.append(device)
+
+    def remove(self, device):
+        ''' Forget about `device`, the gatttool of which is gone '''
+        self.closing(device)
+        if device in self.leaving:
+            self.leaving.remove(device)
+            self.poller.unregister(device.fd)
+        if not device.gatt.closed:
+            device.gatt.close(force=True)
+
+    def request(self, client_addr, body):
+        ''' Pass the request on to its device '''
+        try:
+            msg = protocol.unpack(body)
+            command, bluetooth_addr = msg[:2]
+        except (ValueError, TypeError, AttributeError):
+            self.reply(client_addr, protocol.error_reply("Malformed request"))
+            return
+        print "Received request {} '{}' from '{}'".format(command, bluetooth_addr, client_addr)
+        try:
+            command, priority = parse_command(command)
+        except ValueError as e:
+            self.reply(client_addr, protocol.error_reply(str(e)))
+            return
+        if command in INTERNAL_COMMANDS:
+            self.reply(client_addr, protocol.error_reply("Unknown command '{}'".format(command)))
+            return
+        missing = missing_arguments(command, msg[2:])
+        if missing is not None:
+            self.reply(client_addr, protocol.error_reply("Malformed request: " + missing))
+            return
 
         # Return list of active connections
         if command == 'active':
-            active_socks = worker_sockets.keys()
-            socket.send_multipart([client_addr, b'', ",".join(active_socks)])
-            continue
-
-        # Parse bluetooth address
-        bluetooth_addr = msg[1]
-        command_args = msg[2:]
-
-        # Worker URL to be shared
-        url_worker = "inproc://{}".format(bluetooth_addr)
-
-        # Connect: Set up socket and start thread
-        if command == 'connect':
-            # Check if we're already connected (if so, don't do anything)
-            if bluetooth_addr in worker_sockets:
-                socket.send_multipart([client_addr, b'', b'ok'])
-                continue
+            active_socks = [addr for addr, device in self.devices.items() if device.ready]
+            self.reply(client_addr, protocol.ok_reply(*active_socks))
+            return
 
-            # Create socket to be shared with worker thread
-            worker = context.socket(zmq.PAIR)
-            worker.bind(url_worker)
-
-            #Start the worker thread
-            thread = threading.Thread(target=worker_thread, args=(url_worker, bluetooth_addr))
-            thread.start()
-                
-            # Check to see if the operation was successful
-            stats = worker.recv()
-            if stats == 'ok':
-                # Save the socket object if the call was successful
-                worker_sockets[bluetooth_addr] = worker
-                socket.send_multipart([client_addr, b'', b'ok'])
-            else:
-                # Connection is not successful, pass on error message
-                socket.send_multipart([client_addr, b'', stats])
-
-        elif command == 'disconnect':
-            # Send disconnect to thread, and close and remove the socket
-            # from the dict
-            worker = worker_sockets[bluetooth_addr]
-            worker.send(b'disconnect')
-            stats = worker.recv()
-            if stats == 'ok':
-                socket.send_multipart([client_addr, b'', b'ok'])
-                del worker_sockets[bluetooth_addr]
-            else:
-                # Connection is not successful
-                socket.send_multipart([client_addr, b'', b'error'])
+        # Queues and wait times of the devices, or of the one given
+        if command == 'stats':
+            stats = dict((addr, device.as_dict()) for addr, device in self.devices.items()
+                         if addr == bluetooth_addr or not bluetooth_addr)
+            self.reply(client_addr, protocol.ok_reply(json.dumps(stats)))
+            return
 
-        else:
-            # Fetch the right socket
-            worker = worker_sockets[bluetooth_addr]
+        device = self.devices.get(bluetooth_addr)
+        if device is None:
+            if command != 'connect':
+                self.reply(client_addr, protocol.error_reply("Not connected to '{}'".format(bluetooth_addr)))
+                return
+            if len(self.devices) >= self.max_connections:
+                self.reply(client_addr, protocol.error_reply(
+                    "Already connected to {} devices".format(self.max_connections)))
+                return
+
+            device = Device(self, bluetooth_addr)
+            self.devices[bluetooth_addr] = device
+            self.poller.register(device.fd, zmq.POLLIN)
+
+        try:
+            device.request(client_addr, [command] + msg[2:], priority)
+        except Exception as e:
+            # What one client sent must not take down the daemon for all
+            print "Request {} from '{}' failed: {!r}".format(msg, client_addr, e)
+            self.reply(client_addr, protocol.error_reply("Failed: {}".format(e)))
+            return
+
+        if command == 'disconnect':
+            # From now on, the device is not connected: requests for it
+            # fail, and a connect starts over with a new gatttool
+            self.closing(device)
+
+    def run(self):
+        while True:
+            devices = self.devices.values() + self.leaving
+            deadlines = [d for d in (device.deadline() for device in devices) if d is not None]
+            timeout = max(min(deadlines + [self.heartbeat.next_beat]) - time.time(), 0)
+            events = dict(self.poller.poll(timeout * 1e3))
+
+            if self.socket in events:
+                while True:
+                    try:
+                        client_addr, body = self.socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.request(client_addr, body)
 
-            worker.send(command + ' ' + ' '.join(command_args))
-            worker_result = worker.recv()
+            now = time.time()
+            for device in devices:
+                if device.fd in events:
+                    device.readable()
+                device.tick(now)
 
-            # Relay reply to the original thread
-            socket.send_multipart([client_addr, b'', worker_result]) 
+            self.heartbeat.beat()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Kasa Bluetooth GATT daemon")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help="devices to be connected to at the same time, at most "
+                             "(default: {})".format(MAX_CONNECTIONS))
+    parser.add_argument('--handle-cache', default=HANDLE_CACHE_FILE,
+                        help="file that keeps the handles of the characteristics of "
+                             "the devices (default: {})".format(HANDLE_CACHE_FILE))
+    parser.add_argument('--sensor-idle', type=float, default=SENSOR_IDLE,
+                        help="seconds without reads after which a sensor is switched "
+                             "off (default: {})".format(SENSOR_IDLE))
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    '''
+    Server routine
+    '''
+    args = parse_args(argv)
+    port = "9801"
+    context = zmq.Context.instance()
+
+    # Receive input from the outside world
+    socket = context.socket(zmq.DEALER)
+    # Specify unique identity, other instances may serve the same devices
+    socket.setsockopt(zmq.IDENTITY, protocol.worker_identity(SERVICE))
+    socket.connect("tcp://localhost:%s" % port)
+
+    # The readings of all the devices are published on the telemetry bus
+    telemetry = context.socket(zmq.PUB)
+    telemetry.setsockopt(zmq.LINGER, 0)
+    telemetry.connect("tcp://localhost:{}".format(protocol.TELEMETRY_PUBLISH_PORT))
+
+    # Register with the broker
+    socket.send_multipart(protocol.control(protocol.W_READY, SERVICE))
+
+    print "Ready to receive"
+    Engine(socket, telemetry, args.max_connections, HandleCache(args.handle_cache),
+           args.sensor_idle).run()
 
 if __name__=="__main__": main()
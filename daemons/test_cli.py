@@ -1,19 +1,31 @@
 import zmq
+import os
 import sys
 
+# Make the shared kasa modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from devices import protocol
+
 def main():
+    '''
+    Usage: test_cli.py target command [device [args...]]
+    '''
 
     # Connect to the broker as a client
     port = "9800"
     context = zmq.Context()
-    socket = context.socket(zmq.REQ)
+    socket = context.socket(zmq.DEALER)
     socket.connect("tcp://localhost:%s" % port)
 
-    print "Sending request:'{}'".format(" ".join(sys.argv[1:]))
-    socket.send(" ".join(sys.argv[1:]))
+    target, command = sys.argv[1:3]
+    device = sys.argv[3] if len(sys.argv) > 3 else b''
+    body = [command, device] + sys.argv[4:]
+
+    print "Sending request to {}:'{}'".format(target, body)
+    socket.send_multipart([protocol.VERSION, b'0', target, b'0', protocol.pack(body)])
 
-    message = socket.recv_multipart()
-    print "Received reply:'{}'".format(message)
+    _, _, status, payload = socket.recv_multipart()
+    print "Received reply:'{}' {}".format(status, protocol.unpack(payload))
 
 
 if __name__=="__main__": main()
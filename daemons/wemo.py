@@ -1,88 +1,575 @@
 #!/usr/bin/env python
+# The switches are driven through blocking `requests` calls, which have to
+# yield to the other greenlets while they wait
+from gevent import monkey
+monkey.patch_all()
+
 import zmq.green as zmq
 #import zmq
+import os
+import sys
+import json
+import time
+import argparse
+import urlparse
+import collections
+
+# Make the shared kasa modules importable (before ouimeaux, which resets
+# __main__.__file__)
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from devices import protocol
+from devices.jsonfile import load_json, save_json
+
 import ouimeaux
 import gevent
 from gevent import Greenlet
+from gevent.lock import Semaphore
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from ouimeaux.environment import Environment, UnknownDevice
+from ouimeaux.device.insight import Insight
+from ouimeaux.signals import discovered, devicefound, statechange
+
+# Target that the clients address this daemon with
+SERVICE = b"WeMo"
+
+# Requests handled at the same time, and seconds a command may take (an
+# unreachable switch would otherwise be retried for minutes)
+POOL_SIZE = 16
+COMMAND_TIMEOUT = 10
+# Seconds each switch gets in the commands on many switches, which answer
+# with what they have by then
+SWITCH_TIMEOUT = COMMAND_TIMEOUT / 2
+
+# Where the switches found so far are kept, for the next start
+CACHE_FILE = os.path.expanduser('~/.kasa/wemo-switches.json')
+# Seconds after which a switch that stopped answering is forgotten
+CACHE_EXPIRY = 7 * 24 * 3600
 
-from ouimeaux.environment import Environment
-from ouimeaux.signals import discovered, devicefound
+# Bounds of the time between two rounds of discovery
+MIN_DISCOVERY_INTERVAL = 30
+MAX_DISCOVERY_INTERVAL = 600
+
+# Seconds between two power readings of the Insight switches
+POWER_INTERVAL = 10
+
+def make_environment(**kwargs):
+    '''
+    ouimeaux Environment that receives the events of the switches
+
+    ouimeaux binds its event server to '', which recent versions of gevent
+    open as a dual-stack IPv6 socket. The switches then connect from
+    IPv4-mapped addresses (::ffff:a.b.c.d) that ouimeaux doesn't match to
+    any switch, and drops their events, so bind the server to IPv4.
+    '''
+    env = Environment(with_subscribers=True, **kwargs)
+    registry = env.registry
+    registry._server = WSGIServer(('0.0.0.0', registry.port), registry._handle, log=None)
+    return env
 
 def discovered_wemo(**kwargs):
     print "Discovered something"
     print kwargs
 
+class SwitchDirectory(object):
+    '''
+    The switches that were discovered so far, saved in `path`
+
+    Every switch has the location of its setup.xml (host and port), its
+    UDN, and the last time it answered. A restarted daemon lists the saved
+    switches right away, and `restore` sets them up in the ouimeaux
+    environment without waiting for them to answer a discovery. Switches
+    that have not answered for `expiry` seconds are forgotten.
+    '''
+    def __init__(self, path=CACHE_FILE, expiry=CACHE_EXPIRY):
+        self.path = path
+        self.expiry = expiry
+        self.switches = load_json(path, {})
+
+        # Discovery answers, and switches set up, by host. The environment
+        # sets up a switch as soon as it answers, so the two signals can
+        # come in either order
+        self._answers = {}
+        self._found_devices = {}
+        discovered.connect(self._discovered, weak=False)
+        devicefound.connect(self._found, weak=False)
+
+    def save(self):
+        save_json(self.path, self.switches)
+
+    def names(self):
+        return self.switches.keys()
+
+    def _discovered(self, sender, **kwargs):
+        # (The host of the location, as the answer may come from elsewhere)
+        host = urlparse.urlsplit(kwargs['headers']['location']).hostname
+        self._answers[host] = kwargs['headers']
+        self._record(host)
+
+    def _found(self, sender, **kwargs):
+        self._found_devices[sender.host] = sender
+        self._record(sender.host)
+
+    def _record(self, host):
+        '''
+        Remember where the switch at `host` is, once it answered and was set
+        up. (The file is saved once per discovery round, by `check`, and once
+        the restore is over, rather than for every switch.)
+        '''
+        if host not in self._answers or host not in self._found_devices:
+            return
+        headers = self._answers.pop(host)
+        device = self._found_devices.pop(host)
+
+        location = urlparse.urlsplit(headers['location'])
+        self.switches[device.name] = {'location': headers['location'],
+                                      'host': location.hostname,
+                                      'port': location.port,
+                                      'udn': headers['usn'].split('::')[0],
+                                      'last_seen': time.time()}
+
+    def restore(self, env, timeout=SWITCH_TIMEOUT):
+        ''' Set up the saved switches in `env`, as if they had answered a discovery '''
+        def restore_one(name, switch):
+            headers = {'location': switch['location'], 'usn': switch['udn']}
+            try:
+                with gevent.Timeout(timeout, False):
+                    discovered.send(env.upnp, address=(switch['host'], switch['port']),
+                                    headers=headers)
+            except Exception as e:
+                print "Could not restore saved switch '{}': {}".format(name, e)
+                return
+            if name in env.devices:
+                # Discovery only reports the locations it hasn't seen yet
+                env.upnp.clients[switch['location']] = headers
+            else:
+                print "Saved switch '{}' is not answering".format(name)
+
+        def save_when_restored(greenlets):
+            gevent.joinall(greenlets)
+            self.save()
+
+        greenlets = [gevent.spawn(restore_one, name, switch)
+                     for name, switch in self.switches.items()]
+        gevent.spawn(save_when_restored, greenlets)
+
+    def check(self, env, timeout=SWITCH_TIMEOUT):
+        '''
+        Ask every switch set up in `env` for its state, forget the ones that
+        stopped answering long ago. Returns the names of the switches that
+        did not answer.
+        '''
+        now = time.time()
+        results = each(env.list_switches(),
+                       lambda name: env.get_switch(name).get_state(force_update=True),
+                       timeout)
+        missing = set()
+        for name, result in results.items():
+            if name not in self.switches:
+                continue
+            if isinstance(result, BaseException):
+                missing.add(name)
+            else:
+                self.switches[name]['last_seen'] = now
+
+        for name, switch in self.switches.items():
+            if switch['last_seen'] < now - self.expiry:
+                print "Forgetting switch '{}'".format(name)
+                del self.switches[name]
+                # Let discovery report it again if it comes back
+                env.upnp.clients.pop(switch['location'], None)
+        self.save()
+        return missing
+
 class BackgroundDiscovery(Greenlet):
     '''
     Greenlet that runs in the background and continuously updates
 
-    Pass in the ouimeaux environment, and a polling interval
+    Every round looks for new switches, and checks that the known ones
+    still answer. Rounds get further apart while nothing changes, and
+    come back to `min_interval` when a switch appears or goes missing.
     '''
-    def __init__(self, env, interval=60):
+    def __init__(self, env, directory,
+                 min_interval=MIN_DISCOVERY_INTERVAL, max_interval=MAX_DISCOVERY_INTERVAL):
         Greenlet.__init__(self)
         self.env = env
-        self.interval = interval
+        self.directory = directory
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
 
     def _run(self):
         while True:
+            known = set(self.directory.names())
             self.env.discover()
+            missing = self.directory.check(self.env)
+            new = set(self.directory.names()) - known
+
+            if new or missing:
+                print "New switches: {}, missing switches: {}".format(list(new), list(missing))
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
             gevent.sleep(self.interval)
 
-def main():
+class Rollup(object):
+    '''
+    Average, minimum and maximum of a value over consecutive windows of
+    `period` seconds, for the last `keep` windows
+    '''
+    def __init__(self, period, keep):
+        self.period = period
+        self.windows = collections.deque(maxlen=keep)
+
+    def add(self, t, value):
+        start = t - t % self.period
+        if not self.windows or self.windows[-1]['start'] != start:
+            self.windows.append({'start': start, 'samples': 0, 'sum': 0.,
+                                 'min': value, 'max': value})
+        window = self.windows[-1]
+        window['samples'] += 1
+        window['sum'] += value
+        window['min'] = min(window['min'], value)
+        window['max'] = max(window['max'], value)
+
+    def as_list(self):
+        ''' The windows, oldest first, the last one still being filled '''
+        return [{'start': w['start'],
+                 'samples': w['samples'],
+                 'avg': w['sum'] / w['samples'],
+                 'min': w['min'],
+                 'max': w['max']} for w in self.windows]
+
+class PowerMonitor(Greenlet):
+    '''
+    Greenlet that reads the power use of the Insight switches every
+    `interval` seconds
+
+    All the Insights are read at once, so that a large install doesn't
+    stretch the interval. The latest reading of each switch is kept, along
+    with the 1 minute rollups of the last hour and the 1 hour rollups of
+    the last day of its power (in W). `on_reading(name, reading)` is called
+    with every reading.
+    '''
+    def __init__(self, env, on_reading, interval=POWER_INTERVAL):
+        Greenlet.__init__(self)
+        self.env = env
+        self.on_reading = on_reading
+        self.interval = interval
+        self.latest = {}
+        self.rollups = {}
+
+    def insights(self):
+        return [name for name in self.env.list_switches()
+                if isinstance(self.env.get_switch(name), Insight)]
+
+    def sample(self):
+        now = time.time()
+        results = each(self.insights(),
+                       lambda name: self.env.get_switch(name).insight_params,
+                       self.interval)
+        for name, params in results.items():
+            if isinstance(params, BaseException):
+                continue
+            reading = {'time': now,
+                       'power': params['currentpower'] / 1e3,
+                       # The Insights count energy in mW.min
+                       'today_kwh': params['todaymw'] / 6e7,
+                       'total_kwh': params['totalmw'] / 6e7}
+            self.latest[name] = reading
+            if name not in self.rollups:
+                self.rollups[name] = {'1m': Rollup(60, 60), '1h': Rollup(3600, 24)}
+            for rollup in self.rollups[name].values():
+                rollup.add(now, reading['power'])
+            self.on_reading(name, reading)
+
+    def _run(self):
+        next_sample = time.time()
+        while True:
+            self.sample()
+            # Keep the schedule, however long the readings took
+            next_sample = max(next_sample + self.interval, time.time())
+            gevent.sleep(next_sample - time.time())
+
+class StateTable(object):
+    '''
+    Last known state ('on' or 'off') of every switch
+
+    The switches send a UPnP event whenever their state changes, whoever
+    changed it (the switch button, the WeMo app...), and when we subscribe
+    to them. The table follows these events, so that state requests don't need to ask
+    the switch. `on_change(name, state)` is called when a state changes.
+    '''
+    def __init__(self, on_change):
+        self.states = {}
+        self.on_change = on_change
+        statechange.connect(self._state_changed, weak=False)
+
+    def _state_changed(self, sender, **kwargs):
+        self.set(sender.name, 'on' if kwargs['state'] else 'off')
+
+    def get(self, name):
+        ''' State of the switch `name`, None if not known yet '''
+        return self.states.get(name)
+
+    def set(self, name, state):
+        ''' Record the state of a switch '''
+        if self.states.get(name) != state:
+            self.states[name] = state
+            self.on_change(name, state)
+
+class Heartbeat(Greenlet):
+    '''
+    Greenlet that keeps the broker informed that we are alive
+
+    Pass in the function that sends a message to the broker
+    '''
+    def __init__(self, send):
+        Greenlet.__init__(self)
+        self.send = send
+
+    def _run(self):
+        while True:
+            gevent.sleep(protocol.HEARTBEAT_INTERVAL)
+            self.send(protocol.control(protocol.W_HEARTBEAT, SERVICE))
+
+def each(names, fn, timeout=SWITCH_TIMEOUT):
+    '''
+    Run `fn(name)` for all the switches in `names` at once
+
+    Returns a dict with the result for every name, or the exception it
+    raised (gevent.Timeout if it did not finish in `timeout` seconds).
+    '''
+    def run(name):
+        try:
+            return fn(name)
+        except Exception as e:
+            return e
+
+    greenlets = dict((name, gevent.spawn(run, name)) for name in names)
+    gevent.joinall(greenlets.values(), timeout=timeout)
+
+    results = {}
+    for name, g in greenlets.items():
+        if g.ready():
+            results[name] = g.value
+        else:
+            g.kill(block=False)
+            results[name] = gevent.Timeout(timeout)
+    return results
+
+def handle(env, states, body, switch_timeout=SWITCH_TIMEOUT, directory=None, power=None):
+    '''
+    Run the request in `body`, return the status and payload frames of the reply
+
+    Commands on many switches give each switch `switch_timeout` seconds.
+    `list` answers with the switches of `directory` if given, which includes
+    the saved ones that were not set up yet. The power commands answer from
+    the readings of the PowerMonitor `power`.
+    '''
+    fields = protocol.unpack(body)
+    command, switch_name, args = fields[0], fields[1], fields[2:]
+
+    def get_state(name, fresh):
+        ''' 'on' or 'off', from the state table unless `fresh` '''
+        st = states.get(name)
+        if st is None or fresh:
+            st = 'on' if env.get_switch(name).get_state(force_update=True) else 'off'
+            states.set(name, st)
+        return st
+
+    def set_state(name, st):
+        switch = env.get_switch(name)
+        if st == 'on':
+            switch.on()
+        elif st == 'off':
+            switch.off()
+        else:
+            raise ValueError("Unknown state '{}'".format(st))
+        states.set(name, st)
+        return st
+
+    # General commands
+    if command == 'list':
+        # Send the current set of devices (only switches supported)
+        names = directory.names() if directory is not None else env.list_switches()
+        return protocol.ok_reply(*names)
+
+    elif command == 'state_all':
+        # [name, state, name, state...], 'unknown' for the switches that
+        # could not be asked
+        results = each(env.list_switches(), lambda name: get_state(name, 'fresh' in args),
+                       switch_timeout)
+        reply = []
+        for name, st in sorted(results.items()):
+            reply.extend([name, st if not isinstance(st, BaseException) else 'unknown'])
+        return protocol.ok_reply(*reply)
+
+    elif command == 'set_many':
+        # The arguments are [name, state, name, state...], the reply is
+        # [name, result...] with the new state, or what went wrong
+        if len(args) % 2:
+            return protocol.error_reply("set_many takes pairs of switch and state")
+        wanted = dict(zip(args[::2], args[1::2]))
+        results = each(wanted, lambda name: set_state(name, wanted[name]), switch_timeout)
+        reply = []
+        for name, result in sorted(results.items()):
+            if isinstance(result, UnknownDevice):
+                result = "Unknown switch '{}'".format(name)
+            elif isinstance(result, gevent.Timeout):
+                result = "No answer from the switch"
+            elif isinstance(result, BaseException):
+                result = "Failed: {}".format(result)
+            reply.extend([name, result])
+        return protocol.ok_reply(*reply)
+
+    # Commands on objects
+    try:
+        env.get_switch(switch_name)
+    except UnknownDevice:
+        if directory is not None and switch_name in directory.names():
+            return protocol.error_reply("Switch '{}' is not answering".format(switch_name))
+        return protocol.error_reply("Unknown switch '{}'".format(switch_name))
+
+    if command == 'power':
+        # [power in W, energy today in kWh, energy in total in kWh, time]
+        reading = power.latest.get(switch_name) if power is not None else None
+        if reading is None:
+            return protocol.error_reply("No power readings for '{}'".format(switch_name))
+        # (repr, as str would round the time to the 1/100 s)
+        return protocol.ok_reply(*[repr(reading[field]) for field in
+                                   ('power', 'today_kwh', 'total_kwh', 'time')])
+    elif command == 'power_rollups':
+        # The rollups as a JSON object, by period
+        rollups = power.rollups.get(switch_name) if power is not None else None
+        if rollups is None:
+            return protocol.error_reply("No power readings for '{}'".format(switch_name))
+        return protocol.ok_reply(json.dumps(dict((period, rollup.as_list())
+                                                 for period, rollup in rollups.items())))
+    elif command in ('on', 'off'):
+        set_state(switch_name, command)
+        return protocol.ok_reply()
+    elif command == 'state':
+        # Answer from the state table, unless asked to query the switch
+        return protocol.ok_reply(get_state(switch_name, 'fresh' in args))
+    else:
+        return protocol.error_reply("Unknown command '{}'".format(command))
+
+def serve(socket, send, handler, pool_size=POOL_SIZE, timeout=COMMAND_TIMEOUT):
+    '''
+    Answer the requests that arrive on `socket` with `handler(body)`
+
+    Every request runs in a greenlet of its own, and is answered as soon as
+    it is done, so that a slow switch only holds up its own requests. Up to
+    `pool_size` requests run at once, the next ones wait in the socket.
+    Requests that take more than `timeout` seconds are answered with an error.
+    '''
+    pool = Pool(pool_size)
+
+    def run(client_addr, body):
+        try:
+            with gevent.Timeout(timeout):
+                reply = handler(body)
+        except gevent.Timeout:
+            reply = protocol.error_reply("No answer from the switch after {} s".format(timeout))
+        except Exception as e:
+            reply = protocol.error_reply("Failed: {}".format(e))
+        send([client_addr] + reply)
+
+    while True:
+        # Get the outside message in several parts
+        # Store the client_addr
+        client_addr, body = socket.recv_multipart()
+        print "Received request {} from '{}'".format(protocol.peek(body), client_addr)
+
+        # Waits for a free greenlet if the pool is full
+        pool.spawn(run, client_addr, body)
+
+def locked_send(socket):
+    '''
+    Function that sends a multipart message on `socket`, one greenlet at a time
+
+    The greenlets share the socket: a greenlet can be switched out in the
+    middle of a multipart message, so only one may send at a time.
+    '''
+    lock = Semaphore()
+    def send(frames):
+        with lock:
+            socket.send_multipart(frames)
+    return send
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Kasa WeMo daemon")
+    parser.add_argument('--power-interval', type=float, default=POWER_INTERVAL,
+                        help="seconds between two power readings of the Insight "
+                             "switches, 0 to not read them (default: {})".format(POWER_INTERVAL))
+    parser.add_argument('--ssdp', metavar='HOST:PORT',
+                        help="send the discovery requests there rather than to the "
+                             "SSDP multicast group, e.g. 127.0.0.1:19000 for "
+                             "benchmarks/fake_wemo.py")
+    parser.add_argument('--switch-cache', default=CACHE_FILE,
+                        help="where the switches found are saved (default: {})".format(CACHE_FILE))
+    return parser.parse_args(argv)
+
+def main(argv=None):
     '''
     Server routine
     '''
+    args = parse_args(argv)
     port = "9801"
     context = zmq.Context.instance()
 
     # Receive input from the outside world
     socket = context.socket(zmq.DEALER)
-    # Specify unique identity
-    socket.setsockopt(zmq.IDENTITY, b"WeMo")
+    # Specify unique identity, other instances may serve the same devices
+    socket.setsockopt(zmq.IDENTITY, protocol.worker_identity(SERVICE))
     socket.connect("tcp://127.0.0.1:%s" % port)
 
-    print "Ready to receive"
+    send = locked_send(socket)
+
+    # Register with the broker, and keep sending heartbeats
+    send(protocol.control(protocol.W_READY, SERVICE))
+    Heartbeat(send).start()
+
+    # Publish the state of the switches on the telemetry bus
+    telemetry = context.socket(zmq.PUB)
+    telemetry.connect("tcp://127.0.0.1:{}".format(protocol.TELEMETRY_PUBLISH_PORT))
+
+    def publish_state(switch_name, state):
+        protocol.publish(telemetry, protocol.topic('WeMo', switch_name, 'state'), state)
 
-    # Where we will store references to the worker threads
-    worker_sockets = {}
+    # State changes are pushed to the clients on the telemetry bus
+    states = StateTable(publish_state)
 
-    # Start the ouimeaux environment for discovery
-    env = Environment(with_subscribers = False, with_discovery=True, with_cache=False)
+    print "Ready to receive"
+
+    # Start the ouimeaux environment for discovery, and to receive the
+    # events of the switches
+    env = make_environment(with_discovery=True)
+    if args.ssdp:
+        host, _, ssdp_port = args.ssdp.rpartition(':')
+        env.upnp.mcast_ip = host
+        env.upnp.mcast_port = int(ssdp_port)
     env.start()
     discovered.connect(discovered_wemo)
 
-    # Run the polling mechanism in the background
-    BackgroundDiscovery(env).start()
+    # Start with the switches of the last run, then look for changes in
+    # the background
+    directory = SwitchDirectory(args.switch_cache)
+    directory.restore(env)
+    BackgroundDiscovery(env, directory).start()
 
-    while True:
-        # Get the outside message in several parts
-        # Store the client_addr
-        client_addr, _, msg = socket.recv_multipart()
-        print "Received request {} from '{}'".format(msg, client_addr)
-        msg = msg.split(' ')
-
-        command = msg[0]
-
-        # General commands
-        if command == 'list':
-            # Send the current set of devices (only switches supported)
-            socket.send_multipart([client_addr, b'', ",".join(env.list_switches())])
-            continue
-
-        # Commands on objects
-        switch_name = msg[1]
-        print switch_name
-        s = env.get_switch(switch_name)
-
-        if command == 'on':
-            s.on()
-            socket.send_multipart([client_addr, b'', 'OK'])
-        elif command == 'off':
-            s.off()
-            socket.send_multipart([client_addr, b'', 'OK'])
-        elif command == 'state':
-            st = s.get_state()
-            st = 'on' if st else 'off'
-            socket.send_multipart([client_addr, b'', st])
+    # Stream the power use of the Insights
+    power = None
+    if args.power_interval > 0:
+        def publish_power(switch_name, reading):
+            protocol.publish(telemetry, protocol.topic('WeMo', switch_name, 'power'),
+                             repr(reading['power']), repr(reading['today_kwh']))
+        power = PowerMonitor(env, publish_power, args.power_interval)
+        power.start()
+
+    serve(socket, send,
+          lambda body: handle(env, states, body, directory=directory, power=power))
 
 if __name__=="__main__": main()
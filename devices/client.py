@@ -0,0 +1,288 @@
+'''
+Kasa broker client
+
+A single, long-lived DEALER connection to the broker that is shared by every
+device driver in the process. Each request is tagged with an id, so any number
+of threads can have requests in flight at the same time over the one socket.
+
+ZMQ sockets are not thread safe, so the broker connection is owned by a
+background I/O thread. Every calling thread talks to it through its own inproc
+socket, and the I/O thread routes each reply back to the thread that is
+waiting for it.
+
+(c) 2014 Berk Birand
+'''
+import zmq
+import os
+import json
+import time
+import threading
+import itertools
+
+import protocol
+
+BROKER_URL = "tcp://localhost:9800"
+
+# Seconds to wait for a reply before giving up
+DEFAULT_TIMEOUT = 30
+
+# Extra seconds to wait for a batch, which the broker answers at its deadline
+# with the items it has by then
+BATCH_GRACE = 1
+
+class BrokerError(IOError):
+    ''' The broker could not deliver a request or its reply '''
+
+class BrokerTimeout(BrokerError):
+    ''' No reply was received within the timeout '''
+
+class BrokerBusy(BrokerError):
+    ''' The target has too many requests queued, try again later '''
+
+def reply_error(status, payload):
+    ''' The exception for a reply with an error `status` '''
+    message = " ".join(payload)
+    if status == protocol.BUSY:
+        return BrokerBusy(message)
+    if message.startswith("Deadline passed"):
+        return BrokerTimeout(message)
+    return BrokerError(message)
+
+class BrokerClient(object):
+    '''
+    Multiplexed connection to the broker
+
+    Use `get_client()` rather than creating instances directly, so that the
+    process shares a single connection.
+    '''
+
+    def __init__(self, url=BROKER_URL, context=None):
+        self.url = url
+        self.context = context or zmq.Context.instance()
+
+        self._ids = itertools.count()
+        self._local = threading.local()
+        self._inproc_url = "inproc://kasa-client-{}".format(id(self))
+
+        # The inproc endpoint must be bound before the callers connect
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._io_loop, args=(ready,),
+                                        name="KasaBrokerClient")
+        self._thread.daemon = True
+        self._thread.start()
+        ready.wait()
+
+    def _caller_socket(self):
+        ''' Return the inproc socket of the calling thread, and its poller '''
+        sock = getattr(self._local, 'socket', None)
+        if sock is None:
+            sock = self.context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self._inproc_url)
+            self._local.socket = sock
+            self._local.poller = zmq.Poller()
+            self._local.poller.register(sock, zmq.POLLIN)
+        return sock, self._local.poller
+
+    def request(self, target, command, device=b'', args=(), timeout=DEFAULT_TIMEOUT, ttl=None):
+        ''' Send `command` for `device` to `target`, and return the reply payload
+
+        `args` is a list of strings, packed into the request body. The
+        payload is returned as a list of strings as well.
+
+        Blocks the calling thread only; other threads can send requests
+        while this one is waiting.
+        Raises BrokerTimeout if no reply arrives within `timeout` seconds,
+        BrokerBusy if the target is overloaded, and BrokerError if the broker
+        or the worker could not carry out the request.
+
+        The broker drops the request if it is still queued after `ttl`
+        seconds, which defaults to the timeout.
+        '''
+        req_id = str(next(self._ids))
+        sock, p = self._caller_socket()
+
+        if ttl is None:
+            ttl = timeout
+        ttl = b'0' if ttl is None else str(int(ttl * 1e3))
+        sock.send_multipart([req_id, target, ttl,
+                             protocol.pack([command, device] + list(args))])
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            remaining = None if deadline is None else max(deadline - time.time(), 0) * 1e3
+            if not p.poll(remaining):
+                # Tell the I/O thread to forget about the request
+                sock.send_multipart([req_id])
+                raise BrokerTimeout("No reply from {} for '{}'".format(target, command))
+
+            reply_id, status, payload = sock.recv_multipart()
+            # Skip late replies to requests of this thread that timed out
+            if reply_id != req_id:
+                continue
+
+            payload = protocol.unpack(payload)
+            if status != protocol.OK:
+                raise reply_error(status, payload)
+            return payload
+
+    def batch(self, requests, timeout=DEFAULT_TIMEOUT):
+        ''' Send many requests at once, and return their results in the same order
+
+        `requests` is a list of (target, command, device, args) tuples, where
+        `device` and `args` may be left out. The broker sends them to the
+        workers in parallel, so the whole batch takes about as long as its
+        slowest request.
+
+        The result of each request is its payload, or the BrokerError it
+        failed with (a BrokerTimeout if it wasn't answered within `timeout`
+        seconds): one failed request doesn't fail the others.
+        '''
+        items = []
+        for r in requests:
+            target, command = r[:2]
+            device = r[2] if len(r) > 2 else b''
+            args = list(r[3]) if len(r) > 3 else []
+            items.append(protocol.pack([target, command, device] + args))
+
+        # The broker answers at the timeout with what it has, wait a bit longer
+        # so that the partial results get here
+        wait = None if timeout is None else timeout + BATCH_GRACE
+        replies = self.request(protocol.BROKER, protocol.B_BATCH, args=items,
+                               timeout=wait, ttl=timeout)
+
+        results = []
+        for item in replies:
+            item = protocol.unpack(item)
+            status, payload = item[0], item[1:]
+            results.append(payload if status == protocol.OK else reply_error(status, payload))
+        return results
+
+    def _io_loop(self, ready):
+        ''' Owns the broker connection: forwards requests and routes replies '''
+        callers = self.context.socket(zmq.ROUTER)
+        callers.bind(self._inproc_url)
+
+        broker = self.context.socket(zmq.DEALER)
+        broker.setsockopt(zmq.LINGER, 0)
+        broker.connect(self.url)
+        ready.set()
+
+        # Address of the calling thread for every request in flight
+        pending = {}
+
+        p = zmq.Poller()
+        p.register(callers, zmq.POLLIN)
+        p.register(broker, zmq.POLLIN)
+
+        while True:
+            socks = dict(p.poll())
+
+            if callers in socks:
+                frames = callers.recv_multipart()
+                caller, req_id = frames[:2]
+                if len(frames) == 2:
+                    # Request id given up on by the caller
+                    pending.pop(req_id, None)
+                else:
+                    pending[req_id] = caller
+                    broker.send_multipart([protocol.VERSION] + frames[1:])
+
+            if broker in socks:
+                # Pass the status and payload on to the caller
+                _, req_id, status, payload = broker.recv_multipart()
+                caller = pending.pop(req_id, None)
+                if caller is not None:
+                    callers.send_multipart([caller, req_id, status, payload])
+
+# Process-wide client, created on first use
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_client():
+    ''' Return the client shared by the whole process '''
+    global _client, _client_pid
+
+    with _client_lock:
+        # Do not reuse a connection inherited through fork()
+        if _client is None or _client_pid != os.getpid():
+            _client = BrokerClient()
+            _client_pid = os.getpid()
+        return _client
+
+def request(target, command, device=b'', args=(), timeout=DEFAULT_TIMEOUT):
+    ''' Send a request through the shared client and return the reply payload '''
+    return get_client().request(target, command, device, args, timeout)
+
+def broker_stats(timeout=DEFAULT_TIMEOUT):
+    ''' Traffic statistics of the broker, per target (see `protocol.B_STATS`) '''
+    snapshot, = request(protocol.BROKER, protocol.B_STATS, timeout=timeout)
+    return json.loads(snapshot)
+
+class BatchResult(object):
+    ''' Placeholder for the result of a request in a `Batch` '''
+
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def get(self):
+        ''' The payload of the reply, raises the error if the request failed '''
+        if not self.done:
+            raise RuntimeError("The batch hasn't been sent yet")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class Batch(object):
+    '''
+    Collects requests to send them as a single batch, e.g.
+
+        with Batch() as b:
+            kitchen = b.request('WeMo', 'state', 'Kitchen')
+            lamp = b.request('WeMo', 'state', 'Lamp')
+        print kitchen.get(), lamp.get()
+
+    The requests are sent when the `with` block ends (or on `send()`).
+    '''
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, client=None):
+        self.timeout = timeout
+        self.client = client
+        self._requests = []
+        self._results = []
+
+    def request(self, target, command, device=b'', args=()):
+        ''' Add a request to the batch, returns its BatchResult '''
+        result = BatchResult()
+        self._requests.append((target, command, device, args))
+        self._results.append(result)
+        return result
+
+    def send(self):
+        ''' Send the requests collected so far '''
+        requests, results = self._requests, self._results
+        self._requests, self._results = [], []
+
+        client = self.client or get_client()
+        for result, value in zip(results, client.batch(requests, self.timeout)):
+            if isinstance(value, BrokerError):
+                result.error = value
+            else:
+                result.value = value
+            result.done = True
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.send()
+
+def batch(requests, timeout=DEFAULT_TIMEOUT):
+    ''' Send a batch through the shared client, see `BrokerClient.batch` '''
+    return get_client().batch(requests, timeout)
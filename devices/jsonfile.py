@@ -0,0 +1,30 @@
+'''
+JSON files that the daemons keep their state in between runs
+
+(c) 2014 Berk Birand
+'''
+import os
+import json
+
+def load_json(path, default=None):
+    ''' The contents of the JSON file at `path`, `default` if it is missing or unreadable '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+def save_json(path, data):
+    '''
+    Write `data` to the JSON file at `path`, creating its directory if needed
+
+    The file is replaced rather than rewritten, so that a crash never leaves
+    half of it, and its readers never see half of it either.
+    '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
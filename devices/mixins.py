@@ -5,6 +5,7 @@ Utility mixins for the sensor classes
 '''
 
 from threads import RegularStoppableThread
+from telemetry import subscribe
 
 class RegularUpdateMixin(object):
     ''' Mixin that adds regular update capabilities
@@ -103,3 +104,38 @@ class RegularUpdateMixin(object):
 
         def loop(self):
             self.obj.read()
+
+class TelemetryMixin(object):
+    ''' Mixin that updates `value` from the telemetry bus instead of polling
+    A class that extends this mixin must have a `._topic()` method that returns
+    the telemetry topic of its reading. When used, this mixin adds the
+    following methods:
+
+    - listen():
+      Updates `value` whenever the daemon publishes a new reading, whoever
+      asked for it
+
+    - stop_listening():
+      Stops the updates
+
+    By default the reading is a single float, override `_parse_reading` for
+    other kinds of values.
+    '''
+    _subscription = None
+
+    def listen(self):
+        ''' Start updating `value` from the telemetry bus '''
+        if self._subscription is None:
+            self._subscription = subscribe(self._topic(), self._on_reading)
+
+    def stop_listening(self):
+        ''' Stop updating `value` from the telemetry bus '''
+        if self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+
+    def _parse_reading(self, values):
+        return float(values[0])
+
+    def _on_reading(self, topic, values):
+        self.value = self._parse_reading(values)
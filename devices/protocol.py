@@ -0,0 +1,187 @@
+'''
+Messages shared by the broker, the daemons and the clients
+
+Requests and replies are multipart messages. The broker routes on the
+routing frames, and the rest of the request travels as a single body frame
+that the broker passes on untouched. It only peeks at the command and the
+device at the start of the body (see `peek`), to send the requests for a
+device to the same worker and to share the replies of identical reads,
+without decoding the rest. The body is a JSON array of strings, so no hop
+has to split or re-join strings, and values may contain spaces. (Every frame
+costs a round of socket calls in each process on the way, so the body is
+packed into one frame instead of a frame per field.)
+
+Clients send requests to the broker from a DEALER socket as
+
+    [VERSION, req_id, target, ttl, body]    body: [command, device, arg1, ...]
+
+where `device` is empty for commands that don't address a device, and `ttl`
+is the number of milliseconds the client is willing to wait for the reply
+(0 for no limit). The broker routes on `target`, and hands the body to the
+worker with a token that identifies the request:
+
+    [token, body]
+
+Workers reply with a status frame, followed by the payload (a JSON array of
+strings as well)
+
+    [token, status, payload]
+
+and the broker passes them back to the client as
+
+    [VERSION, req_id, status, payload]
+
+Workers (the device daemons) also send control messages as
+[b'', VERSION, command, service]:
+
+- W_READY: sent once after connecting, registers the worker
+- W_HEARTBEAT: sent every HEARTBEAT_INTERVAL seconds
+
+where `service` is the target that the worker serves. Several workers can
+serve the same target (e.g. one per Bluetooth adapter), as long as their
+socket identities differ (see `worker_identity`). The broker sends the
+requests for a device to the worker that got its first request, and spreads
+the other devices over the least loaded workers.
+
+The broker considers a worker dead when it hasn't heard from it for
+HEARTBEAT_LIVENESS intervals. Requests to dead or unknown workers are
+answered right away with an ERROR status.
+
+The broker only sends a limited number of requests to a worker at a time, and
+queues the others. Requests that are still queued when their ttl runs out are
+answered with an ERROR, and so are the requests sent to a worker that doesn't
+answer them by then (a reply that comes later is dropped). Requests that don't
+fit in the queue anymore get a BUSY status: the target is overloaded, and the
+client should back off.
+
+Besides requests, the broker hosts a telemetry bus: daemons connect a PUB (or
+XPUB) socket to TELEMETRY_PUBLISH_PORT and publish readings and state changes
+as
+
+    [topic, payload]    topic: <target>/<device>/<name>
+
+e.g. `SensorTag/BC:6A:29:AB:D3:7A/temperature`, where the payload is a JSON
+array of strings like the reply payloads. Clients subscribe with a SUB socket
+connected to TELEMETRY_SUBSCRIBE_PORT. Subscriptions are passed on to the
+daemons, so that a daemon with an XPUB socket can start producing a reading
+when someone is listening for it.
+
+Reads in IDEMPOTENT_COMMANDS have no side effects, so the broker may answer
+several identical reads that are in flight at the same time with a single
+reply of the worker.
+
+The BROKER target is reserved for the broker itself, which answers
+
+- B_STATS: request counts, in-flight requests, errors and latency
+  percentiles per target, as a single JSON object in the payload
+- B_BATCH: carries many requests, each as a packed
+  [target, command, device, arg1, ...] in place of the arguments. The
+  broker sends them on to their workers at the same time, and replies once
+  all of them are answered (or the ttl runs out) with a packed
+  [status, value1, ...] per item, in the same order
+
+(c) 2014 Berk Birand
+'''
+import os
+import json
+from socket import gethostname
+
+# Bumped on every incompatible change of the frame layout
+VERSION = b'KASA03'
+
+# Reply status
+OK = b'OK'
+ERROR = b'ERROR'
+BUSY = b'BUSY'
+
+# Worker control commands
+W_READY = b'READY'
+W_HEARTBEAT = b'HEARTBEAT'
+
+# Commands that only read a value, and can share their reply with identical
+# requests. Anything that changes a device (on, off, enable...) must not be here
+IDEMPOTENT_COMMANDS = frozenset([
+    'list', 'state', 'state_all', 'power', 'power_rollups',     # WeMo
+    'active', 'read',                                           # GATT
+    'readIrTemperature', 'readHumidity', 'readBarometricPressure',
+    'readMagnetometer', 'readAccelerometer', 'readGyroscope',
+    'snapshot',                                                 # SensorTag
+])
+
+# Target of the requests to the broker itself, and its commands
+BROKER = b'broker'
+B_STATS = b'stats'
+B_BATCH = b'batch'
+
+# Ports of the telemetry bus, for the publishers and for the subscribers
+TELEMETRY_PUBLISH_PORT = 9802
+TELEMETRY_SUBSCRIBE_PORT = 9803
+
+# Seconds between heartbeats
+HEARTBEAT_INTERVAL = 1.0
+
+# Number of missed heartbeats after which a worker is dead
+HEARTBEAT_LIVENESS = 3
+
+def pack(fields):
+    ''' Encode a list of strings into a body or payload frame '''
+    return json.dumps(fields, separators=(',', ':'))
+
+def unpack(frame):
+    ''' Decode a body or payload frame into a list of (byte) strings '''
+    return [f.encode('utf-8') for f in json.loads(frame)]
+
+def peek(body):
+    '''
+    The command and the device of the request `body`, without decoding all of
+    it. Both are empty if the body is malformed, the worker will complain.
+    Any valid JSON spelling of the body works, e.g. with spaces after the
+    separators, as long as it is an array of strings.
+    '''
+    # Without escaped characters, the strings simply end at the next quote:
+    # the body is then ["command", "device"... with only whitespace
+    # around the bracket and the comma
+    if '\\' not in body:
+        parts = body.split('"', 4)
+        if len(parts) > 3 and parts[0].strip() == '[' and parts[2].strip() == ',':
+            return parts[1], parts[3]
+    if not body.lstrip().startswith('['):
+        return b'', b''
+    try:
+        fields = unpack(body)
+        return fields[0], fields[1] if len(fields) > 1 else b''
+    except (ValueError, IndexError, TypeError, AttributeError):
+        return b'', b''
+
+def is_idempotent(body):
+    ''' Whether the request `body` is a read in IDEMPOTENT_COMMANDS '''
+    # (Whatever priority the command gives after a colon, e.g. 'read:poll')
+    return peek(body)[0].split(':', 1)[0] in IDEMPOTENT_COMMANDS
+
+def control(command, service):
+    ''' Frames of the control message `command` of a worker for `service` '''
+    return [b'', VERSION, command, service]
+
+def worker_identity(service):
+    ''' Socket identity for a worker of `service`, unique across hosts and processes '''
+    return b'{}-{}-{}'.format(service, gethostname(), os.getpid())
+
+def ok_reply(*payload):
+    ''' Status and payload frames of a successful reply '''
+    return [OK, pack(payload)]
+
+def error_reply(reason):
+    ''' Status and payload frames of a failed request '''
+    return [ERROR, pack([reason])]
+
+def busy_reply(reason):
+    ''' Status and payload frames of a request turned away by an overloaded target '''
+    return [BUSY, pack([reason])]
+
+def topic(target, device, name):
+    ''' Telemetry topic of the reading `name` of `device` at `target` '''
+    return b'/'.join([target, device, name])
+
+def publish(socket, topic, *values):
+    ''' Publish the string `values` under `topic` on the telemetry bus '''
+    socket.send_multipart([topic, pack(values)])
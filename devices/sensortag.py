@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 import zmq
+import json
 import threading
 import time
 
-from mixins import RegularUpdateMixin
+from mixins import RegularUpdateMixin, TelemetryMixin
 from utils import raise_msg
+from client import request, batch, BrokerError, DEFAULT_TIMEOUT
+import protocol
 
 # GUI-related
 from IPython.utils.traitlets import Unicode, Float, List
 from sensors import ScalarSensorWidget, TupleSensorWidget
 
-from actor import ReadEvery, Echo
+from actor import ReadEvery, echo
 
 class SensorTag(object):
 
@@ -52,28 +55,30 @@ class SensorTag(object):
 
         Default timeout is 5s.
         '''
-        broker_port = "9800"  #TODO: Move this to a global configuration
-        context = zmq.Context().instance()
-        socket = context.socket(zmq.REQ)
-        socket.connect("tcp://localhost:%s" % broker_port)
-
-        # Use poller for timeouts
-        p = zmq.Poller()
-        p.register(socket, zmq.POLLIN)
-
-        # Send discovery message
-        socket.send('SensorTag discover')
-
-        # Receive result or time out
-        msgs = dict(p.poll(timeout)) 
-        if socket in msgs and msgs[socket] == zmq.POLLIN:
-            result = socket.recv().split(' ')
-            socket.close()
-            return map( lambda x: (SensorTag, x), result)
-        # Socket time out
-        else:
-            socket.close()
+        # Send discovery message, and receive result or time out (or fail
+        # if the daemon isn't running)
+        try:
+            result = request('SensorTag', 'discover', timeout=timeout/1000.)
+        except BrokerError:
             return None
+        return map( lambda x: (SensorTag, x), result)
+
+    @staticmethod
+    def snapshot_all(tags, timeout=DEFAULT_TIMEOUT):
+        ''' Snapshots of many tags, in a single round trip
+
+        `tags` are SensorTag objects. The daemon reads all of them at once,
+        so refreshing a dashboard of every sensor of every tag takes about as
+        long as the slowest tag. Returns a dict of the snapshot of every tag
+        (see `snapshot`) by its address, or the BrokerError it failed with.
+        '''
+        results = batch([('SensorTag', 'snapshot', tag._uuid) for tag in tags], timeout)
+        snapshots = {}
+        for tag, result in zip(tags, results):
+            if not isinstance(result, BrokerError):
+                result = tag._apply_snapshot(json.loads(result[0]))
+            snapshots[tag._uuid] = result
+        return snapshots
 
     @staticmethod
     def pretty_name():
@@ -101,42 +106,53 @@ class SensorTag(object):
         '''Establishes a connection to the SensorTag BT Daemon
         Tells it to connect to the bluetooth device
         '''
-        # Create local socket connection
-        port = "9800"
-        context = zmq.Context().instance()
-        socket = context.socket(zmq.REQ)
-        socket.connect("tcp://localhost:%s" % port)
-
         # Send the connection command
-        socket.send('SensorTag connect {}'.format(self._uuid))
-        result = socket.recv() #TODO Add time out handling
-        socket.close()
-
-        if result == 'OK':
-            return True
-        elif result == 'fail':
+        try:
+            request('SensorTag', 'connect', self._uuid)
+        except BrokerError:
             raise_msg(IOError('Cannot connect to SensorTag. Is it discoverable?'))
-        else:
-            raise_msg(ValueError('Unexpected response received: ' + result))
+            return False
+        return True
+
 
+    def snapshot(self):
+        ''' Read all the sensors of the tag that are on, in a single request
+
+        Returns a dict with the time of the readings (`time`, in seconds since
+        the epoch) and the reading of every sensor by name, e.g.
+        {'time': 1400000000.5, 'temperature': 23.12, 'magnetometer': [...]}.
+        The sensors of the tag that are in use get their `value` updated, as
+        if they were read one by one.
+        '''
+        record, = self._send_cmd('snapshot')
+        return self._apply_snapshot(json.loads(record))
+
+    def _apply_snapshot(self, record):
+        ''' Update the sensors from the snapshot `record` of the daemon, return the readings '''
+        readings = {'time': record.pop('time')}
+        for name, values in record.items():
+            # (Only the sensors that were asked for, __getattr__ would create the others)
+            sensor = self.__dict__.get(name)
+            if sensor is not None:
+                sensor.value = sensor._parse_reading(values)
+                readings[name] = sensor.value
+            else:
+                values = map(float, values)
+                readings[name] = values[0] if len(values) == 1 else values
+        return readings
 
     def _send_cmd(self, cmd, args=[]):
         ''' 
         Send a custom command to the daemon
+        Returns the list of payload frames of the reply
         '''
+        return request('SensorTag', cmd, self._uuid, args)
 
-        port = "9800"
-        context = zmq.Context().instance()
-        socket = context.socket(zmq.REQ)
-        socket.connect("tcp://localhost:%s" % port)
+    def _topic(self, sensor):
+        ''' Telemetry topic of the readings of `sensor`, e.g. 'temperature' '''
+        return protocol.topic('SensorTag', self._uuid, sensor)
 
-        socket.send('SensorTag {} {} {}'.format( cmd, self._uuid, ",".join(args)))
-        result = socket.recv()
-        socket.close()
-
-        return result
-
-class SensorTagMagnetometer(RegularUpdateMixin, TupleSensorWidget):
+class SensorTagMagnetometer(RegularUpdateMixin, TelemetryMixin, TupleSensorWidget):
     '''
     Magnetometer device for TI SensorTag
 
@@ -158,9 +174,6 @@ class SensorTagMagnetometer(RegularUpdateMixin, TupleSensorWidget):
         # Make sure to call the super constructor for traitlets
         super(SensorTagMagnetometer, self).__init__()
 
-        # Whether we have already enabled the sensor
-        self._is_enabled = False
-
         # When initiated take a first reading
         threading.Thread(target=self.read).start()
 
@@ -173,6 +186,12 @@ class SensorTagMagnetometer(RegularUpdateMixin, TupleSensorWidget):
         '''
         return self.sensortag._uuid + 'Magneto'
 
+    def _topic(self):
+        return self.sensortag._topic('magnetometer')
+
+    def _parse_reading(self, values):
+        return map(float, values)
+
     def calibrate(self):
         ''' Calibrate the magnetometer such that the current direction is (0,0,0) '''
         self.calibration =  self.read(with_calibrate = False)
@@ -194,20 +213,13 @@ class SensorTagMagnetometer(RegularUpdateMixin, TupleSensorWidget):
         else:
             calibration = (0,0,0)
 
-        # If it's not already enabled, enable it
-        if not self._is_enabled:
-            rval = self.sensortag._send_cmd("enableMagnetometer")
-            if rval == "OK":
-                self._is_enabled = True
-            time.sleep(3)
-
         rval = self.sensortag._send_cmd("readMagnetometer")
-        self.value = map(float,rval.split(","))
+        self.value = map(float,rval)
 
         #TODO: Subtract calibration
         return self.value
 
-class SensorTagTemperature(ScalarSensorWidget):
+class SensorTagTemperature(TelemetryMixin, ScalarSensorWidget):
 
     # Needed for the GUI
     sensor_type = Unicode("Amb. Temp", sync=True)
@@ -220,29 +232,18 @@ class SensorTagTemperature(ScalarSensorWidget):
         # Make sure to call the super constructor for traitlets
         super(SensorTagTemperature, self).__init__()
 
-        # Whether we have already enabled the sensor
-        self._is_enabled = False
-
-        # Run the read command in a thread so that the GUI can be displayed while
-        # the values are loading
-        #self.read()
-        #threading.Thread(target=self.read).start()
-        self.every(wait=1)
+        # Take the first reading in a thread so that the GUI can be displayed
+        # while the value is loading, and then follow the readings that the
+        # daemon publishes rather than polling the tag
+        threading.Thread(target=self.read).start()
+        self.listen()
 
     def read(self):
         ''' Return the temperature in Celsius
 
         Uses the read_value method of SensorTag with the appropriate addresses
         '''
-
-        # If it's not already enabled, enable it
-        if not self._is_enabled:
-            rval = self.sensortag._send_cmd("enableIrTemperature")
-            if rval == "OK":
-                self._is_enabled = True
-            time.sleep(1)
-
-        rval = self.sensortag._send_cmd("readIrTemperature")
+        rval, = self.sensortag._send_cmd("readIrTemperature")
         self.value = float(rval)
         return self.value
 
@@ -267,7 +268,10 @@ class SensorTagTemperature(ScalarSensorWidget):
         '''
         return self.sensortag._uuid + 'Temp'
 
-class SensorTagHumidity(ScalarSensorWidget):
+    def _topic(self):
+        return self.sensortag._topic('temperature')
+
+class SensorTagHumidity(TelemetryMixin, ScalarSensorWidget):
 
     # Needed for the GUI
     sensor_type = Unicode("Humidity", sync=True)
@@ -280,29 +284,18 @@ class SensorTagHumidity(ScalarSensorWidget):
         # Make sure to call the super constructor for traitlets
         super(SensorTagHumidity, self).__init__()
 
-        # Whether we have already enabled the sensor
-        self._is_enabled = False
-
-        # Run the read command in a thread so that the GUI can be displayed while
-        # the values are loading
-        #self.read()
-        #threading.Thread(target=self.read).start()
-        self.every(wait=1)
+        # Take the first reading in a thread so that the GUI can be displayed
+        # while the value is loading, and then follow the readings that the
+        # daemon publishes rather than polling the tag
+        threading.Thread(target=self.read).start()
+        self.listen()
 
     def read(self):
         ''' Return the humidity in %
 
         Uses the read_value method of SensorTag with the appropriate addresses
         '''
-
-        # If it's not already enabled, enable it
-        if not self._is_enabled:
-            rval = self.sensortag._send_cmd("enableHumidity")
-            if rval == "OK":
-                self._is_enabled = True
-            time.sleep(1)
-
-        rval = self.sensortag._send_cmd("readHumidity")
+        rval, = self.sensortag._send_cmd("readHumidity")
         self.value = float(rval)
 
         return self.value
@@ -328,6 +321,9 @@ class SensorTagHumidity(ScalarSensorWidget):
         '''
         return self.sensortag._uuid + 'Humidity'
 
+    def _topic(self):
+        return self.sensortag._topic('humidity')
+
 def main():
     import sys
 
@@ -0,0 +1,145 @@
+'''
+Kasa telemetry bus client
+
+The daemons publish their readings and state changes on the telemetry bus of
+the broker (see `protocol`). Rather than every consumer asking the device for
+a value, consumers subscribe to its topic, and are called back whenever the
+daemon publishes it, no matter who caused the reading.
+
+Like `client`, the process shares one connection, owned by a background
+thread. Callbacks run in that thread, so they should return quickly.
+
+(c) 2014 Berk Birand
+'''
+import zmq
+import os
+import threading
+import traceback
+
+import protocol
+
+TELEMETRY_URL = "tcp://localhost:{}".format(protocol.TELEMETRY_SUBSCRIBE_PORT)
+
+class Subscription(object):
+    ''' A callback registered for a topic, returned by `subscribe` '''
+
+    def __init__(self, bus, topic, callback):
+        self.bus = bus
+        self.topic = topic
+        self.callback = callback
+
+    def cancel(self):
+        ''' Stop calling the callback '''
+        self.bus.unsubscribe(self)
+
+class TelemetryBus(object):
+    '''
+    Subscriber connection to the telemetry bus
+
+    Use `get_bus()` rather than creating instances directly, so that the
+    process shares a single connection.
+    '''
+
+    def __init__(self, url=TELEMETRY_URL, context=None):
+        self.url = url
+        self.context = context or zmq.Context.instance()
+
+        # Subscriptions by topic
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+        # Changes in the topics are sent to the I/O thread, which owns the
+        # SUB socket. Only used with the lock held.
+        self._control_url = "inproc://kasa-telemetry-{}".format(id(self))
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._io_loop, args=(ready,),
+                                        name="KasaTelemetry")
+        self._thread.daemon = True
+        self._thread.start()
+        ready.wait()
+
+        self._control = self.context.socket(zmq.PAIR)
+        self._control.connect(self._control_url)
+
+    def subscribe(self, topic, callback):
+        ''' Call `callback(topic, values)` for every message published under `topic`
+
+        Only messages with exactly this topic are passed on. Returns a
+        Subscription, whose `cancel()` method stops the callbacks.
+        '''
+        subscription = Subscription(self, topic, callback)
+        with self._lock:
+            if topic not in self._subscriptions:
+                self._subscriptions[topic] = []
+                self._control.send_multipart([b'subscribe', topic])
+            self._subscriptions[topic].append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        ''' Stop calling back `subscription` '''
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.topic, [])
+            if subscription not in subscriptions:
+                return
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.topic]
+                self._control.send_multipart([b'unsubscribe', subscription.topic])
+
+    def _io_loop(self, ready):
+        ''' Owns the SUB socket: applies the topic changes and runs the callbacks '''
+        control = self.context.socket(zmq.PAIR)
+        control.bind(self._control_url)
+
+        bus = self.context.socket(zmq.SUB)
+        bus.setsockopt(zmq.LINGER, 0)
+        bus.connect(self.url)
+        ready.set()
+
+        p = zmq.Poller()
+        p.register(control, zmq.POLLIN)
+        p.register(bus, zmq.POLLIN)
+
+        while True:
+            socks = dict(p.poll())
+
+            if control in socks:
+                action, topic = control.recv_multipart()
+                option = zmq.SUBSCRIBE if action == b'subscribe' else zmq.UNSUBSCRIBE
+                bus.setsockopt(option, topic)
+
+            if bus in socks:
+                topic, payload = bus.recv_multipart()
+                with self._lock:
+                    subscriptions = list(self._subscriptions.get(topic, []))
+                if not subscriptions:
+                    # A longer topic with a subscribed prefix
+                    continue
+
+                values = protocol.unpack(payload)
+                for subscription in subscriptions:
+                    try:
+                        subscription.callback(topic, values)
+                    except Exception:
+                        # Don't let a broken callback stop the others
+                        traceback.print_exc()
+
+# Process-wide bus connection, created on first use
+_bus = None
+_bus_pid = None
+_bus_lock = threading.Lock()
+
+def get_bus():
+    ''' Return the telemetry connection shared by the whole process '''
+    global _bus, _bus_pid
+
+    with _bus_lock:
+        # Do not reuse a connection inherited through fork()
+        if _bus is None or _bus_pid != os.getpid():
+            _bus = TelemetryBus()
+            _bus_pid = os.getpid()
+        return _bus
+
+def subscribe(topic, callback):
+    ''' Subscribe to `topic` on the shared connection, see `TelemetryBus.subscribe` '''
+    return get_bus().subscribe(topic, callback)
@@ -1,4 +1,4 @@
-import zmq 
+import json
 
 from ouimeaux.environment import Environment
 from ouimeaux.signals import statechange, receiver
@@ -6,8 +6,11 @@ from ouimeaux.signals import statechange, receiver
 from IPython.html import widgets
 from IPython.utils.traitlets import Bool, Unicode, Float, Int
 from devices.utils import AlignableWidget
+from client import request, BrokerError
+from mixins import TelemetryMixin
+import protocol
 
-from actor import Actor, ReadEvery, Echo
+from actor import Actor, ReadEvery, echo
 
 class WeMoToggle(Actor):
     name = "WeMoToggle"
@@ -24,53 +27,63 @@ class WeMoToggle(Actor):
                 last_state = i
             yield i
 
-class WeMoSwitch(widgets.DOMWidget, AlignableWidget):
+class WeMoSwitch(TelemetryMixin, widgets.DOMWidget, AlignableWidget):
     ''' Our implementation of a WeMo Switch '''
     _view_name = Unicode('WeMoSwitchView', sync=True)
     value = Bool(sync=True)
     description = Unicode(sync=True)
 
     @staticmethod
-    def _send_wemo(command):
+    def _send_wemo(command, name=b'', args=()):
         ''' Low-level send a command to the WeMo module
 
+        Returns the list of payload frames of the reply.
         Mostly intended for internal use of the class
         '''
-        #TODO Wrap this type of functionality in a Kasa protocol library
-
-        # Connect to broker
-        port = "9800"
-        context = zmq.Context().instance()
-        sock = context.socket(zmq.REQ)
-        sock.connect("tcp://localhost:%s" % port)
-
-        # Send the command
-        sock.send('WeMo {}'.format(command))
-        result =  sock.recv() 
-        sock.close()
-        return result
+        return request('WeMo', command, name, args)
 
     @staticmethod
     def discover():
-        # Discover WeMo devices in the environment
-        port = "9800"
-        context = zmq.Context().instance()
-        sock = context.socket(zmq.REQ)
-        sock.connect("tcp://localhost:%s" % port)
-
-        # Send the connection command
-        sock.send('WeMo list')
-        result = sock.recv()
-        sock.close()
-
-        if result != '':
-            devs = result.split(' ')
+        # Discover WeMo devices in the environment (none if the daemon
+        # isn't running)
+        try:
+            devs = WeMoSwitch._send_wemo('list')
+        except BrokerError:
+            return None
+
+        if devs:
             # Create correct data structure
             l2 = map( lambda x:(WeMoSwitch, x), devs)
             return l2
         else:
             return None
     
+    @staticmethod
+    def state_all(fresh=False):
+        ''' State of every known switch, in a single request
+
+        Returns a dict of switch name: True if on, False if off, or None if
+        the switch could not be asked.
+        '''
+        values = WeMoSwitch._send_wemo('state_all', args=['fresh'] if fresh else [])
+        states = {'on': True, 'off': False}
+        return dict((name, states.get(st)) for name, st in zip(values[::2], values[1::2]))
+
+    @staticmethod
+    def set_many(states):
+        ''' Turn several switches on or off in a single request
+
+        `states` maps switch names to True (on) or False (off), and the daemon
+        changes all the switches at once. Returns a dict with the error of
+        every switch that could not be changed, which is empty if all went well.
+        '''
+        args = []
+        for name, on in states.items():
+            args.extend([name, 'on' if on else 'off'])
+        values = WeMoSwitch._send_wemo('set_many', args=args)
+        return dict((name, result) for name, result in zip(values[::2], values[1::2])
+                    if result not in ('on', 'off'))
+
     @staticmethod
     def pretty_name():
         ''' Name of the class '''
@@ -103,9 +116,16 @@ class WeMoSwitch(widgets.DOMWidget, AlignableWidget):
         else:
             self.description = self.name
 
+        # Set while the value is updated from the telemetry bus, so that the
+        # new state is not sent back to the switch
+        self._updating_from_bus = False
+
         # Callback for changing value
         self.on_trait_change(self.on_value_change, 'value')
 
+        # Follow the changes made by others
+        self.listen()
+
     def set(self):
         return WeMoToggle(self)
 
@@ -119,20 +139,56 @@ class WeMoSwitch(widgets.DOMWidget, AlignableWidget):
             self.off()
 
     def on(self):
-        self._send_wemo('on {}'.format(self.name))
+        self._send_wemo('on', self.name)
         self.value = True
 
     def off(self):
-        self._send_wemo('off {}'.format(self.name))
+        self._send_wemo('off', self.name)
         self.value = False
 
-    def state(self):
-        val = self._send_wemo('state {}'.format(self.name))
+    def state(self, fresh=False):
+        ''' Whether the switch is on
+
+        The daemon answers from the last state that the switch reported,
+        pass `fresh=True` to have it ask the switch instead.
+        '''
+        val, = self._send_wemo('state', self.name, ['fresh'] if fresh else [])
         if val == 'on':
             return True
         else:
             return False
 
+    def power(self):
+        ''' Latest power reading of an Insight switch
+
+        Returns a dict with the power in W, the energy used today and in
+        total in kWh, and the time of the reading.
+        '''
+        values = self._send_wemo('power', self.name)
+        return dict(zip(['power', 'today_kwh', 'total_kwh', 'time'], map(float, values)))
+
+    def power_rollups(self):
+        ''' Average, min and max power of an Insight switch
+
+        Returns a dict with the '1m' windows of the last hour and the '1h'
+        windows of the last day, oldest first.
+        '''
+        values, = self._send_wemo('power_rollups', self.name)
+        return json.loads(values)
+
+    #
+    # Telemetry
+    #
+    def _topic(self):
+        return protocol.topic('WeMo', self.name, 'state')
+
+    def _on_reading(self, topic, values):
+        self._updating_from_bus = True
+        try:
+            self.value = values[0] == 'on'
+        finally:
+            self._updating_from_bus = False
+
     #
     # Change callback
     #
@@ -142,6 +198,10 @@ class WeMoSwitch(widgets.DOMWidget, AlignableWidget):
         When the value of the traitlet changes, make the appropriate
         change to execute the new value
         '''
+        # The switch is already in that state
+        if self._updating_from_bus:
+            return
+
         if value:
             self.on()
         else:
@@ -15,6 +15,7 @@ from devices.wemo import WeMoSwitch
 from devices.sensortag import SensorTag
 
 from devices.utils import raise_msg
+from devices import client
 
 from IPython.display import HTML, display_html
 
@@ -37,6 +38,28 @@ def kasa(name):
     raise_msg( LookupError("Device '{}' not available.".format(name)) )
 
 
+def batch(requests=None, timeout=client.DEFAULT_TIMEOUT):
+    ''' Send requests to many devices at once
+
+    The requests go out in parallel through the broker, so refreshing many
+    devices takes about as long as the slowest one. Either pass a list of
+    (target, command, device, args) tuples, and get back the list of their
+    results (the reply payload, or the error it failed with):
+
+        batch([('WeMo', 'state', 'Kitchen'), ('WeMo', 'state', 'Lamp')])
+
+    or use it as a context, where every request returns a placeholder whose
+    `get()` returns the payload once the block is done:
+
+        with batch() as b:
+            kitchen = b.request('WeMo', 'state', 'Kitchen')
+        kitchen.get()
+    '''
+    if requests is None:
+        return client.Batch(timeout)
+    return client.batch(requests, timeout)
+
+
 '''
 
  Discovery functions
@@ -8,6 +8,7 @@
  *
  */
 
+var os = require('os');
 var zmq = require('zmq');
 var util = require('util');
 var async = require('async');
@@ -16,43 +17,306 @@ var SensorTag = require('sensortag');
 var port = 'tcp://127.0.0.1:9801';
 var socket = zmq.socket('dealer');
 
-// Connect to the broker
-socket['identity'] = "SensorTag";
+// Protocol constants, must match devices/protocol.py
+var PROTOCOL_VERSION = 'KASA03';
+var HEARTBEAT_INTERVAL = 1000;
+var SERVICE = 'SensorTag';
+
+// Connect to the broker, with an identity of our own, since other
+// instances may serve SensorTags too
+socket['identity'] = SERVICE + '-' + os.hostname() + '-' + process.pid;
 socket.connect(port);
 console.log('connected to broker');
 
+// Register with the broker, and keep sending heartbeats so that it
+// knows we are alive
+socket.send(['', PROTOCOL_VERSION, 'READY', SERVICE]);
+setInterval(function() {
+    socket.send(['', PROTOCOL_VERSION, 'HEARTBEAT', SERVICE]);
+}, HEARTBEAT_INTERVAL);
+
+//
+// Telemetry bus
+//
+// Readings are published under SensorTag/<uuid>/<sensor>. The socket is an
+// XPUB, so that we also see what the clients subscribe to: while someone is
+// subscribed to a sensor, its notifications are turned on and every new
+// value is published, without anyone polling.
+var TELEMETRY_PORT = 'tcp://127.0.0.1:9802';
+var telemetry = zmq.socket('xpub');
+telemetry.connect(TELEMETRY_PORT);
+
+// Milliseconds without reads after which a sensor that nobody is
+// subscribed to is switched off again
+var SENSOR_IDLE = 60000;
+
+// How to switch each sensor on and off, read it, and turn its readings into
+// strings, and the milliseconds it takes to give its first reading once on
+var SENSORS = {
+    temperature: {
+        enable: 'enableIrTemperature', disable: 'disableIrTemperature', read: 'readIrTemperature',
+        warmUp: 1000,
+        notify: 'notifyIrTemperature', unnotify: 'unnotifyIrTemperature', event: 'irTemperatureChange',
+        values: function(objectTemperature, ambientTemperature) {
+            return [ambientTemperature.toFixed(2)];
+        }
+    },
+    humidity: {
+        enable: 'enableHumidity', disable: 'disableHumidity', read: 'readHumidity',
+        warmUp: 1000,
+        notify: 'notifyHumidity', unnotify: 'unnotifyHumidity', event: 'humidityChange',
+        values: function(temp, humidity) { return [humidity.toFixed(2)]; }
+    },
+    pressure: {
+        enable: 'enableBarometricPressure', disable: 'disableBarometricPressure', read: 'readBarometricPressure',
+        warmUp: 1000,
+        notify: 'notifyBarometricPressure', unnotify: 'unnotifyBarometricPressure', event: 'barometricPressureChange',
+        values: function(pressure) { return [pressure.toFixed(2)]; }
+    },
+    magnetometer: {
+        enable: 'enableMagnetometer', disable: 'disableMagnetometer', read: 'readMagnetometer',
+        warmUp: 3000,
+        notify: 'notifyMagnetometer', unnotify: 'unnotifyMagnetometer', event: 'magnetometerChange',
+        values: function(x, y, z) { return [x, y, z].map(String); }
+    },
+    accelerometer: {
+        enable: 'enableAccelerometer', disable: 'disableAccelerometer', read: 'readAccelerometer',
+        warmUp: 1000,
+        notify: 'notifyAccelerometer', unnotify: 'unnotifyAccelerometer', event: 'accelerometerChange',
+        values: function(x, y, z) { return [x, y, z].map(String); }
+    },
+    gyroscope: {
+        enable: 'enableGyroscope', disable: 'disableGyroscope', read: 'readGyroscope',
+        warmUp: 1000,
+        notify: 'notifyGyroscope', unnotify: 'unnotifyGyroscope', event: 'gyroscopeChange',
+        values: function(x, y, z) { return [x, y, z].map(String); }
+    }
+};
+
+// Topics that someone is subscribed to
+var subscribed = {};
+
+//
+// Sensor power
+//
+// The sensors are switched on here, for all the clients at once, rather
+// than by each client: a sensor is switched on by its first read (or
+// subscription), stays on while someone is subscribed to it, and is
+// switched off once nobody is and it went unread for SENSOR_IDLE.
+//
+// The sensors that are on, by tag and by name: whether they warmed up (and
+// the callbacks waiting for it if not), when they were last read, and the
+// timer that checks whether they went idle. The snapshots read all of them.
+var power = {};
+
+function isSubscribed(uuid, sensor) {
+    return ('SensorTag/' + uuid + '/' + sensor) in subscribed;
+}
+
+// Switch `sensor` on if it is off, and call back once it can be read. The
+// sensor counts as read unless `subscribing`
+function powerOn(uuid, sensorTag, sensor, callback, subscribing) {
+    power[uuid] = power[uuid] || {};
+    var state = power[uuid][sensor];
+    if (!state) {
+        state = power[uuid][sensor] = {ready: false, waiting: [], lastRead: 0, timer: null};
+        sensorTag[SENSORS[sensor].enable](function() {
+            setTimeout(function() {
+                state.ready = true;
+                state.waiting.forEach(function(waiting) { waiting(); });
+                state.waiting = [];
+            }, SENSORS[sensor].warmUp);
+        });
+    }
+    if (!subscribing) {
+        state.lastRead = Date.now();
+    }
+    scheduleIdle(uuid, sensorTag, sensor);
+    if (state.ready) {
+        callback();
+    } else {
+        state.waiting.push(callback);
+    }
+}
+
+// Switch `sensor` off, unless someone is subscribed to it. It is switched
+// off right away if it went unread for SENSOR_IDLE already, and once it
+// does otherwise
+function powerOff(uuid, sensorTag, sensor) {
+    var state = (power[uuid] || {})[sensor];
+    if (!state || isSubscribed(uuid, sensor)) {
+        return;
+    }
+    if (Date.now() < state.lastRead + SENSOR_IDLE) {
+        scheduleIdle(uuid, sensorTag, sensor);
+        return;
+    }
+    clearTimeout(state.timer);
+    delete power[uuid][sensor];
+    sensorTag[SENSORS[sensor].disable](function() {});
+}
+
+// Check for idleness once `sensor` may have gone idle
+function scheduleIdle(uuid, sensorTag, sensor) {
+    var state = power[uuid][sensor];
+    if (state.timer) {
+        return;
+    }
+    state.timer = setTimeout(function() {
+        state.timer = null;
+        powerOff(uuid, sensorTag, sensor);
+    }, Math.max(state.lastRead + SENSOR_IDLE - Date.now(), 0));
+}
+
+// Forget the sensors of a tag, which are off once it (re)connects
+function resetPower(uuid) {
+    Object.keys(power[uuid] || {}).forEach(function(sensor) {
+        clearTimeout(power[uuid][sensor].timer);
+    });
+    power[uuid] = {};
+}
+
+// The sensor that `cmd` switches on, switches off or reads, and which of
+// these it does, if any
+function sensorCommand(cmd) {
+    var sensors = Object.keys(SENSORS);
+    for (var i = 0; i < sensors.length; i++) {
+        var s = SENSORS[sensors[i]];
+        if (cmd == s.enable || cmd == s.disable || cmd == s.read) {
+            return {sensor: sensors[i], action: cmd == s.enable ? 'enable' : cmd == s.disable ? 'disable' : 'read'};
+        }
+    }
+    return null;
+}
+
+// Read all the sensors of a tag that are on, at the same time, and call
+// back with a single record of their readings: {time: <seconds since the
+// epoch>, <sensor>: [values], ...}. The readings are published as well
+function snapshot(uuid, sensorTag, callback) {
+    var record = {time: Date.now() / 1000};
+    async.each(Object.keys(power[uuid] || {}), function(sensor, done) {
+        var s = SENSORS[sensor];
+        powerOn(uuid, sensorTag, sensor, function() {
+            sensorTag[s.read](function() {
+                record[sensor] = s.values.apply(null, arguments);
+                publish(uuid, sensor, record[sensor]);
+                done();
+            });
+        });
+    }, function() {
+        callback(record);
+    });
+}
+
+function publish(uuid, sensor, values) {
+    telemetry.send(['SensorTag/' + uuid + '/' + sensor, JSON.stringify(values)]);
+}
+
+// Turn the notifications of `sensor` on or off. The sensor is on while
+// someone is subscribed to it, and switched off with the last subscription
+// unless it is still being read
+function setNotify(uuid, sensorTag, sensor, on) {
+    var s = SENSORS[sensor];
+    if (on) {
+        powerOn(uuid, sensorTag, sensor, function() {
+            sensorTag[s.notify](function() {});
+        }, true);
+    } else {
+        sensorTag[s.unnotify](function() {
+            powerOff(uuid, sensorTag, sensor);
+        });
+    }
+}
+
+// Publish the notifications of a newly connected tag
+function watchTag(uuid, sensorTag) {
+    Object.keys(SENSORS).forEach(function(sensor) {
+        sensorTag.on(SENSORS[sensor].event, function() {
+            publish(uuid, sensor, SENSORS[sensor].values.apply(null, arguments));
+        });
+
+        // Someone was already waiting for it
+        if (('SensorTag/' + uuid + '/' + sensor) in subscribed) {
+            setNotify(uuid, sensorTag, sensor, true);
+        }
+    });
+}
+
+// Subscription messages are the topic, prefixed with 1 (subscribe) or 0
+telemetry.on('message', function(data) {
+    var on = data[0] == 1;
+    var topic = data.slice(1).toString();
+    if (on) {
+        subscribed[topic] = true;
+    } else {
+        delete subscribed[topic];
+    }
+
+    var parts = topic.split('/');
+    if (parts.length != 3 || parts[0] != 'SensorTag' || !(parts[2] in SENSORS)) {
+        return;
+    }
+    if (parts[1] in currently_connected_devs) {
+        setNotify(parts[1], currently_connected_devs[parts[1]], parts[2], on);
+    }
+});
+
+// Reply to a request with the OK status and the list of strings in `payload`
+function replyOK(client, payload) {
+    socket.send([client, 'OK', JSON.stringify(payload || [])]);
+}
+
+// Reply to a request with an error message
+function replyError(client, reason) {
+    socket.send([client, 'ERROR', JSON.stringify([reason])]);
+}
+
 currently_connected_devs = {}
 
 // Carry out the action upon receiving data
-socket.on('message', function(client, empty, data) {
+// Requests arrive as [client, body], where the body is the JSON
+// array [command, device, args...]
+socket.on('message', function(client, body) {
+    var msg;
+    try {
+        msg = JSON.parse(body.toString());
+    } catch (e) {
+        replyError(client, 'Malformed request');
+        return
+    }
+    if (!Array.isArray(msg)) {
+        replyError(client, 'Malformed request');
+        return
+    }
     console.log('From:\'' + client + '\'');
-    console.log('Data:\'' + data   + '\'');
-    msg = data.toString().split(' ')
+    console.log('Data:\'' + msg + '\'');
 
     // Discover command
     if (msg[0] == "discover") {
         console.log("Discover");
-        // First send list of currently connected devices, if any
-        for (var k in currently_connected_devs) {
-            console.log("Already connected to " + k);
-            socket.send([client, '', k]);
+        // Send list of currently connected devices, if any
+        var connected = Object.keys(currently_connected_devs);
+        if (connected.length > 0) {
+            console.log("Already connected to " + connected);
+            replyOK(client, connected);
+            return
         }
 
-        // Then actually run the discovery routine
+        // Otherwise actually run the discovery routine
         SensorTag.discover(function(sensorTag) {
             console.log("Discovered: " + sensorTag);
-            socket.send([client, '', sensorTag['uuid']]);
+            replyOK(client, [sensorTag['uuid']]);
         });
         return
     }
     // Connect command
     else if (msg[0] == "connect") {
         console.log("Connecting to: " + msg[1]);
-        target_uuid = msg[1];
+        var target_uuid = msg[1];
 
         // If we are already connected, just return OK
         if (target_uuid in currently_connected_devs) {
-            socket.send([client, '', 'OK']);
+            replyOK(client);
             console.log("Already connected.");
             return
         }
@@ -62,8 +326,10 @@ socket.on('message', function(client, empty, data) {
             sensorTag.connect(function(err) {
                 //TODO: Add to a global data structure that we're connected
                 currently_connected_devs[target_uuid] = sensorTag;
+                resetPower(target_uuid);
                 sensorTag.discoverServicesAndCharacteristics(function(){
-                    socket.send([client, '', 'OK']);
+                    watchTag(target_uuid, sensorTag);
+                    replyOK(client);
                     console.log("Connected.");
                 });
             });
@@ -72,135 +338,118 @@ socket.on('message', function(client, empty, data) {
     }
     // Disconnect command
     else if (msg[0] == "disconnect") {
-        throw new Error('Disconnect not implemented');
+        replyError(client, 'Disconnect not implemented');
+        return
     }
 
     //
     // Parse per-device arguments
     //
-    cmd = msg[0]
-    uuid = msg[1]
-    args = msg.slice(2)
+    var cmd = msg[0];
+    var uuid = msg[1];
+    var args = msg.slice(2);
 
     // Make sure that we have a connection to the device
     if (!(uuid in currently_connected_devs)) {
         //TODO: If not, connect to the device?
-        throw new Error('Not connected to ' + uuid);
+        replyError(client, 'Not connected to ' + uuid);
+        return
     }
 
     // Fetch right SensorTag object
-    sensorTag = currently_connected_devs[uuid];
+    var sensorTag = currently_connected_devs[uuid];
+
+    // All the sensors that are on, in one request
+    if (cmd == "snapshot") {
+        snapshot(uuid, sensorTag, function(record) {
+            replyOK(client, [JSON.stringify(record)]);
+        });
+        return
+    }
 
+    // The sensors are switched on for their reads, and off once idle (see
+    // powerOn). Switching one off only lets it go idle, since other clients
+    // may still be using it
+    var sensorCmd = sensorCommand(cmd);
+    if (sensorCmd && sensorCmd.action == 'enable') {
+        powerOn(uuid, sensorTag, sensorCmd.sensor, function() {
+            replyOK(client);
+        });
+        return
+    }
+    if (sensorCmd && sensorCmd.action == 'disable') {
+        powerOff(uuid, sensorTag, sensorCmd.sensor);
+        replyOK(client);
+        return
+    }
+    if (sensorCmd) {
+        powerOn(uuid, sensorTag, sensorCmd.sensor, function() {
+            read(client, uuid, sensorTag, cmd);
+        });
+        return
+    }
+
+    replyError(client, 'Unknown command ' + cmd);
+});
+
+// Read a sensor of `sensorTag` with the read command `cmd`, reply to
+// `client` with the reading and publish it
+function read(client, uuid, sensorTag, cmd) {
     switch(cmd) {
         // Temperature chip
-        case "enableIrTemperature":
-            sensorTag.enableIrTemperature(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
-        case "disableIrTemperature":
-            sensorTag.disableIrTemperature(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
         case "readIrTemperature":
             sensorTag.readIrTemperature(function(objectTemperature, ambientTemperature) {
                 console.log('\tobject temperature = %d °C', objectTemperature.toFixed(1));
                 console.log('\tambient temperature = %d °C', ambientTemperature.toFixed(1));
-                socket.send([client, '', ambientTemperature.toFixed(2)]);
+                replyOK(client, [ambientTemperature.toFixed(2)]);
+                publish(uuid, 'temperature', [ambientTemperature.toFixed(2)]);
             });
             break;
 
         // Humidity chip
-        case "enableHumidity":
-            sensorTag.enableHumidity(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
-        case "disableHumidity":
-            sensorTag.disableHumidity(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
         case "readHumidity":
             sensorTag.readHumidity(function(temp, humidity) {
                 console.log('\ttemperature = %d °C', temp.toFixed(2));
                 console.log('\thumidity = %d °C', humidity.toFixed(2));
-                socket.send([client, '', humidity.toFixed(2)]); // + "," + temp.toFixed(2)]);
+                replyOK(client, [humidity.toFixed(2)]);
+                publish(uuid, 'humidity', [humidity.toFixed(2)]);
             });
             break;
 
         // Barometric Pressure chip
-        case "enableBarometricPressure":
-            sensorTag.enableBarometricPressure(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
-        case "disableBarometricPressure":
-            sensorTag.disableBarometricPressure(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
         case "readBarometricPressure":
             sensorTag.readBarometricPressure(function(pressure) {
                 console.log('\tpressure = %d °C', pressure.toFixed(12));
-                socket.send([client, '', pressure.toFixed(2)]);
+                replyOK(client, [pressure.toFixed(2)]);
+                publish(uuid, 'pressure', [pressure.toFixed(2)]);
             });
             break;
 
         // Magnetometer chip
-        case "enableMagnetometer":
-            sensorTag.enableMagnetometer(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
-        case "disableMagnetometer":
-            sensorTag.disableMagnetometer(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
         case "readMagnetometer":
             sensorTag.readMagnetometer(function(x,y,z) {
                 console.log('\tmagnetometer = %d,%d,%d', x.toFixed(2), y.toFixed(2), z.toFixed(2));
-                socket.send([client, '', [x,y,z].join() ]);
+                replyOK(client, [x, y, z].map(String));
+                publish(uuid, 'magnetometer', [x, y, z].map(String));
             });
             break;
 
         // Accelerometer chip
-        case "enableAccelerometer":
-            sensorTag.enableAccelerometer(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
-        case "disableAccelerometer":
-            sensorTag.disableAccelerometer(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
         case "readAccelerometer":
             sensorTag.readAccelerometer(function(x,y,z) {
                 console.log('\taccelerometer = %d,%d,%d', x.toFixed(2), y.toFixed(2), z.toFixed(2));
-                socket.send([client, '', [x,y,z].join() ]);
+                replyOK(client, [x, y, z].map(String));
+                publish(uuid, 'accelerometer', [x, y, z].map(String));
             });
             break;
 
         // Gyroscope chip
-        case "enableGyroscope":
-            sensorTag.enableGyroscope(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
-        case "disableGyroscope":
-            sensorTag.disableGyroscope(function() {
-                socket.send([client, '', 'OK']);
-            });
-            break;
         case "readGyroscope":
             sensorTag.readGyroscope(function(x,y,z) {
                 console.log('\tgyroscope = %d,%d,%d', x.toFixed(2), y.toFixed(2), z.toFixed(2));
-                socket.send([client, '', [x,y,z].join() ]);
+                replyOK(client, [x, y, z].map(String));
+                publish(uuid, 'gyroscope', [x, y, z].map(String));
             });
             break;
     }
-
-});
+}